@@ -0,0 +1,88 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Per-packet cost of dispatching IPMI requests in a virtual BMC.
+
+Feeds requests straight to `VirtualBMC.dispatch_raw_request` with a session
+which drops the responses, so that only the lookup of the handler and the
+building of the response payload are measured.
+
+    python benchmarks/ipmi_dispatch.py --requests 200000
+
+No VI Server is needed; the commands handled here do not call it.
+"""
+
+import argparse
+import logging
+import sys
+import time
+
+# netfn, command, data and name of the requests to dispatch
+REQUESTS = [
+    (0x06, 0x01, b"", "get device id"),
+    (0x06, 0x41, b"\x02\x40", "get channel access"),
+    (0x06, 0x42, b"\x02", "get channel info"),
+    (0x0C, 0x02, b"\x02\x05\x00\x00", "get lan conf mac"),
+    (0x0C, 0x02, b"\x02\x03\x00\x00", "get lan conf other"),
+    (0x2C, 0x00, b"", "unsupported"),
+]
+
+
+class _NullSession(object):
+    def send_ipmi_response(self, data=(), code=0):
+        self._send_ipmi_net_payload(data=data, code=code)
+
+    def _send_ipmi_net_payload(self, data=(), code=0, **kwargs):
+        # What the pyghmi and asyncio sessions do with the payload first
+        bytearray((code,)) + bytearray(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=200000)
+    args = parser.parse_args()
+
+    from vbmc4vsphere.vbmc import VirtualBMC
+
+    # Logging would be most of the cost otherwise
+    logging.disable(logging.INFO)
+
+    vbmc = VirtualBMC(
+        username="admin",
+        password="password",
+        port=0,
+        address="127.0.0.1",
+        fakemac="02:00:00:00:00:01",
+        vm_name="bench",
+        vm_uuid=None,
+        viserver="192.0.2.1",
+    )
+    session = _NullSession()
+
+    print("%-20s %10s %10s" % ("request", "requests", "ns/req"))
+    for netfn, command, data, name in REQUESTS:
+        request = {"netfn": netfn, "command": command, "data": bytearray(data)}
+        dispatch = vbmc.dispatch_raw_request
+        start = time.perf_counter()
+        for _ in range(args.requests):
+            dispatch(request, session)
+        elapsed = time.perf_counter() - start
+        print(
+            "%-20s %10d %10.0f"
+            % (name, args.requests, elapsed / args.requests * 1e9)
+        )
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
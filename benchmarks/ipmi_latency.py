@@ -0,0 +1,195 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""IPMI request latency of the vBMC engines.
+
+Serves a few virtual BMCs with each engine, one of which answers `Get
+Chassis Status` only after a long simulated VI Server call, and measures
+the latency seen by clients of the other BMCs while that one is busy.
+
+    python benchmarks/ipmi_latency.py --bmcs 4 --requests 20
+
+No VI Server is needed; the power state handler is replaced by a sleep.
+"""
+
+import argparse
+import multiprocessing
+import sys
+import time
+
+BASE_PORT = 16300
+
+
+def _bmc_config(index, port):
+    return {
+        "username": "admin",
+        "password": "password",
+        "port": port,
+        "address": "127.0.0.1",
+        "fakemac": "02:00:00:00:00:%02x" % index,
+        "vm_name": "bench-%d" % index,
+        "vm_uuid": None,
+        "viserver": "192.0.2.1",
+    }
+
+
+def _simulate(vbmc, delay):
+    def get_power_state():
+        time.sleep(delay)
+        return 1
+
+    vbmc.get_power_state = get_power_state
+
+
+def _process_runner(config, delay):
+    from vbmc4vsphere.vbmc import VirtualBMC
+
+    vbmc = VirtualBMC(**config)
+    _simulate(vbmc, delay)
+    vbmc.listen(timeout=1)
+
+
+def _client(port, requests, results):
+    import pyghmi.ipmi.private.session as ipmisession
+    from pyghmi.ipmi import command
+
+    # The vBMCs only offer cipher suite 3
+    open_request = ipmisession.Session._open_rmcpplus_request
+
+    def sha1_open_request(self):
+        self.attemptedhash = 1
+        return open_request(self)
+
+    ipmisession.Session._open_rmcpplus_request = sha1_open_request
+
+    ipmi = command.Command(
+        bmc="127.0.0.1", userid="admin", password="password", port=port
+    )
+    latencies = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        ipmi.raw_command(netfn=0, command=1)
+        latencies.append(time.perf_counter() - start)
+    results.put((port, latencies))
+
+
+def _serve(name, configs, delays, workers):
+    """Start serving, return a function which stops serving."""
+    if name == "process":
+        processes = [
+            multiprocessing.get_context("fork").Process(
+                target=_process_runner, args=(config, delay), daemon=True
+            )
+            for config, delay in zip(configs, delays)
+        ]
+        for process in processes:
+            process.start()
+        time.sleep(1)
+
+        def stop():
+            for process in processes:
+                process.terminate()
+
+        return stop
+
+    if name == "single":
+        from vbmc4vsphere.engine import Engine
+
+        engine = Engine(workers)
+    else:
+        from vbmc4vsphere.aioserver import AsyncEngine
+
+        engine = AsyncEngine(workers)
+
+    engine.start()
+    for config, delay in zip(configs, delays):
+        _simulate(engine.add(config).vbmc, delay)
+
+    return engine.stop
+
+
+def run(name, args, port):
+    configs = [_bmc_config(i, port + i) for i in range(args.bmcs)]
+    delays = [args.slow_delay] + [args.delay] * (args.bmcs - 1)
+    stop = _serve(name, configs, delays, args.workers)
+
+    # Clients must not inherit the state of the pyghmi event loop
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    clients = [
+        context.Process(
+            target=_client, args=(config["port"], args.requests, results)
+        )
+        for config in configs
+    ]
+    for client in clients:
+        client.start()
+
+    collected = [results.get(timeout=args.timeout) for _ in clients]
+    for client in clients:
+        client.join()
+    stop()
+
+    # Only the clients of the BMCs which are not slow themselves count
+    latencies = []
+    for client_port, client_latencies in collected:
+        if client_port != configs[0]["port"]:
+            latencies.extend(client_latencies)
+
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--bmcs", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument(
+        "--delay", type=float, default=0.01, help="VI Server call duration"
+    )
+    parser.add_argument(
+        "--slow-delay",
+        type=float,
+        default=2.0,
+        help="VI Server call duration of the slow BMC",
+    )
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument(
+        "--engines", nargs="+", default=["process", "single", "asyncio"]
+    )
+    args = parser.parse_args()
+
+    print(
+        "%-8s %8s %8s %8s %8s"
+        % ("engine", "requests", "p50 ms", "p95 ms", "max ms")
+    )
+    for offset, name in enumerate(args.engines):
+        latencies = sorted(run(name, args, BASE_PORT + offset * args.bmcs))
+        if not latencies:
+            print("%-8s %8d" % (name, 0))
+            continue
+        print(
+            "%-8s %8d %8.1f %8.1f %8.1f"
+            % (
+                name,
+                len(latencies),
+                latencies[len(latencies) // 2] * 1000,
+                latencies[int(len(latencies) * 0.95)] * 1000,
+                latencies[-1] * 1000,
+            )
+        )
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,106 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Throughput of the sessionless packets of a virtual BMC.
+
+Feeds `Get Channel Authentication Capabilities`, `Get Channel Cipher
+Suites` and ASF Presence Ping packets, as sent by monitoring systems and
+vCenter Server before opening a session, straight to the packet handler
+of the pyghmi server, and reports how many packets per second it answers.
+The replies are built but not sent.
+
+    python benchmarks/ipmi_sessionless.py --packets 200000
+
+No VI Server is needed.
+"""
+
+import argparse
+import logging
+import sys
+import time
+
+# IPMI message of a request: rsAddr, netFn/rsLUN, checksum, rqAddr,
+# rqSeq/rqLUN, command and data
+AUTH_CAP = b"\x20\x18\xc8\x81\x04\x38\x8e\x04\xb5"
+CIPHER_SUITES = b"\x20\x18\xc8\x81\x08\x54\x0e\x00\x80\x15"
+
+# Name and packet of the requests
+PACKETS = [
+    (
+        "auth cap v1.5",
+        b"\x06\x00\xff\x07\x00" + bytes(8) + bytes([len(AUTH_CAP)]) + AUTH_CAP,
+    ),
+    (
+        "auth cap v2.0",
+        b"\x06\x00\xff\x07\x06\x00"
+        + bytes(8)
+        + bytes([len(AUTH_CAP), 0])
+        + AUTH_CAP,
+    ),
+    (
+        "cipher suites v2.0",
+        b"\x06\x00\xff\x07\x06\x00"
+        + bytes(8)
+        + bytes([len(CIPHER_SUITES), 0])
+        + CIPHER_SUITES,
+    ),
+    ("asf presence ping", b"\x06\x00\xff\x06\x00\x00\x11\xbe\x80\x01\x00\x00"),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--packets", type=int, default=200000)
+    args = parser.parse_args()
+
+    import pyghmi.ipmi.private.session as ipmisession
+
+    from vbmc4vsphere.vbmc import VirtualBMC
+
+    # Logging would be most of the cost otherwise
+    logging.disable(logging.INFO)
+
+    replies = []
+    ipmisession._io_sendto = lambda socket, packet, sockaddr: replies.append(
+        len(packet)
+    )
+
+    vbmc = VirtualBMC(
+        username="admin",
+        password="password",
+        port=0,
+        address="127.0.0.1",
+        fakemac="02:00:00:00:00:01",
+        vm_name="bench",
+        vm_uuid=None,
+        viserver="192.0.2.1",
+    )
+    sockaddr = ("127.0.0.1", 623)
+
+    print("%-20s %10s %12s" % ("packet", "packets", "packets/s"))
+    for name, packet in PACKETS:
+        replies.clear()
+        handle = vbmc.sessionless_data
+        start = time.perf_counter()
+        for _ in range(args.packets):
+            handle(packet, sockaddr)
+        elapsed = time.perf_counter() - start
+        if len(replies) != args.packets:
+            print("%-20s not answered" % name)
+            continue
+        print("%-20s %10d %12.0f" % (name, args.packets, args.packets / elapsed))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
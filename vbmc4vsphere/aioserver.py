@@ -0,0 +1,517 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import asyncio
+import concurrent.futures
+import hashlib
+import hmac
+import os
+import struct
+import threading
+import time
+
+import pyghmi.ipmi.private.session as ipmisession
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+from vbmc4vsphere import engine, log
+from vbmc4vsphere.vbmc import VirtualBMC
+
+__all__ = ["AsyncEngine"]
+
+LOG = log.get_logger()
+
+RMCP_HEADER = b"\x06\x00\xff\x07"
+
+# RMCP+ payload types
+PAYLOAD_IPMI = 0x00
+PAYLOAD_OPEN_SESSION_REQUEST = 0x10
+PAYLOAD_OPEN_SESSION_RESPONSE = 0x11
+PAYLOAD_RAKP1 = 0x12
+PAYLOAD_RAKP2 = 0x13
+PAYLOAD_RAKP3 = 0x14
+PAYLOAD_RAKP4 = 0x15
+
+PAYLOAD_ENCRYPTED = 0b10000000
+PAYLOAD_AUTHENTICATED = 0b01000000
+
+# Address of the BMC on the IPMB
+BMC_ADDRESS = 0x20
+
+# HMAC-SHA1-96
+INTEGRITY_LENGTH = 12
+
+# Seconds a session may stay unused before it is forgotten
+SESSION_IDLE_TIMEOUT = 60
+
+
+def _hmac_sha1(key, data):
+    return hmac.new(key, bytes(data), hashlib.sha1).digest()
+
+
+def _build_message(rsaddr, netfnlun, rqaddr, seqlun, command, data):
+    header = bytearray((rsaddr, netfnlun))
+    body = bytearray((rqaddr, seqlun, command)) + data
+    return (
+        header
+        + bytearray((ipmisession._checksum(*header),))
+        + body
+        + bytearray((ipmisession._checksum(*body),))
+    )
+
+
+class _Session(object):
+    """State of one RMCP+ session, as negotiated with cipher suite 3.
+
+    Cipher suite 3 (HMAC-SHA1 authentication, HMAC-SHA1-96 integrity,
+    AES-CBC-128 confidentiality) is the only one offered, as by pyghmi.
+    """
+
+    def __init__(self, sockaddr, client_sid):
+        self.sockaddr = sockaddr
+        self.client_sid = bytes(client_sid)
+        self.managed_sid = os.urandom(4)
+        self.localsid = struct.unpack("<I", self.managed_sid)[0]
+        self.established = False
+        self.sequencenumber = 1
+        self.remseqnumber = None
+        self.clientpriv = 4
+        self.maxpriv = 4
+        self.last_used = time.monotonic()
+
+    def start_rakp(self, rakp1, authdata, bmc_uuid):
+        """Process RAKP message 1, return the key exchange authentication code."""
+        self.rm = bytes(rakp1[8:24])
+        self.rolem = rakp1[24]
+        self.maxpriv = self.rolem & 0b111
+        self.username = bytes(rakp1[28 : 28 + rakp1[27]])
+        self.uuid = bmc_uuid.bytes
+        self.rc = os.urandom(16)
+        self.kuid = authdata[self.username.decode("utf-8")].encode("utf-8")
+
+        return _hmac_sha1(
+            self.kuid,
+            self.client_sid
+            + self.managed_sid
+            + self.rm
+            + self.rc
+            + self.uuid
+            + bytes((self.rolem, len(self.username)))
+            + self.username,
+        )
+
+    def finish_rakp(self, rakp3):
+        """Check RAKP message 3, return the integrity check value for RAKP 4."""
+        expected = _hmac_sha1(
+            self.kuid,
+            self.rc
+            + self.client_sid
+            + bytes((self.rolem, len(self.username)))
+            + self.username,
+        )
+        if not hmac.compare_digest(expected, bytes(rakp3[8:])):
+            return None
+
+        # Kg is not supported, Kuid is used in its place
+        sik = _hmac_sha1(
+            self.kuid,
+            self.rm + self.rc + bytes((self.rolem, len(self.username))) + self.username,
+        )
+        self.k1 = _hmac_sha1(sik, b"\x01" * 20)
+        self.aeskey = _hmac_sha1(sik, b"\x02" * 20)[:16]
+        self.established = True
+
+        return _hmac_sha1(sik, self.rm + self.managed_sid + self.uuid)[
+            :INTEGRITY_LENGTH
+        ]
+
+    def unwrap(self, packet):
+        """Return the IPMI message of an authenticated packet, or None."""
+        authcode = bytes(packet[-INTEGRITY_LENGTH:])
+        expected = _hmac_sha1(self.k1, packet[4:-INTEGRITY_LENGTH])[
+            :INTEGRITY_LENGTH
+        ]
+        if not hmac.compare_digest(expected, authcode):
+            return None
+
+        remseqnumber = struct.unpack("<I", bytes(packet[10:14]))[0]
+        if self.remseqnumber is not None and remseqnumber < self.remseqnumber:
+            return None
+        self.remseqnumber = remseqnumber
+
+        psize = packet[14] | (packet[15] << 8)
+        payload = packet[16 : 16 + psize]
+        if packet[5] & PAYLOAD_ENCRYPTED:
+            decryptor = Cipher(
+                algorithms.AES(self.aeskey), modes.CBC(bytes(payload[:16]))
+            ).decryptor()
+            payload = bytearray(
+                decryptor.update(bytes(payload[16:])) + decryptor.finalize()
+            )
+            del payload[-(payload[-1] + 1) :]
+
+        self.last_used = time.monotonic()
+        return payload
+
+    def wrap(self, payload):
+        """Return an encrypted and authenticated packet of an IPMI payload."""
+        iv = os.urandom(16)
+        encryptor = Cipher(algorithms.AES(self.aeskey), modes.CBC(iv)).encryptor()
+        body = iv + encryptor.update(bytes(payload + ipmisession._aespad(payload)))
+        body += encryptor.finalize()
+
+        packet = bytearray(RMCP_HEADER)
+        packet.append(6)
+        packet.append(PAYLOAD_IPMI | PAYLOAD_AUTHENTICATED | PAYLOAD_ENCRYPTED)
+        packet += self.client_sid
+        packet += struct.pack("<IH", self.sequencenumber, len(body))
+        packet += body
+        pad = (4 - (len(packet) - 2) % 4) % 4
+        packet += b"\xff" * pad
+        packet += bytes((pad, 7))
+        packet += _hmac_sha1(self.k1, packet[4:])[:INTEGRITY_LENGTH]
+
+        self.sequencenumber = (self.sequencenumber + 1) & 0xFFFFFFFF or 1
+        return packet
+
+
+class _Request(object):
+    """Stands in for the pyghmi session while a request is handled.
+
+    Handlers run on worker threads and answer through this object; the
+    response is built and sent on the event loop.
+    """
+
+    def __init__(self, protocol, session, message):
+        self._protocol = protocol
+        self.session = session
+        self.sockaddr = session.sockaddr
+        self.localsid = session.localsid
+        self.clientaddr = message[3]
+        self.clientnetfn = (message[1] >> 2) + 1
+        self.seqlun = message[4] >> 2
+        self.rqlun = message[4] & 0b11
+        self.clientcommand = message[5]
+
+    def send_ipmi_response(self, data=[], code=0):
+        self._send_ipmi_net_payload(data=data, code=code)
+
+    def _send_ipmi_net_payload(self, data=(), code=0, **kwargs):
+        response = _build_message(
+            self.clientaddr,
+            self.clientnetfn << 2,
+            BMC_ADDRESS,
+            (self.seqlun << 2) | self.rqlun,
+            self.clientcommand,
+            bytearray((code,)) + bytearray(data),
+        )
+        self._protocol.loop.call_soon_threadsafe(
+            self._protocol.send_session_payload, self.session, response
+        )
+
+
+class IpmiProtocol(asyncio.DatagramProtocol):
+    """RMCP and RMCP+ endpoint of one virtual BMC.
+
+    Sessionless requests and the session handshake are answered right
+    away on the event loop. IPMI requests are run by the `VirtualBMC`
+    handlers on the worker pool, so a slow VI Server call only delays the
+    request which made it.
+    """
+
+    def __init__(self, vbmc, executor):
+        self.vbmc = vbmc
+        self.executor = executor
+        self.loop = asyncio.get_running_loop()
+        self.transport = None
+        # Keyed on the managed session id
+        self.sessions = {}
+        self.tasks = set()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        try:
+            self._received(bytearray(data), addr)
+        except Exception as e:
+            LOG.debug(
+                "Dropping malformed packet from %(addr)s: %(error)s",
+                {"addr": addr, "error": e},
+            )
+
+    def _received(self, data, addr):
+        if len(data) < 4:
+            return
+
+        if data[0:4] == b"\x06\x00\xff\x06" and len(data) > 9 and data[8] == 0x80:
+            LOG.debug("Responding to asf presence ping")
+            self.transport.sendto(
+                b"\x06\x00\xff\x06\x00\x00\x11\xbe\x40"
+                + bytes((data[9],))
+                + b"\x00\x10\x00\x00\x11\xbe\x00\x00\x00\x00\x81\x00\x00\x00"
+                b"\x00\x00\x00\x00",
+                addr,
+            )
+            return
+
+        if len(data) < 16 or data[0:4] != RMCP_HEADER:
+            return
+
+        if data[4] != 6:
+            # IPMI 1.5, only sessionless requests are answered
+            if data[4] == 0:
+                self._sessionless(data[14 : 14 + data[13]], addr, v2=False)
+            return
+
+        ptype = data[5] & 0b00111111
+        payload = data[16 : 16 + (data[14] | (data[15] << 8))]
+        sid = struct.unpack("<I", bytes(data[6:10]))[0]
+
+        if ptype == PAYLOAD_IPMI and sid == 0:
+            self._sessionless(payload, addr, v2=True)
+        elif ptype == PAYLOAD_IPMI:
+            session = self.sessions.get(sid)
+            if session is None or not session.established:
+                return
+            if not data[5] & PAYLOAD_AUTHENTICATED:
+                return
+            message = session.unwrap(data)
+            if message is not None and len(message) >= 7:
+                self._request(session, message)
+        elif ptype == PAYLOAD_OPEN_SESSION_REQUEST:
+            self._open_session(payload, addr)
+        elif ptype == PAYLOAD_RAKP1:
+            self._rakp1(payload, addr)
+        elif ptype == PAYLOAD_RAKP3:
+            self._rakp3(payload, addr)
+
+    def _send_unauthenticated(self, ptype, payload, addr, v2=True):
+        if v2:
+            packet = bytearray(RMCP_HEADER) + bytes((6, ptype))
+            packet += struct.pack("<IIH", 0, 0, len(payload))
+        else:
+            # Authentication type none, session sequence and id 0
+            packet = bytearray(RMCP_HEADER) + bytes(9)
+            packet.append(len(payload))
+        self.transport.sendto(bytes(packet + payload), addr)
+
+    def _sessionless(self, message, addr, v2):
+        if len(message) < 7 or message[1] >> 2 != 6:
+            return
+
+        command = message[5]
+        if command == 0x38:  # get channel auth capabilities
+            verchannel = message[6]
+            if verchannel & 0b10000000 != 0b10000000:
+                return
+            if verchannel & 0b1111 != 0xE:
+                return
+            data = bytearray(self.vbmc.authcap)
+        elif command == 0x54:  # get channel cipher suites
+            # Cipher suite 3 only
+            data = bytearray(b"\x00\x01\xc0\x03\x01\x41\x81")
+        else:
+            return
+
+        response = _build_message(
+            message[3],
+            (7 << 2) | (message[4] & 0b11),
+            message[0],
+            (message[4] & 0b11111100) | (message[1] & 0b11),
+            command,
+            data,
+        )
+        self._send_unauthenticated(PAYLOAD_IPMI, response, addr, v2=v2)
+
+    def _expire_sessions(self):
+        now = time.monotonic()
+        for sid, session in list(self.sessions.items()):
+            if now - session.last_used > SESSION_IDLE_TIMEOUT:
+                del self.sessions[sid]
+
+    def _open_session(self, request, addr):
+        self._expire_sessions()
+
+        session = _Session(addr, request[4:8])
+        while session.localsid in self.sessions or session.localsid == 0:
+            session = _Session(addr, request[4:8])
+        self.sessions[session.localsid] = session
+
+        response = bytearray((request[0], 0, 4, 0)) + session.client_sid
+        response += session.managed_sid
+        response += bytearray(
+            (
+                *(0, 0, 0, 8, 1, 0, 0, 0),  # auth: HMAC-SHA1
+                *(1, 0, 0, 8, 1, 0, 0, 0),  # integrity: HMAC-SHA1-96
+                *(2, 0, 0, 8, 1, 0, 0, 0),  # confidentiality: AES-CBC-128
+            )
+        )
+        self._send_unauthenticated(PAYLOAD_OPEN_SESSION_RESPONSE, response, addr)
+
+    def _rakp1(self, rakp1, addr):
+        sid = struct.unpack("<I", bytes(rakp1[4:8]))[0]
+        session = self.sessions.get(sid)
+        if session is None or session.established or rakp1[27] == 0:
+            return
+
+        try:
+            authcode = session.start_rakp(rakp1, self.vbmc.authdata, self.vbmc.uuid)
+        except (KeyError, UnicodeDecodeError):
+            # Unknown user, let the client time out as pyghmi does
+            return
+
+        response = bytearray((rakp1[0], 0, 0, 0)) + session.client_sid
+        response += session.rc + session.uuid + authcode
+        self._send_unauthenticated(PAYLOAD_RAKP2, response, addr)
+
+    def _rakp3(self, rakp3, addr):
+        sid = struct.unpack("<I", bytes(rakp3[4:8]))[0]
+        session = self.sessions.get(sid)
+        if session is None or session.established or rakp3[1] != 0:
+            return
+        if not hasattr(session, "kuid"):
+            return
+
+        authcode = session.finish_rakp(rakp3)
+        if authcode is None:
+            return
+
+        response = bytearray((rakp3[0], 0, 0, 0)) + session.client_sid + authcode
+        self._send_unauthenticated(PAYLOAD_RAKP4, response, addr)
+
+    def send_session_payload(self, session, payload):
+        if self.transport is None:
+            return
+        self.transport.sendto(bytes(session.wrap(payload)), session.sockaddr)
+
+    def _request(self, session, message):
+        request = _Request(self, session, message)
+        netfn = message[1] >> 2
+        command = message[5]
+        data = message[6:-1]
+
+        if netfn == 6 and command == 0x3B:  # set session privilege level
+            code = 0
+            if data and data[0] > 1:
+                if data[0] > session.maxpriv:
+                    code = 0x81
+                else:
+                    session.clientpriv = data[0]
+            request.send_ipmi_response(code=code, data=[session.clientpriv])
+            return
+
+        if netfn == 6 and command == 0x3C:  # close session
+            request.send_ipmi_response()
+            self.loop.call_soon(self.sessions.pop, session.localsid, None)
+            return
+
+        task = self.loop.create_task(
+            self._handle({"netfn": netfn, "command": command, "data": data}, request)
+        )
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _handle(self, request, session):
+        try:
+            await self.loop.run_in_executor(
+                self.executor, self.vbmc.handle_raw_request, request, session
+            )
+        except Exception as e:
+            LOG.error(
+                "Error handling request for vm %(vm)s: %(error)s",
+                {"vm": self.vbmc.vm_name, "error": e},
+            )
+            session._send_ipmi_net_payload(code=0xFF)
+
+    def close(self):
+        for task in self.tasks:
+            task.cancel()
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+
+
+class AsyncEngine(object):
+    """Serves many virtual BMCs from one asyncio event loop.
+
+    Offers the same interface as `engine.Engine`, but does not use the
+    pyghmi event loop at all: RMCP+ is spoken by `IpmiProtocol`.
+    """
+
+    def __init__(self, workers):
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="vbmcd-aio-worker"
+        )
+        self._lock = threading.Lock()
+        self._hosted = {}
+        self.loop = None
+        self._thread = None
+
+    def start(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self.loop.run_forever, name="vbmcd-aio-engine", daemon=True
+        )
+        self._thread.start()
+
+    async def _serve(self, vbmc):
+        _, protocol = await self.loop.create_datagram_endpoint(
+            lambda: IpmiProtocol(vbmc, self._executor),
+            sock=engine.release_socket(vbmc),
+        )
+        return protocol
+
+    def add(self, bmc_config, notify=None):
+        vm_name = bmc_config["vm_name"]
+        try:
+            # Binds the socket the same way as the other engines do
+            vbmc = VirtualBMC(notify=notify, **bmc_config)
+            protocol = asyncio.run_coroutine_threadsafe(
+                self._serve(vbmc), self.loop
+            ).result()
+
+        except Exception as ex:
+            LOG.error(
+                "Error serving vBMC for vm %(vm)s: %(error)s",
+                {"vm": vm_name, "error": ex},
+            )
+            return engine.HostedBMC(self, vm_name, error=ex)
+
+        hosted = engine.HostedBMC(self, vm_name, vbmc)
+        with self._lock:
+            self._hosted[hosted] = protocol
+
+        return hosted
+
+    def is_serving(self, hosted):
+        with self._lock:
+            return hosted in self._hosted
+
+    def remove(self, hosted):
+        with self._lock:
+            protocol = self._hosted.pop(hosted, None)
+        if protocol is not None:
+            self.loop.call_soon_threadsafe(protocol.close)
+
+    def sentinels(self):
+        """Return the sentinels of worker processes, none here."""
+        return []
+
+    def stop(self):
+        with self._lock:
+            hosted = list(self._hosted)
+        for entry in hosted:
+            self.remove(entry)
+
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self._executor.shutdown(wait=False, cancel_futures=True)
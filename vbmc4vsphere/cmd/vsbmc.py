@@ -10,9 +10,11 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import csv
 import json
 import logging
 import sys
+import time
 
 import zmq
 from cliff.app import App
@@ -29,6 +31,9 @@ CONF = vbmc_config.get_config()
 
 LOG = log.get_logger()
 
+# Seconds between checks for the completion of a command
+POLL_INTERVAL = 0.1
+
 
 class ZmqClient(object):
     """Client part of the VirtualBMC system.
@@ -44,10 +49,16 @@ class ZmqClient(object):
     `rc` and `msg` attributes, used to indicate the outcome of the
     command, and optionally 2-D table conveyed through the `header`
     and `rows` attributes pointing to lists of cell values.
+
+    Commands other than `list` and `show` are sent asynchronously, and
+    their outcome is asked for by request ID until they are done, so
+    that a long one does not run into the response timeout.
     """
 
     SERVER_TIMEOUT = CONF["default"]["server_response_timeout"]
 
+    READ_ONLY_COMMANDS = ("list", "show")
+
     @staticmethod
     def to_dict(obj):
         return {
@@ -60,6 +71,49 @@ class ZmqClient(object):
 
         data_out.update(command=command)
 
+        if command not in self.READ_ONLY_COMMANDS:
+            data_out["async"] = True
+
+        data_in = self._request(data_out)
+        while data_in.get("pending"):
+            time.sleep(POLL_INTERVAL)
+            data_in = self._request(
+                {"command": "result", "request_id": data_in["request_id"]}
+            )
+
+        rc = data_in.pop("rc", None)
+        if rc:
+            msg = "(%(rc)s): %(msg)s" % {
+                "rc": rc,
+                "msg": "\n".join(data_in.get("msg", ())),
+            }
+            LOG.error(msg)
+            raise VirtualBMCError(msg)
+
+        return data_in
+
+    def subscribe(self, events=()):
+        """Yield the events published by vsbmcd, of the given names or all."""
+        event_port = CONF["default"]["event_port"]
+        if not event_port:
+            raise VirtualBMCError("Events are not published, event_port is 0")
+
+        context = zmq.Context()
+        socket = context.socket(zmq.SUB)
+        try:
+            socket.connect("tcp://127.0.0.1:%s" % event_port)
+            for event in events or [""]:
+                socket.setsockopt(zmq.SUBSCRIBE, event.encode("utf-8"))
+
+            while True:
+                event, message = socket.recv_multipart()
+                yield json.loads(message.decode("utf-8"))
+
+        finally:
+            socket.close(linger=0)
+            context.destroy()
+
+    def _request(self, data_out):
         data_out = json.dumps(data_out)
 
         server_port = CONF["default"]["server_port"]
@@ -80,7 +134,7 @@ class ZmqClient(object):
 
                 socks = dict(poller.poll(timeout=self.SERVER_TIMEOUT))
                 if socket in socks and socks[socket] == zmq.POLLIN:
-                    data_in = socket.recv()
+                    data_in, *chunks = socket.recv_multipart()
 
                 else:
                     raise zmq.ZMQError(zmq.RCVTIMEO, msg="Server response timed out")
@@ -100,31 +154,137 @@ class ZmqClient(object):
 
         try:
             data_in = json.loads(data_in.decode("utf-8"))
+            if data_in.pop("chunked", False):
+                data_in["rows"] = (
+                    row
+                    for chunk in chunks
+                    for row in json.loads(chunk.decode("utf-8"))
+                )
 
         except ValueError as ex:
             msg = "Server response parsing error %(error)s" % {"error": ex}
             LOG.error(msg)
             raise VirtualBMCError(msg)
 
-        rc = data_in.pop("rc", None)
-        if rc:
-            msg = "(%(rc)s): %(msg)s" % {
-                "rc": rc,
-                "msg": "\n".join(data_in.get("msg", ())),
-            }
-            LOG.error(msg)
-            raise VirtualBMCError(msg)
-
         return data_in
 
 
-class AddCommand(Command):
+def read_inventory(path):
+    """Read the VMs listed in a YAML or CSV file.
+
+    A YAML file holds a list of mappings, or a mapping with such a list
+    under `vms`; a CSV file has a header row. Keys are the long options of
+    `vsbmc add`, e.g. `vm_name` or `vm-uuid`.
+    """
+    try:
+        with open(path, newline="") as f:
+            if path.endswith((".yaml", ".yml")):
+                try:
+                    import yaml
+                except ImportError:
+                    raise VirtualBMCError("PyYAML is required to read %s" % path)
+
+                vms = yaml.safe_load(f)
+                if isinstance(vms, dict):
+                    vms = vms.get("vms")
+            else:
+                vms = list(csv.DictReader(f))
+
+    except (OSError, ValueError) as ex:
+        raise VirtualBMCError("Unable to read %s: %s" % (path, ex))
+
+    if not isinstance(vms, list) or not all(isinstance(vm, dict) for vm in vms):
+        raise VirtualBMCError("%s does not hold a list of VMs" % path)
+
+    inventory = []
+    for vm in vms:
+        vm = {
+            str(key).strip().replace("-", "_"): value
+            for key, value in vm.items()
+            if value not in (None, "")
+        }
+        if not vm.get("vm_name"):
+            raise VirtualBMCError("A VM in %s has no vm_name" % path)
+        inventory.append(vm)
+
+    return inventory
+
+
+class BulkCommand(Lister):
+    """Command which can be given its VMs in a file.
+
+    The outcome for each VM is then shown as a table, and the command
+    fails if any of them failed.
+    """
+
+    failed = False
+
+    def add_file_argument(self, parser, help):
+        parser.add_argument(
+            "--from-file",
+            dest="from_file",
+            default=None,
+            metavar="FILE",
+            help=help,
+        )
+
+    def communicate_bulk(self, command, args):
+        rsp = self.app.zmq.communicate(
+            command, args, no_daemon=self.app.options.no_daemon
+        )
+        self.failed = bool(rsp.get("failed"))
+        return rsp["header"], rsp["rows"]
+
+    def produce_output(self, parsed_args, column_names, data):
+        # Nothing to show for VMs given on the command line
+        if column_names:
+            return super(BulkCommand, self).produce_output(
+                parsed_args, column_names, data
+            )
+        return 0
+
+    def run(self, parsed_args):
+        rc = super(BulkCommand, self).run(parsed_args)
+        return 1 if self.failed else rc
+
+
+class AddCommand(BulkCommand):
     """Create a new BMC for a virtual machine instance"""
 
+    OPTIONS = (
+        "vm_name",
+        "vm_uuid",
+        "username",
+        "password",
+        "port",
+        "address",
+        "fakemac",
+        "viserver",
+        "viserver_username",
+        "viserver_password",
+    )
+
     def get_parser(self, prog_name):
         parser = super(AddCommand, self).get_parser(prog_name)
 
-        parser.add_argument("vm_name", help="The name of the virtual machine")
+        parser.add_argument(
+            "vm_name", nargs="?", help="The name of the virtual machine"
+        )
+        self.add_file_argument(
+            parser,
+            "A YAML or CSV file listing the virtual machines to add, with "
+            "the options below as keys; options given on the command line "
+            "apply to the virtual machines which do not set them",
+        )
+        parser.add_argument(
+            "--resolve-uuids",
+            dest="resolve_uuids",
+            action="store_true",
+            help=(
+                "With --from-file, look the UUIDs of the virtual machines "
+                "which have none up by name, with one query per VI Server"
+            ),
+        )
         parser.add_argument(
             "--vm-uuid",
             dest="vm_uuid",
@@ -151,8 +311,11 @@ class AddCommand(Command):
             "--port",
             dest="port",
             type=int,
-            default=6230,
-            help="Port to listen on; defaults to 6230",
+            default=None,
+            help=(
+                "Port to listen on; defaults to the next free port of the "
+                "port_range of vsbmcd"
+            ),
         )
         parser.add_argument(
             "--address",
@@ -198,6 +361,13 @@ class AddCommand(Command):
 
         log = logging.getLogger(__name__)
 
+        if args.from_file:
+            args.vms = [self._vm(args, vm) for vm in read_inventory(args.from_file)]
+            return self.communicate_bulk("add", args)
+
+        if not args.vm_name:
+            raise VirtualBMCError("Either a VM name or --from-file is required")
+
         # Check if the username and password were given for VI Server
         viuser = args.viserver_username
         vipass = args.viserver_password
@@ -211,6 +381,31 @@ class AddCommand(Command):
                 raise VirtualBMCError(msg)
 
         self.app.zmq.communicate("add", args, no_daemon=self.app.options.no_daemon)
+        return (), ()
+
+    def _vm(self, args, vm):
+        unknown = set(vm) - set(self.OPTIONS)
+        if unknown:
+            raise VirtualBMCError(
+                "Unknown option(s) %s for vm %s"
+                % (", ".join(sorted(unknown)), vm["vm_name"])
+            )
+
+        options = {
+            option: vm.get(option, getattr(args, option)) for option in self.OPTIONS
+        }
+        try:
+            if options["port"] is not None:
+                options["port"] = int(options["port"])
+        except ValueError:
+            raise VirtualBMCError(
+                "Invalid port %s for vm %s" % (options["port"], vm["vm_name"])
+            )
+
+        return {
+            option: None if value is None else str(value)
+            for option, value in options.items()
+        }
 
 
 class DeleteCommand(Command):
@@ -229,36 +424,64 @@ class DeleteCommand(Command):
         self.app.zmq.communicate("delete", args, self.app.options.no_daemon)
 
 
-class StartCommand(Command):
+class StartCommand(BulkCommand):
     """Start a virtual BMC for a virtual machine instance"""
 
     def get_parser(self, prog_name):
         parser = super(StartCommand, self).get_parser(prog_name)
 
         parser.add_argument(
-            "vm_names", nargs="+", help="A list of virtual machine names"
+            "vm_names", nargs="*", help="A list of virtual machine names"
+        )
+        self.add_file_argument(
+            parser,
+            "A YAML or CSV file listing the virtual machines to start, as "
+            "taken by `vsbmc add --from-file`",
         )
 
         return parser
 
     def take_action(self, args):
+        if args.from_file:
+            args.vm_names += [vm["vm_name"] for vm in read_inventory(args.from_file)]
+            args.report = True
+            return self.communicate_bulk("start", args)
+
+        if not args.vm_names:
+            raise VirtualBMCError("Either VM names or --from-file is required")
+
         self.app.zmq.communicate("start", args, no_daemon=self.app.options.no_daemon)
+        return (), ()
 
 
-class StopCommand(Command):
+class StopCommand(BulkCommand):
     """Stop a virtual BMC for a virtual machine instance"""
 
     def get_parser(self, prog_name):
         parser = super(StopCommand, self).get_parser(prog_name)
 
         parser.add_argument(
-            "vm_names", nargs="+", help="A list of virtual machine names"
+            "vm_names", nargs="*", help="A list of virtual machine names"
+        )
+        self.add_file_argument(
+            parser,
+            "A YAML or CSV file listing the virtual machines to stop, as "
+            "taken by `vsbmc add --from-file`",
         )
 
         return parser
 
     def take_action(self, args):
+        if args.from_file:
+            args.vm_names += [vm["vm_name"] for vm in read_inventory(args.from_file)]
+            args.report = True
+            return self.communicate_bulk("stop", args)
+
+        if not args.vm_names:
+            raise VirtualBMCError("Either VM names or --from-file is required")
+
         self.app.zmq.communicate("stop", args, no_daemon=self.app.options.no_daemon)
+        return (), ()
 
 
 class ListCommand(Lister):
@@ -271,13 +494,90 @@ class ListCommand(Lister):
             "--fakemac", action="store_true", help="Display Fake MAC column"
         )
 
+        parser.add_argument(
+            "--workers",
+            action="store_true",
+            help="List the worker processes of the sharded engine and "
+            "their load instead",
+        )
+
+        parser.add_argument(
+            "--name",
+            dest="name",
+            default=None,
+            help="Only list the virtual machines whose name matches this "
+            "shell-style pattern",
+        )
+
+        parser.add_argument(
+            "--status",
+            dest="status",
+            choices=("running", "down", "error"),
+            default=None,
+            help="Only list the virtual BMCs in this status",
+        )
+
+        parser.add_argument(
+            "--address",
+            dest="address",
+            default=None,
+            help="Only list the virtual BMCs bound to this address",
+        )
+
+        parser.add_argument(
+            "--viserver",
+            dest="viserver",
+            default=None,
+            help="Only list the virtual BMCs of this VI Server",
+        )
+
+        parser.add_argument(
+            "--sort",
+            dest="sort",
+            type=lambda value: value.split(","),
+            default=None,
+            help="Comma-separated fields to sort by, each descending when "
+            'prefixed with "-", out of vm_name, status, address, port, '
+            "viserver and fakemac; defaults to vm_name",
+        )
+
+        parser.add_argument(
+            "--limit",
+            dest="limit",
+            type=int,
+            default=None,
+            help="List at most this many virtual BMCs",
+        )
+
+        parser.add_argument(
+            "--offset",
+            dest="offset",
+            type=int,
+            default=0,
+            help="Skip this many virtual BMCs first; defaults to 0",
+        )
+
         return parser
 
     def take_action(self, args):
+        # Rows are sent in chunks, decoded as they are shown
+        args.chunked = not args.workers
         rsp = self.app.zmq.communicate(
             "list", args, no_daemon=self.app.options.no_daemon
         )
-        return rsp["header"], sorted(rsp["rows"])
+        if args.limit is not None or args.offset:
+            last = rsp["total"]
+            if args.limit is not None:
+                last = min(last, args.offset + args.limit)
+            self.app.stderr.write(
+                "%(count)d of %(total)d virtual BMC(s), from offset %(offset)d\n"
+                % {
+                    "count": max(0, last - args.offset),
+                    "total": rsp["total"],
+                    "offset": args.offset,
+                }
+            )
+        return rsp["header"], rsp["rows"]
 
 
 class ShowCommand(Lister):
@@ -297,6 +597,45 @@ class ShowCommand(Lister):
         return rsp["header"], sorted(rsp["rows"])
 
 
+class EventsCommand(Command):
+    """Print the changes of virtual BMCs as they happen"""
+
+    EVENTS = ("added", "deleted", "started", "restarted", "stopped", "exited", "power")
+
+    def get_parser(self, prog_name):
+        parser = super(EventsCommand, self).get_parser(prog_name)
+
+        parser.add_argument(
+            "vm_names",
+            nargs="*",
+            help="Only print the events of these virtual machines",
+        )
+
+        parser.add_argument(
+            "--event",
+            dest="events",
+            action="append",
+            choices=self.EVENTS,
+            default=[],
+            help="Only print events of this kind; may be repeated",
+        )
+
+        return parser
+
+    def take_action(self, args):
+        vm_names = set(args.vm_names)
+        try:
+            for event in self.app.zmq.subscribe(args.events):
+                if vm_names and event["vm_name"] not in vm_names:
+                    continue
+                # One JSON document per line
+                self.app.stdout.write(json.dumps(event, sort_keys=True) + "\n")
+                self.app.stdout.flush()
+
+        except KeyboardInterrupt:
+            pass
+
+
 class VirtualBMCApp(App):
     def __init__(self):
         super(VirtualBMCApp, self).__init__(
@@ -36,13 +36,61 @@ class VirtualBMCConfig(object):
             "config_dir": os.path.join(os.path.expanduser("~"), ".vsbmc"),
             "pid_file": os.path.join(os.path.expanduser("~"), ".vsbmc", "master.pid"),
             "server_port": 50891,
+            # Port vsbmcd publishes the changes of vBMCs on, 0 not to
+            # publish them
+            "event_port": 50892,
+            # Port vsbmcd serves metrics on in the Prometheus format, 0 not
+            # to serve them
+            "metrics_port": 50893,
             "server_response_timeout": 5000,  # milliseconds
             "server_spawn_wait": 3000,  # milliseconds
+            # Threads running the commands other than "list" and "show"
+            "server_workers": 4,
+            # "process" runs every vBMC in a process of its own, "single"
+            # serves all of them from the vsbmcd process with the pyghmi
+            # event loop, "asyncio" with an asyncio event loop, "sharded"
+            # spreads them over `engine_processes` processes
+            "engine": "process",
+            # Threads handling IPMI requests in the "single", "asyncio" and
+            # "sharded" engines, per process
+            "engine_workers": 16,
+            # Processes of the "sharded" engine, 0 for one per CPU
+            "engine_processes": 0,
+            # VMs whose config file is checked for changes made outside of
+            # vsbmc every 3 seconds
+            "config_check_batch": 64,
+            # "directory" keeps a config file per VM under config_dir,
+            # "sqlite" all of them in the `config_db` database, by default
+            # config_dir/vbmc4vsphere.db, imported from config_dir once
+            "config_store": "directory",
+            "config_db": None,
+            # Ports given to the vBMCs added without one, "first-last"
+            "port_range": "6230-6999",
+        },
+        "log": {
+            "logfile": None,
+            "debug": "false",
+            # IPMI requests logged per second and vBMC, 0 to log none
+            "access_log_rate": 10,
         },
-        "log": {"logfile": None, "debug": "true"},
         "ipmi": {
             # Maximum time (in seconds) to wait for the data to come across
-            "session_timeout": 1
+            "session_timeout": 1,
+            # Seconds during which a retransmitted request is answered with
+            # the response to the original, 0 to handle every copy
+            "replay_window": 5,
+        },
+        "vsphere": {
+            # Seconds a pooled VI Server session may stay idle before its
+            # validity is checked again
+            "session_check_interval": 60,
+            # Minimum seconds between checks for inventory changes when
+            # looking virtual machines up by name or UUID
+            "inventory_refresh_interval": 2,
+            # Maximum age (in seconds) of a power state or boot order
+            # answered from the subscription to vCenter, 0 to always ask
+            # vCenter directly
+            "vm_state_max_staleness": 10,
         },
     }
 
@@ -67,6 +115,10 @@ class VirtualBMCConfig(object):
             self._conf_dict["log"]["debug"]
         )
 
+        self._conf_dict["log"]["access_log_rate"] = int(
+            self._conf_dict["log"]["access_log_rate"]
+        )
+
         self._conf_dict["default"]["show_passwords"] = utils.str2bool(
             self._conf_dict["default"]["show_passwords"]
         )
@@ -83,10 +135,68 @@ class VirtualBMCConfig(object):
             self._conf_dict["default"]["server_response_timeout"]
         )
 
+        self._conf_dict["default"]["event_port"] = int(
+            self._conf_dict["default"]["event_port"]
+        )
+
+        self._conf_dict["default"]["metrics_port"] = int(
+            self._conf_dict["default"]["metrics_port"]
+        )
+
+        self._conf_dict["default"]["server_workers"] = int(
+            self._conf_dict["default"]["server_workers"]
+        )
+
+        self._conf_dict["default"]["engine_workers"] = int(
+            self._conf_dict["default"]["engine_workers"]
+        )
+
+        self._conf_dict["default"]["engine_processes"] = int(
+            self._conf_dict["default"]["engine_processes"]
+        ) or (os.cpu_count() or 1)
+
+        self._conf_dict["default"]["config_check_batch"] = int(
+            self._conf_dict["default"]["config_check_batch"]
+        )
+
+        port_range = self._conf_dict["default"]["port_range"]
+        if port_range:
+            first, _, last = str(port_range).partition("-")
+            self._conf_dict["default"]["port_range"] = (
+                int(first),
+                int(last or first),
+            )
+        else:
+            self._conf_dict["default"]["port_range"] = None
+
+        # VMs to add vBMCs for, by the name of their [discovery:<name>]
+        # section
+        self._conf_dict["discoveries"] = {}
+        for section, options in self._conf_dict.items():
+            if section.startswith("discovery:"):
+                options["start"] = utils.str2bool(options.get("start", "true"))
+                self._conf_dict["discoveries"][section.partition(":")[2]] = options
+
         self._conf_dict["ipmi"]["session_timeout"] = int(
             self._conf_dict["ipmi"]["session_timeout"]
         )
 
+        self._conf_dict["ipmi"]["replay_window"] = float(
+            self._conf_dict["ipmi"]["replay_window"]
+        )
+
+        self._conf_dict["vsphere"]["session_check_interval"] = int(
+            self._conf_dict["vsphere"]["session_check_interval"]
+        )
+
+        self._conf_dict["vsphere"]["inventory_refresh_interval"] = float(
+            self._conf_dict["vsphere"]["inventory_refresh_interval"]
+        )
+
+        self._conf_dict["vsphere"]["vm_state_max_staleness"] = float(
+            self._conf_dict["vsphere"]["vm_state_max_staleness"]
+        )
+
     def __getitem__(self, key):
         return self._conf_dict[key]
 
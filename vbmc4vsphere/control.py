@@ -13,14 +13,21 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
+import concurrent.futures
+import functools
 import json
+import os
+import queue
 import signal
 import sys
+import time
+import uuid
 
 import zmq
 
 from vbmc4vsphere import config as vbmc_config
-from vbmc4vsphere import exception, log
+from vbmc4vsphere import exception, log, metrics
 from vbmc4vsphere.manager import VirtualBMCManager
 
 CONF = vbmc_config.get_config()
@@ -29,6 +36,83 @@ LOG = log.get_logger()
 
 TIMER_PERIOD = 3000  # milliseconds
 
+# Milliseconds between attempts to get hold of the manager while a command
+# runs
+BUSY_RETRY_PERIOD = 100
+
+# Commands answered by the control loop itself, from the state in memory
+READ_ONLY_COMMANDS = frozenset(["list", "show"])
+
+# Responses to asynchronous requests kept until fetched, at most
+RESULTS_KEPT = 1000
+
+# Table rows per message part of a chunked response
+ROWS_PER_CHUNK = 500
+
+
+def _handle(handle_command, vbmc_manager, data_in):
+    """Run a command, turning its errors into a response."""
+    LOG.debug("Command request data: %(request)s", {"request": data_in})
+
+    try:
+        data_out = handle_command(vbmc_manager, data_in)
+
+    except exception.VirtualBMCError as ex:
+        msg = "Command failed: %(error)s" % {"error": ex}
+        LOG.error(msg)
+        data_out = {"rc": 1, "msg": [msg]}
+
+    except Exception as ex:
+        msg = "Command failed: %(error)s" % {"error": ex}
+        LOG.exception(msg)
+        data_out = {"rc": 1, "msg": [msg]}
+
+    LOG.debug("Command response data: %(response)s", {"response": data_out})
+    return data_out
+
+
+def _send(socket, envelope, data_out):
+    """Send a response, its rows in parts of their own if it is chunked.
+
+    The rows of a chunked response follow the first part in lists of up
+    to ROWS_PER_CHUNK rows, so that they are never serialized all at once.
+    """
+    rows = data_out.pop("rows") if data_out.get("chunked") else None
+
+    try:
+        message = json.dumps(data_out)
+
+    except ValueError as ex:
+        LOG.warning(
+            "Control server response serialization error: " "%(error)s",
+            {"error": ex},
+        )
+        message = json.dumps({"rc": 1, "msg": ["Unable to serialize response"]})
+        rows = None
+
+    if rows is None:
+        socket.send_multipart(envelope + [message.encode("utf-8")])
+        return
+
+    socket.send_multipart(envelope + [message.encode("utf-8")], zmq.SNDMORE)
+    chunk = []
+    try:
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) == ROWS_PER_CHUNK:
+                socket.send(json.dumps(chunk).encode("utf-8"), zmq.SNDMORE)
+                chunk = []
+
+    except Exception as ex:
+        LOG.error(
+            "Control server response serialization error: " "%(error)s",
+            {"error": ex},
+        )
+
+    finally:
+        # The message is complete with its last part
+        socket.send(json.dumps(chunk).encode("utf-8"))
+
 
 def main_loop(vbmc_manager, handle_command):
     """Server part of the CLI control interface
@@ -44,28 +128,163 @@ def main_loop(vbmc_manager, handle_command):
     contains at least the `rc` and `msg` attributes, used to indicate the
     outcome of the command, and optionally 2-D table conveyed through the
     `header` and `rows` attributes pointing to lists of cell values.
+
+    The changes returned by `vbmc_manager.events()` are published on a
+    PUB socket bound to `event_port`, each as a message made of the event
+    name, to subscribe by, and the JSON-encoded event. The manager wakes
+    the loop up through `vbmc_manager.wakeup` for them to go out at once,
+    whichever thread they come from.
+
+    The metrics returned by `vbmc_manager.metrics()` are served over HTTP
+    on `metrics_port`, in the Prometheus text format, unless the port
+    cannot be bound.
+
+    `list` and `show` are answered right away from the state in memory.
+    Other commands run on a pool of `server_workers` threads, one at a
+    time as far as the manager is concerned. Their response is sent when
+    they are done, or, if the request has `async` set, a `request_id` is
+    sent at once and the response is fetched with a `result` command.
     """
     server_port = CONF["default"]["server_port"]
 
-    context = socket = None
-
+    context = socket = publisher = metrics_server = None
+    executor = concurrent.futures.ThreadPoolExecutor(
+        CONF["default"]["server_workers"], thread_name_prefix="vbmcd-control"
+    )
+    # Commands done by the pool, and a pipe waking the loop up for them
+    # and for the events of the manager
+    done = queue.SimpleQueue()
+    wakeup_r, wakeup_w = os.pipe()
+    os.set_blocking(wakeup_r, False)
+    os.set_blocking(wakeup_w, False)
+    # Envelopes of the clients waiting for a command by request ID, None
+    # for asynchronous requests, and the responses nobody fetched yet
+    pending = {}
+    results = collections.OrderedDict()
+
+    def wakeup():
+        try:
+            os.write(wakeup_w, b"x")
+        except BlockingIOError:
+            # Full, the loop has yet to wake up anyway
+            pass
+
+    def finished(request_id, future):
+        done.put((request_id, future.result()))
+        wakeup()
+
+    vbmc_manager.wakeup = wakeup
     try:
         context = zmq.Context()
-        socket = context.socket(zmq.REP)
+        socket = context.socket(zmq.ROUTER)
         socket.setsockopt(zmq.LINGER, 5)
         socket.bind("tcp://127.0.0.1:%s" % server_port)
 
+        event_port = CONF["default"]["event_port"]
+        if event_port:
+            publisher = context.socket(zmq.PUB)
+            publisher.setsockopt(zmq.LINGER, 0)
+            publisher.bind("tcp://127.0.0.1:%s" % event_port)
+
+        metrics_port = CONF["default"]["metrics_port"]
+        if metrics_port:
+            try:
+                metrics_server = metrics.serve(metrics_port, vbmc_manager.metrics)
+            except OSError as e:
+                # Metrics are not worth failing to serve the vBMCs for
+                LOG.error(
+                    "Unable to serve metrics on port %(port)s, going on "
+                    "without them. Error: %(error)s",
+                    {"port": metrics_port, "error": e},
+                )
+
         poller = zmq.Poller()
         poller.register(socket, zmq.POLLIN)
+        poller.register(wakeup_r, zmq.POLLIN)
+        # Process sentinels and status pipes of the vBMC instances
+        watched = frozenset()
 
         LOG.info("Started vBMC server on port %s", server_port)
 
+        next_periodic = time.monotonic() + TIMER_PERIOD / 1000
         while True:
-            socks = dict(poller.poll(timeout=TIMER_PERIOD))
+            # While a command holds the manager, only answer the socket
+            if vbmc_manager.lock.acquire(blocking=False):
+                try:
+                    fds = vbmc_manager.fds()
+                    next_restart = vbmc_manager.next_restart()
+                finally:
+                    vbmc_manager.lock.release()
+                wake_up = next_periodic
+                if next_restart is not None:
+                    wake_up = min(wake_up, next_restart)
+            else:
+                fds = frozenset()
+                next_restart = None
+                wake_up = time.monotonic() + BUSY_RETRY_PERIOD / 1000
+
+            if fds is not watched:
+                for fd in watched - fds:
+                    poller.unregister(fd)
+                for fd in fds - watched:
+                    poller.register(fd, zmq.POLLIN)
+                watched = fds
+
+            timeout = max(0, int((wake_up - time.monotonic()) * 1000))
+
+            socks = dict(poller.poll(timeout=timeout))
+
+            ready = [fd for fd in socks if fd in watched]
+            if ready or (next_restart is not None and next_restart <= time.monotonic()):
+                if vbmc_manager.lock.acquire(blocking=False):
+                    try:
+                        vbmc_manager.handle_events(ready)
+                    finally:
+                        vbmc_manager.lock.release()
+
+            if time.monotonic() >= next_periodic:
+                if vbmc_manager.lock.acquire(blocking=False):
+                    try:
+                        vbmc_manager.periodic()
+                    finally:
+                        vbmc_manager.lock.release()
+                    next_periodic = time.monotonic() + TIMER_PERIOD / 1000
+
+            if wakeup_r in socks:
+                try:
+                    while os.read(wakeup_r, 4096):
+                        pass
+                except BlockingIOError:
+                    pass
+
+                while True:
+                    try:
+                        request_id, data_out = done.get_nowait()
+                    except queue.Empty:
+                        break
+
+                    envelope = pending.pop(request_id, None)
+                    if envelope is not None:
+                        _send(socket, envelope, data_out)
+                        continue
+
+                    results[request_id] = data_out
+                    while len(results) > RESULTS_KEPT:
+                        results.popitem(last=False)
+
+            # Dropped unless someone subscribed
+            for event in vbmc_manager.events():
+                if publisher is not None:
+                    publisher.send_multipart(
+                        [
+                            event["event"].encode("utf-8"),
+                            json.dumps(event).encode("utf-8"),
+                        ]
+                    )
+
             if socket in socks and socks[socket] == zmq.POLLIN:
-                message = socket.recv()
+                *envelope, message = socket.recv_multipart()
             else:
-                vbmc_manager.periodic()
                 continue
 
             try:
@@ -76,37 +295,76 @@ def main_loop(vbmc_manager, handle_command):
                     "Control server request deserialization error: " "%(error)s",
                     {"error": ex},
                 )
+                _send(socket, envelope, {"rc": 1, "msg": ["Invalid request"]})
                 continue
 
-            LOG.debug("Command request data: %(request)s", {"request": data_in})
-
-            try:
-                data_out = handle_command(vbmc_manager, data_in)
-
-            except exception.VirtualBMCError as ex:
-                msg = "Command failed: %(error)s" % {"error": ex}
-                LOG.error(msg)
-                data_out = {"rc": 1, "msg": [msg]}
-
-            LOG.debug("Command response data: %(response)s", {"response": data_out})
+            command = data_in.get("command")
+            if command == "result":
+                request_id = data_in.get("request_id")
+                if request_id in results:
+                    data_out = results.pop(request_id)
+                elif request_id in pending:
+                    data_out = {"rc": 0, "request_id": request_id, "pending": True}
+                else:
+                    data_out = {"rc": 1, "msg": ["Unknown request %s" % request_id]}
+                _send(socket, envelope, data_out)
+                continue
 
-            try:
-                message = json.dumps(data_out)
+            if command in READ_ONLY_COMMANDS:
+                _send(socket, envelope, _handle(handle_command, vbmc_manager, data_in))
+                continue
 
-            except ValueError as ex:
-                LOG.warning(
-                    "Control server response serialization error: " "%(error)s",
-                    {"error": ex},
+            request_id = uuid.uuid4().hex
+            if data_in.pop("async", False):
+                pending[request_id] = None
+                _send(
+                    socket,
+                    envelope,
+                    {"rc": 0, "request_id": request_id, "pending": True},
                 )
-                continue
+            else:
+                pending[request_id] = envelope
 
-            socket.send(message.encode("utf-8"))
+            future = executor.submit(_handle, handle_command, vbmc_manager, data_in)
+            future.add_done_callback(functools.partial(finished, request_id))
 
     finally:
+        vbmc_manager.wakeup = None
+        executor.shutdown(wait=False)
+        if metrics_server:
+            metrics_server.shutdown()
+            metrics_server.server_close()
+        if publisher:
+            publisher.close()
         if socket:
             socket.close()
         if context:
             context.destroy()
+        os.close(wakeup_r)
+        os.close(wakeup_w)
+
+
+def _check_viserver_auth(data_in):
+    # Check if the username and password were given for VI Server
+    vi_user = data_in["viserver_username"]
+    vi_pass = data_in["viserver_password"]
+    if any((vi_user, vi_pass)):
+        if not all((vi_user, vi_pass)):
+            return (
+                "A password and username are required to use "
+                "VI Server authentication"
+            )
+
+
+def _report(vm_names, data_out, done):
+    """Outcome table of a command run for many VMs."""
+    results = list(zip(vm_names, data_out))
+    return {
+        "rc": 0,
+        "header": ("VM name", "Result"),
+        "rows": [[vm_name, msg if rc else done] for vm_name, (rc, msg) in results],
+        "failed": [vm_name for vm_name, (rc, msg) in results if rc],
+    }
 
 
 def command_dispatcher(vbmc_manager, data_in):
@@ -119,48 +377,95 @@ def command_dispatcher(vbmc_manager, data_in):
 
     LOG.debug('Running "%(cmd)s" command handler', {"cmd": command})
 
-    if command == "add":
+    if command == "add" and data_in.get("vms") is not None:
+        vms = [vm for vm in data_in["vms"] if not _check_viserver_auth(vm)]
+        added = iter(
+            vbmc_manager.add_many(vms, resolve_uuids=data_in.get("resolve_uuids"))
+        )
+        data_out = []
+        for vm in data_in["vms"]:
+            error = _check_viserver_auth(vm)
+            data_out.append((1, error) if error else next(added))
 
-        # Check if the username and password were given for VI Server
-        vi_user = data_in["viserver_username"]
-        vi_pass = data_in["viserver_password"]
-        if any((vi_user, vi_pass)):
-            if not all((vi_user, vi_pass)):
-                error = (
-                    "A password and username are required to use "
-                    "VI Server authentication"
-                )
-                return {"msg": [error], "rc": 1}
+        return _report([vm["vm_name"] for vm in data_in["vms"]], data_out, "added")
 
-        rc, msg = vbmc_manager.add(**data_in)
+    elif command == "add":
+        error = _check_viserver_auth(data_in)
+        if error:
+            return {"msg": [error], "rc": 1}
+
+        with vbmc_manager.batch():
+            rc, msg = vbmc_manager.add(**data_in)
 
         return {"rc": rc, "msg": [msg] if msg else []}
 
     elif command == "delete":
-        data_out = [
-            vbmc_manager.delete(vm_name) for vm_name in set(data_in["vm_names"])
-        ]
+        with vbmc_manager.batch():
+            data_out = [
+                vbmc_manager.delete(vm_name) for vm_name in set(data_in["vm_names"])
+            ]
         return {
             "rc": max(rc for rc, msg in data_out),
             "msg": [msg for rc, msg in data_out if msg],
         }
 
     elif command == "start":
-        data_out = [vbmc_manager.start(vm_name) for vm_name in set(data_in["vm_names"])]
+        # In the given order, once each
+        vm_names = list(dict.fromkeys(data_in["vm_names"]))
+        with vbmc_manager.batch():
+            data_out = [vbmc_manager.start(vm_name) for vm_name in vm_names]
+        if data_in.get("report"):
+            return _report(vm_names, data_out, "started")
+
         return {
             "rc": max(rc for rc, msg in data_out),
             "msg": [msg for rc, msg in data_out if msg],
         }
 
     elif command == "stop":
-        data_out = [vbmc_manager.stop(vm_name) for vm_name in set(data_in["vm_names"])]
+        # In the given order, once each
+        vm_names = list(dict.fromkeys(data_in["vm_names"]))
+        with vbmc_manager.batch():
+            data_out = [vbmc_manager.stop(vm_name) for vm_name in vm_names]
+        if data_in.get("report"):
+            return _report(vm_names, data_out, "stopped")
+
         return {
             "rc": max(rc for rc, msg in data_out),
             "msg": [msg for rc, msg in data_out if msg],
         }
 
+    elif command == "list" and data_in.get("workers"):
+        rc, workers = vbmc_manager.list_workers()
+        if rc:
+            return {"rc": rc, "msg": [workers]}
+
+        header = ("Worker", "PID", "Status", "BMCs", "Restarts")
+        return {
+            "rc": rc,
+            "header": header,
+            "rows": [
+                [
+                    worker["worker"],
+                    worker["pid"],
+                    "running" if worker["alive"] else "down",
+                    worker["bmcs"],
+                    worker["restarts"],
+                ]
+                for worker in workers
+            ],
+        }
+
     elif command == "list":
-        rc, tables = vbmc_manager.list()
+        rc, total, tables = vbmc_manager.list(
+            name=data_in.get("name"),
+            status=data_in.get("status"),
+            address=data_in.get("address"),
+            viserver=data_in.get("viserver"),
+            sort=data_in.get("sort"),
+            offset=data_in.get("offset") or 0,
+            limit=data_in.get("limit"),
+        )
 
         if data_in["fakemac"]:
             header = ("VM name", "Status", "Address", "Port", "Fake MAC")
@@ -169,11 +474,17 @@ def command_dispatcher(vbmc_manager, data_in):
             header = ("VM name", "Status", "Address", "Port")
             keys = ("vm_name", "status", "address", "port")
 
-        return {
-            "rc": rc,
-            "header": header,
-            "rows": [[table.get(key, "?") for key in keys] for table in tables],
-        }
+        rows = ([table.get(key, "?") for key in keys] for table in tables)
+        if data_in.get("chunked"):
+            return {
+                "rc": rc,
+                "header": header,
+                "total": total,
+                "chunked": True,
+                "rows": rows,
+            }
+
+        return {"rc": rc, "header": header, "total": total, "rows": list(rows)}
 
     elif command == "show":
         rc, table = vbmc_manager.show(data_in["vm_name"])
@@ -196,12 +507,16 @@ def application():
 
     Initializes, serves and cleans up everything.
     """
+    # The vBMC processes send their log records to vsbmcd
+    LOG.collect()
+
     vbmc_manager = VirtualBMCManager()
 
     vbmc_manager.periodic()
 
     def kill_children(*args):
-        vbmc_manager.periodic(shutdown=True)
+        with vbmc_manager.lock:
+            vbmc_manager.periodic(shutdown=True)
         sys.exit(0)
 
     # SIGTERM does not seem to propagate to multiprocessing
@@ -0,0 +1,292 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import queue
+import threading
+
+from pyVmomi import vmodl
+
+from vbmc4vsphere import config as vbmc_config
+from vbmc4vsphere import exception, inventory, log, pool
+
+__all__ = ["Discovery", "get_discoveries"]
+
+LOG = log.get_logger()
+
+CONF = vbmc_config.get_config()
+
+# Seconds a WaitForUpdatesEx call may block without changes
+WAIT_SECONDS = 60
+
+# Seconds between attempts to watch again after an error, doubling up to
+# the maximum
+RETRY_DELAY = 1
+RETRY_DELAY_MAX = 60
+
+SCOPES = ("folder", "resource_pool", "custom_attribute")
+
+
+class Discovery(object):
+    """VMs of a folder, resource pool or custom attribute, as they change.
+
+    A thread keeps a `WaitForUpdatesEx` call outstanding on a collector
+    over a container view of the scope, through a VI Server session of its
+    own. The VMs found by the first retrieval are reported once as a
+    ("sync", {name: uuid}) change, and the ones entering or leaving the
+    scope afterwards as ("enter", name, uuid) and ("leave", name, None).
+    `fileno()` becomes readable when `changes()` has something to return.
+    """
+
+    def __init__(self, name, options):
+        self.name = name
+        self.options = options
+        scopes = [scope for scope in SCOPES if options.get(scope)]
+        if len(scopes) != 1 or not options.get("viserver"):
+            raise exception.VirtualBMCError(
+                "Discovery %s needs a viserver and one of %s"
+                % (name, ", ".join(SCOPES))
+            )
+        self.scope = scopes[0]
+
+        self._changes = queue.SimpleQueue()
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_r, False)
+        self._stopped = threading.Event()
+        self._collector = None
+        # Whether the last watch got as far as its first retrieval
+        self._synced = False
+        self._thread = threading.Thread(
+            target=self._run, name="vbmcd-discovery-%s" % name, daemon=True
+        )
+
+    def fileno(self):
+        return self._wakeup_r
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        collector = self._collector
+        if collector is not None:
+            try:
+                collector.CancelWaitForUpdates()
+            except Exception:
+                pass
+        self._thread.join(timeout=5)
+
+    def changes(self):
+        """Return the changes reported since the last call."""
+        try:
+            while os.read(self._wakeup_r, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+        changes = []
+        while True:
+            try:
+                changes.append(self._changes.get_nowait())
+            except queue.Empty:
+                return changes
+
+    def _post(self, change):
+        self._changes.put(change)
+        os.write(self._wakeup_w, b"x")
+
+    def _run(self):
+        delay = RETRY_DELAY
+        while not self._stopped.is_set():
+            session = pool.ViServerSession(
+                self.options["viserver"],
+                self.options.get("viserver_username"),
+                self.options.get("viserver_password"),
+            )
+            try:
+                session.connect()
+                self._watch(session)
+
+            except Exception as ex:
+                if self._stopped.is_set():
+                    break
+                if self._synced:
+                    delay = RETRY_DELAY
+                LOG.warning(
+                    "Discovery %(name)s failed, retrying in %(delay)d "
+                    "second(s). Error: %(error)s",
+                    {"name": self.name, "delay": delay, "error": ex},
+                )
+
+            finally:
+                self._synced = False
+                session.disconnect()
+
+            self._stopped.wait(delay)
+            delay = min(delay * 2, RETRY_DELAY_MAX)
+
+    def _container(self, session):
+        content = session.content
+        if self.scope == "custom_attribute":
+            return content.rootFolder
+
+        container = content.searchIndex.FindByInventoryPath(self.options[self.scope])
+        if container is None:
+            raise exception.VirtualBMCError(
+                "No %s %s was found" % (self.scope, self.options[self.scope])
+            )
+        return container
+
+    def _matcher(self, session):
+        """Return a function telling whether the VM is in the scope."""
+        if self.scope != "custom_attribute":
+            return lambda vm: not vm.get("config.template")
+
+        name, _, value = self.options["custom_attribute"].partition("=")
+        content = session.content
+        keys = {
+            field.key
+            for field in content.customFieldsManager.field or ()
+            if field.name == name
+        }
+        if not keys:
+            raise exception.VirtualBMCError("No custom attribute %s was found" % name)
+
+        def matches(vm):
+            return not vm.get("config.template") and any(
+                custom.key in keys and (not value or custom.value == value)
+                for custom in vm.get("customValue") or ()
+            )
+
+        return matches
+
+    def _watch(self, session):
+        paths = ["name", "config.uuid", "config.template"]
+        if self.scope == "custom_attribute":
+            paths.append("customValue")
+
+        matches = self._matcher(session)
+        view, self._collector = inventory.create_vm_collector(
+            session, self._container(session), paths
+        )
+        # Properties of the VMs in the view, the name and UUID of the ones
+        # in the scope, and which of those have each name, in order
+        vms = {}
+        members = {}
+        names = {}
+        version = ""
+        synced = False
+        options = vmodl.query.PropertyCollector.WaitOptions(
+            maxWaitSeconds=WAIT_SECONDS
+        )
+
+        try:
+            while not self._stopped.is_set():
+                update = self._collector.WaitForUpdatesEx(version, options)
+                if update is None:
+                    continue
+
+                changes = []
+                for filter_update in update.filterSet or ():
+                    for obj_update in filter_update.objectSet or ():
+                        moid = obj_update.obj._moId
+                        if obj_update.kind == "leave":
+                            vms.pop(moid, None)
+                            vm = None
+                        else:
+                            vm = vms.setdefault(moid, {})
+                            for change in obj_update.changeSet or ():
+                                vm[change.name] = (
+                                    None if change.op == "remove" else change.val
+                                )
+
+                        member = None
+                        if vm and vm.get("name") and matches(vm):
+                            member = (vm["name"], vm.get("config.uuid"))
+                        changes.extend(self._update(members, names, moid, member))
+
+                version = update.version
+                if synced:
+                    for change in changes:
+                        self._post(change)
+                elif not update.truncated:
+                    synced = self._synced = True
+                    self._post(
+                        (
+                            "sync",
+                            {
+                                name: members[moids[0]][1]
+                                for name, moids in names.items()
+                            },
+                        )
+                    )
+                    LOG.info(
+                        "Discovery %(name)s found %(count)d VM(s) in %(scope)s "
+                        "%(value)s",
+                        {
+                            "name": self.name,
+                            "count": len(members),
+                            "scope": self.scope,
+                            "value": self.options[self.scope],
+                        },
+                    )
+
+        finally:
+            collector, self._collector = self._collector, None
+            for obj in (collector, view):
+                try:
+                    obj.Destroy()
+                except Exception:
+                    pass
+
+    def _update(self, members, names, moid, member):
+        """Record the (name, uuid) of a VM in the scope, or None if not.
+
+        Returns the changes to report. A name shared by several VMs is
+        reported with the UUID of the first of them to have it. When that
+        one goes, the name leaves and enters again with the UUID of the
+        next, and only leaves once no VM of the scope has it anymore.
+        """
+        previous = members.get(moid)
+        if member == previous:
+            return []
+
+        changes = []
+        if previous is not None:
+            del members[moid]
+            moids = names[previous[0]]
+            first = moids[0] == moid
+            moids.remove(moid)
+            if not moids:
+                del names[previous[0]]
+                changes.append(("leave", previous[0], None))
+            elif first and members[moids[0]][1] != previous[1]:
+                changes.append(("leave", previous[0], None))
+                changes.append(("enter", previous[0], members[moids[0]][1]))
+
+        if member is not None:
+            members[moid] = member
+            moids = names.setdefault(member[0], [])
+            moids.append(moid)
+            if len(moids) == 1:
+                changes.append(("enter", member[0], member[1]))
+
+        # A VM which only changed its UUID leaves and enters again
+        return changes
+
+
+def get_discoveries():
+    """Return the discoveries of the [discovery:<name>] config sections."""
+    return {
+        name: Discovery(name, options)
+        for name, options in CONF["discoveries"].items()
+    }
@@ -0,0 +1,240 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import concurrent.futures
+import functools
+import threading
+import time
+
+import pyghmi.ipmi.private.session as ipmisession
+from pyghmi.ipmi.private.serversession import IpmiServer as ipmiserver
+from pyghmi.ipmi.private.serversession import ServerSession as serversession
+
+from vbmc4vsphere import log
+from vbmc4vsphere.vbmc import VirtualBMC
+
+__all__ = ["Engine", "release_socket"]
+
+LOG = log.get_logger()
+
+# Guards the state pyghmi keeps in sessions (sequence numbers, keys, the
+# request being answered) against the I/O thread and the handler workers
+_LOCK = threading.RLock()
+
+# Seconds to keep the socket of a removed BMC open, so that the pyghmi I/O
+# thread is not left selecting on a closed descriptor
+_CLOSE_DELAY = 2
+
+
+def _locked(fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with _LOCK:
+            return fn(*args, **kwargs)
+
+    return wrapper
+
+
+def _patch_pyghmi():
+    if getattr(ipmiserver, "_vbmc_locked", False):
+        return
+    ipmiserver.process_pktqueue = _locked(ipmiserver.process_pktqueue)
+    serversession.process_pktqueue = _locked(ipmisession.Session.process_pktqueue)
+    ipmiserver._vbmc_locked = True
+
+
+def release_socket(vbmc):
+    """Take the socket of a BMC, and its sessions, away from pyghmi."""
+    with _LOCK:
+        handlers = ipmisession.Session.bmc_handlers
+        handlers.pop(vbmc.serversocket, None)
+        for clientaddr, sessions in list(handlers.items()):
+            session = sessions.get(vbmc.port)
+            if getattr(session, "bmc", None) is vbmc:
+                del sessions[vbmc.port]
+                if not sessions:
+                    del handlers[clientaddr]
+        try:
+            ipmisession.iosockets.remove(vbmc.serversocket)
+        except ValueError:
+            pass
+
+    return vbmc.serversocket
+
+
+class _DeferredSession(object):
+    """Answers a request from a worker thread.
+
+    pyghmi builds a response from the sequence number, addresses, netfn
+    and command of the last request received on the session. Those are
+    captured when the request is handed over, and put back in place while
+    the response is sent.
+    """
+
+    CONTEXT = ("seqlun", "rqlun", "clientaddr", "clientnetfn", "clientcommand")
+
+    def __init__(self, session):
+        self._session = session
+        for name in self.CONTEXT:
+            setattr(self, name, getattr(session, name))
+
+    def send_ipmi_response(self, data=[], code=0):
+        self._send_ipmi_net_payload(data=data, code=code)
+
+    def _send_ipmi_net_payload(self, **kwargs):
+        with _LOCK:
+            saved = {name: getattr(self._session, name) for name in self.CONTEXT}
+            for name in self.CONTEXT:
+                setattr(self._session, name, getattr(self, name))
+            try:
+                self._session._send_ipmi_net_payload(**kwargs)
+            finally:
+                for name, value in saved.items():
+                    setattr(self._session, name, value)
+
+    def __getattr__(self, name):
+        return getattr(self._session, name)
+
+
+class HostedBMC(object):
+    """A BMC served by the engine, in lieu of a `multiprocessing.Process`."""
+
+    def __init__(self, engine, vm_name, vbmc=None, error=None):
+        self.engine = engine
+        self.vm_name = vm_name
+        self.vbmc = vbmc
+        self.error = error
+
+    @property
+    def exitcode(self):
+        return None if self.is_alive() else 1
+
+    def is_alive(self):
+        return self.vbmc is not None and self.engine.is_serving(self)
+
+    def terminate(self):
+        self.engine.remove(self)
+
+
+class Engine(object):
+    """Serves many virtual BMCs from a single process.
+
+    All BMCs share the I/O thread of pyghmi, which already selects over
+    every socket of the process, and a single thread running the pyghmi
+    event loop. Requests are handed over to a bounded pool of worker
+    threads, so that a slow VI Server call only holds up the BMC it was
+    made for.
+    """
+
+    def __init__(self, workers, timeout=1):
+        _patch_pyghmi()
+        self.timeout = timeout
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="vbmcd-engine-worker"
+        )
+        self._lock = threading.Lock()
+        self._hosted = set()
+        self._closing = []
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        with _LOCK:
+            # The first socket of pyghmi is used to wake up its I/O thread,
+            # give it one which outlives every BMC
+            ipmisession.Session._assignsocket()
+
+        self._running = True
+        self._thread = threading.Thread(
+            target=self._run, name="vbmcd-engine", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self):
+        while self._running:
+            try:
+                ipmisession.Session.wait_for_rsp(self.timeout)
+            except Exception as e:
+                LOG.exception(
+                    "Error in the engine event loop: %(error)s", {"error": e}
+                )
+            self._close_sockets()
+
+    def _close_sockets(self, delay=_CLOSE_DELAY):
+        now = time.monotonic()
+        with self._lock:
+            closing = [sock for t, sock in self._closing if now - t >= delay]
+            self._closing = [
+                (t, sock) for t, sock in self._closing if now - t < delay
+            ]
+
+        for sock in closing:
+            sock.close()
+
+    def _dispatch(self, handler, request, session):
+        session = _DeferredSession(session)
+        try:
+            self._executor.submit(handler, request, session)
+        except RuntimeError:
+            # Shutting down
+            pass
+
+    def add(self, bmc_config, notify=None):
+        vm_name = bmc_config["vm_name"]
+        try:
+            with _LOCK:
+                vbmc = VirtualBMC(
+                    notify=notify, dispatcher=self._dispatch, **bmc_config
+                )
+
+        except Exception as ex:
+            LOG.error(
+                "Error serving vBMC for vm %(vm)s: %(error)s",
+                {"vm": vm_name, "error": ex},
+            )
+            return HostedBMC(self, vm_name, error=ex)
+
+        hosted = HostedBMC(self, vm_name, vbmc)
+        with self._lock:
+            self._hosted.add(hosted)
+
+        return hosted
+
+    def is_serving(self, hosted):
+        with self._lock:
+            return hosted in self._hosted
+
+    def remove(self, hosted):
+        with self._lock:
+            if hosted not in self._hosted:
+                return
+            self._hosted.discard(hosted)
+
+        sock = release_socket(hosted.vbmc)
+        with self._lock:
+            self._closing.append((time.monotonic(), sock))
+
+    def sentinels(self):
+        """Return the sentinels of worker processes, none here."""
+        return []
+
+    def stop(self):
+        with self._lock:
+            hosted = list(self._hosted)
+        for entry in hosted:
+            self.remove(entry)
+
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._close_sockets(delay=0)
@@ -46,3 +46,11 @@ class DetachProcessError(VirtualBMCError):
         "Error when forking (detaching) the VirtualBMC process "
         "from its parent and session. Error: %(error)s"
     )
+
+
+class PortInUse(VirtualBMCError):
+    message = "Port %(port)s on %(address)s is already used by vm %(vm)s"
+
+
+class NoFreePort(VirtualBMCError):
+    message = "No free port left in port_range %(range)s"
@@ -0,0 +1,401 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import threading
+import time
+
+from pyVmomi import vim, vmodl
+
+from vbmc4vsphere import config as vbmc_config
+from vbmc4vsphere import exception, log, utils
+
+__all__ = ["create_vm_collector", "get_power_state", "get_vm_index"]
+
+LOG = log.get_logger()
+
+CONF = vbmc_config.get_config()
+
+
+def create_vm_collector(session, container, paths):
+    """Return a view of the VMs under `container` and a collector of them.
+
+    The PropertyCollector, private to the caller, has a filter on `paths`
+    of every VM in the view, including the ones entering it later. Both
+    are to be destroyed by the caller.
+    """
+    content = session.content
+    view = content.viewManager.CreateContainerView(
+        container, [vim.VirtualMachine], True
+    )
+    collector = None
+    try:
+        collector = content.propertyCollector.CreatePropertyCollector()
+        traversal = vmodl.query.PropertyCollector.TraversalSpec(
+            name="traverseView",
+            path="view",
+            skip=False,
+            type=vim.view.ContainerView,
+        )
+        spec = vmodl.query.PropertyCollector.FilterSpec(
+            objectSet=[
+                vmodl.query.PropertyCollector.ObjectSpec(
+                    obj=view, skip=True, selectSet=[traversal]
+                )
+            ],
+            propSet=[
+                vmodl.query.PropertyCollector.PropertySpec(
+                    type=vim.VirtualMachine, pathSet=list(paths)
+                )
+            ],
+        )
+        collector.CreateFilter(spec, partialUpdates=True)
+
+    except Exception:
+        for obj in (collector, view):
+            if obj is not None:
+                obj.Destroy()
+        raise
+
+    return view, collector
+
+
+class VMIndex(object):
+    """Name and UUID index of the virtual machines of a VI Server.
+
+    The index is filled by a single PropertyCollector retrieval over a
+    container view of the whole inventory, and then kept current by asking
+    the same collector for the changes since the last version seen. Lookups
+    are dictionary hits; a pending-change check is issued at most every
+    `inventory_refresh_interval` seconds, or right away on a miss.
+    """
+
+    PATHS = ("name", "config.uuid")
+
+    def __init__(self, session, refresh_interval):
+        self.session = session
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._collector = None
+        self._view = None
+        self._version = ""
+        self._last_refresh = None
+        self._vms = {}
+        self._by_name = {}
+        self._by_uuid = {}
+
+    def _create_filter(self):
+        self._view, self._collector = create_vm_collector(
+            self.session, self.session.content.rootFolder, self.PATHS
+        )
+
+    def _unlink(self, moid):
+        vm, name, uuid = self._vms.pop(moid, (None, None, None))
+        for table, key in ((self._by_name, name), (self._by_uuid, uuid)):
+            moids = table.get(key)
+            if moids is not None:
+                moids.discard(moid)
+                if not moids:
+                    del table[key]
+
+    def _link(self, moid, vm, name, uuid):
+        self._vms[moid] = (vm, name, uuid)
+        if name is not None:
+            self._by_name.setdefault(name, set()).add(moid)
+        if uuid is not None:
+            self._by_uuid.setdefault(uuid, set()).add(moid)
+
+    def _apply(self, update):
+        for filter_update in update.filterSet or ():
+            for obj_update in filter_update.objectSet or ():
+                moid = obj_update.obj._moId
+
+                if obj_update.kind == "leave":
+                    self._unlink(moid)
+                    continue
+
+                _, name, uuid = self._vms.get(moid, (None, None, None))
+                for change in obj_update.changeSet or ():
+                    value = None if change.op == "remove" else change.val
+                    if change.name == "name":
+                        name = value
+                    elif change.name == "config.uuid":
+                        uuid = value
+
+                self._unlink(moid)
+                self._link(moid, obj_update.obj, name, uuid)
+
+    def refresh(self, force=False):
+        """Apply the inventory changes made since the last refresh."""
+        with self._lock:
+            now = time.monotonic()
+            if (
+                not force
+                and self._last_refresh is not None
+                and now - self._last_refresh < self.refresh_interval
+            ):
+                return
+
+            try:
+                if self._collector is None:
+                    self._create_filter()
+
+                options = vmodl.query.PropertyCollector.WaitOptions(
+                    maxWaitSeconds=0
+                )
+                while True:
+                    update = self._collector.WaitForUpdatesEx(self._version, options)
+                    if update is None:
+                        break
+                    self._apply(update)
+                    self._version = update.version
+                    if not update.truncated:
+                        break
+
+            except Exception:
+                # Start over with a full retrieval next time
+                self._reset()
+                raise
+
+            if self._last_refresh is None:
+                LOG.debug(
+                    "Indexed %(count)d virtual machines", {"count": len(self._vms)}
+                )
+            self._last_refresh = now
+
+    def _get(self, table, key):
+        with self._lock:
+            return [self._vms[moid][0] for moid in sorted(table.get(key, ()))]
+
+    def _lookup(self, table, key):
+        self.refresh()
+        vms = self._get(table, key)
+        if not vms:
+            # Might have just been created, do not wait for the next refresh
+            self.refresh(force=True)
+            vms = self._get(table, key)
+        return vms
+
+    def find_by_name(self, name):
+        vms = self._lookup(self._by_name, name)
+        if len(vms) != 1:
+            # Either missing or ambiguous
+            raise exception.VMNotFound(vm=name)
+        return vms[0]
+
+    def find_by_uuid(self, uuid):
+        vms = self._lookup(self._by_uuid, uuid)
+        if not vms:
+            raise exception.VMNotFoundByUUID(uuid=uuid)
+        return vms[0]
+
+    def uuids_by_name(self, names):
+        """Return the UUIDs of the VMs with the given names, by name.
+
+        A single refresh is made for all of them. Names which are missing
+        or ambiguous are left out.
+        """
+        self.refresh(force=True)
+        uuids = {}
+        with self._lock:
+            for name in names:
+                moids = self._by_name.get(name, ())
+                if len(moids) == 1:
+                    uuids[name] = self._vms[next(iter(moids))][2]
+        return uuids
+
+    def _reset(self):
+        for obj in (self._collector, self._view):
+            if obj is None:
+                continue
+            try:
+                obj.Destroy()
+            except Exception:
+                pass
+        self._collector = self._view = None
+        self._version = ""
+        self._last_refresh = None
+        self._vms.clear()
+        self._by_name.clear()
+        self._by_uuid.clear()
+
+
+def get_vm_index(session):
+    """Return the VM index of the current login of a pooled session."""
+    return session.get_object(
+        "vm_index",
+        lambda session: VMIndex(
+            session, CONF["vsphere"]["inventory_refresh_interval"]
+        ),
+    )
+
+
+class VMStateWatcher(object):
+    """Push-based cache of the power state and boot order of watched VMs.
+
+    A background thread keeps a `WaitForUpdatesEx` call outstanding on a
+    dedicated PropertyCollector, so vCenter tells us about changes instead
+    of being asked on every poll. The call returns at least every
+    `max_staleness / 2` seconds even without changes; a cached value is
+    only trusted while such a heartbeat has been seen within the last
+    `max_staleness` seconds. Otherwise callers fall back to a direct read.
+    """
+
+    PATHS = ("runtime.powerState", "config.bootOptions.bootOrder")
+
+    def __init__(self, session, max_staleness):
+        self.session = session
+        self.max_staleness = max_staleness
+        self._lock = threading.Lock()
+        self._collector = session.content.propertyCollector.CreatePropertyCollector()
+        self._filters = {}
+        self._values = {}
+        self._heartbeat = None
+        self._failed = False
+        self._failed_at = None
+        self._thread = threading.Thread(
+            target=self._run, name="vbmcd-vm-watcher", daemon=True
+        )
+        self._thread.start()
+
+    @property
+    def healthy(self):
+        with self._lock:
+            return (
+                not self._failed
+                and self._heartbeat is not None
+                and time.monotonic() - self._heartbeat <= self.max_staleness
+            )
+
+    def can_retry(self):
+        """Whether a failed subscription may be replaced by a new one."""
+        with self._lock:
+            return (
+                self._failed
+                and time.monotonic() - self._failed_at > self.max_staleness
+            )
+
+    def watch(self, vm):
+        moid = vm._moId
+        with self._lock:
+            if moid in self._filters:
+                return
+            # Reserve the slot so that concurrent callers do not subscribe twice
+            self._filters[moid] = None
+
+        spec = vmodl.query.PropertyCollector.FilterSpec(
+            objectSet=[vmodl.query.PropertyCollector.ObjectSpec(obj=vm, skip=False)],
+            propSet=[
+                vmodl.query.PropertyCollector.PropertySpec(
+                    type=vim.VirtualMachine, pathSet=list(self.PATHS)
+                )
+            ],
+        )
+        try:
+            pc_filter = self._collector.CreateFilter(spec, partialUpdates=True)
+        except Exception:
+            with self._lock:
+                self._filters.pop(moid, None)
+            raise
+
+        with self._lock:
+            self._filters[moid] = pc_filter
+
+    def get(self, vm, path):
+        """Return the cached value of a property path of the VM.
+
+        Raises KeyError if the value is not known, or cannot be trusted.
+        """
+        if not self.healthy:
+            raise KeyError(path)
+
+        with self._lock:
+            return self._values[vm._moId][path]
+
+    def _apply(self, update):
+        with self._lock:
+            for filter_update in update.filterSet or ():
+                for obj_update in filter_update.objectSet or ():
+                    moid = obj_update.obj._moId
+                    if obj_update.kind == "leave":
+                        self._values.pop(moid, None)
+                        continue
+                    if obj_update.kind == "enter":
+                        # Unset properties are not part of the initial update
+                        self._values[moid] = dict.fromkeys(self.PATHS)
+                    values = self._values.setdefault(moid, {})
+                    for change in obj_update.changeSet or ():
+                        values[change.name] = (
+                            None if change.op == "remove" else change.val
+                        )
+
+    def _run(self):
+        version = ""
+        options = vmodl.query.PropertyCollector.WaitOptions(
+            maxWaitSeconds=max(1, int(self.max_staleness / 2))
+        )
+        try:
+            while True:
+                update = self._collector.WaitForUpdatesEx(version, options)
+                if update is not None:
+                    self._apply(update)
+                    version = update.version
+                with self._lock:
+                    self._heartbeat = time.monotonic()
+
+        except Exception as e:
+            LOG.warning(
+                "VM state subscription failed, falling back to direct "
+                "reads. Error: %(error)s",
+                {"error": e},
+            )
+            with self._lock:
+                self._failed = True
+                self._failed_at = time.monotonic()
+            try:
+                self._collector.Destroy()
+            except Exception:
+                pass
+
+
+def _get_property(session, vm, path):
+    """Return a property of the VM, from memory when possible."""
+    max_staleness = CONF["vsphere"]["vm_state_max_staleness"]
+    if max_staleness > 0:
+        try:
+            watcher = session.get_object(
+                "vm_state_watcher",
+                lambda session: VMStateWatcher(session, max_staleness),
+                stale=lambda watcher: watcher.can_retry(),
+            )
+
+            try:
+                return watcher.get(vm, path)
+            except KeyError:
+                watcher.watch(vm)
+
+        except Exception as e:
+            LOG.debug(
+                "VM state cache unavailable for vm %(vm)s. Error: %(error)s",
+                {"vm": vm._moId, "error": e},
+            )
+
+    return utils.retrieve_properties(session, vm, [path])[path]
+
+
+def get_power_state(session, vm):
+    """Return `runtime.powerState` of the VM."""
+    return _get_property(session, vm, "runtime.powerState")
+
+
+def get_boot_order(session, vm):
+    """Return `config.bootOptions.bootOrder` of the VM."""
+    return _get_property(session, vm, "config.bootOptions.bootOrder")
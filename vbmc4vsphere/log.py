@@ -10,12 +10,19 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import atexit
 import errno
 import logging
+import logging.handlers
+import os
+import queue
+import socket
+import threading
+import time
 
 from vbmc4vsphere import config
 
-__all__ = ["get_logger"]
+__all__ = ["RateLimit", "get_logger"]
 
 DEFAULT_LOG_FORMAT = (
     "%(asctime)s.%(msecs)03d %(process)d %(levelname)s " "%(name)s [-] %(message)s"
@@ -23,6 +30,129 @@ DEFAULT_LOG_FORMAT = (
 LOGGER = None
 
 
+# Bytes of records which may wait for the writer of vsbmcd, past which
+# the records of the processes logging are dropped
+COLLECT_BUFFER_SIZE = 4 * 1024 * 1024
+# Records written at once by the writer of vsbmcd
+COLLECT_BATCH = 256
+# Longest record sent to the writer, longer ones are truncated
+MAX_RECORD_SIZE = 65536
+
+
+class _DatagramHandler(logging.Handler):
+    """Sends formatted records to a `_Collector`, without ever waiting.
+
+    Records which do not fit in the buffer of the collector are dropped
+    and counted, and the count is sent ahead of the next record which
+    fits.
+    """
+
+    def __init__(self, sock):
+        logging.Handler.__init__(self)
+        self.sock = sock
+        self.dropped = 0
+
+    def _send(self, record, flags):
+        try:
+            message = self.format(record).encode("utf-8", "replace")
+            self.sock.send(message[:MAX_RECORD_SIZE], flags)
+            return True
+        except OSError:
+            return False
+
+    def send_dropped(self, flags=socket.MSG_DONTWAIT):
+        """Send the count of the records dropped so far, if any."""
+        if not self.dropped:
+            return True
+
+        notice = logging.makeLogRecord(
+            {
+                "name": "VirtualBMC",
+                "levelno": logging.WARNING,
+                "levelname": logging.getLevelName(logging.WARNING),
+                "msg": "%(count)d log record(s) dropped",
+                "args": {"count": self.dropped},
+            }
+        )
+        if not self._send(notice, flags):
+            return False
+        self.dropped = 0
+        return True
+
+    def emit(self, record):
+        if not self.send_dropped() or not self._send(record, socket.MSG_DONTWAIT):
+            self.dropped += 1
+
+
+class _Collector(object):
+    """Writes the records of vsbmcd and of the processes it forks.
+
+    Every process sends its records as datagrams through `sender`, and a
+    thread of vsbmcd writes them in batches to `handler`. The buffer of
+    the socket bounds how many records may wait to be written.
+    """
+
+    def __init__(self, handler):
+        self.handler = handler
+        self._reader, writer = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._reader.setsockopt(
+            socket.SOL_SOCKET, socket.SO_RCVBUF, COLLECT_BUFFER_SIZE
+        )
+        writer.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, COLLECT_BUFFER_SIZE)
+        self.sender = _DatagramHandler(writer)
+        self.sender.setFormatter(handler.formatter)
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name="vbmcd-log-writer", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self.sender.send_dropped(flags=0)
+        # An empty record tells the writer to stop
+        self.sender.sock.send(b"")
+        self._thread.join()
+        self._thread = None
+
+    def after_fork(self):
+        """Leave the writing to the parent process."""
+        self._thread = None
+        self._reader.close()
+
+    def _run(self):
+        while True:
+            records = [self._reader.recv(MAX_RECORD_SIZE)]
+            while records[-1] and len(records) < COLLECT_BATCH:
+                try:
+                    records.append(
+                        self._reader.recv(MAX_RECORD_SIZE, socket.MSG_DONTWAIT)
+                    )
+                except BlockingIOError:
+                    break
+
+            text = "".join(
+                record.decode("utf-8", "replace") + self.handler.terminator
+                for record in records
+                if record
+            )
+            if text:
+                self.handler.acquire()
+                try:
+                    self.handler.stream.write(text)
+                    self.handler.flush()
+                except Exception:
+                    pass
+                finally:
+                    self.handler.release()
+
+            if not records[-1]:
+                return
+
+
 class VirtualBMCLogger(logging.Logger):
     def __init__(self, debug=False, logfile=None):
         logging.Logger.__init__(self, "VirtualBMC")
@@ -34,7 +164,12 @@ class VirtualBMCLogger(logging.Logger):
 
             formatter = logging.Formatter(DEFAULT_LOG_FORMAT)
             self.handler.setFormatter(formatter)
-            self.addHandler(self.handler)
+            # Records are queued and written by a thread of their own, so
+            # that no thread serving IPMI requests waits on the log file
+            self._sink = None
+            self._listener = None
+            self._collector = None
+            self._start_listener()
 
             if debug:
                 self.setLevel(logging.DEBUG)
@@ -45,11 +180,106 @@ class VirtualBMCLogger(logging.Logger):
             if e.errno == errno.EACCES:
                 pass
 
+    def _use(self, sink):
+        if self._sink is not None:
+            self.removeHandler(self._sink)
+        self._sink = sink
+        self.addHandler(sink)
+
+    def _start_listener(self):
+        records = queue.SimpleQueue()
+        self._use(logging.handlers.QueueHandler(records))
+        self._listener = logging.handlers.QueueListener(records, self.handler)
+        self._listener.start()
+
+    def _after_fork(self):
+        if self._collector is not None:
+            # Keep sending to the writer of the parent
+            self._collector.after_fork()
+        else:
+            # The writer thread is not carried over to the child, and the
+            # records left in the queue are the parent's to write
+            self._start_listener()
+
+    def collect(self):
+        """Write the records of this process and its future children.
+
+        From then on, the processes forked send their records to a single
+        writer thread of this process instead of writing them themselves.
+        """
+        if getattr(self, "_sink", None) is None or self._collector is not None:
+            return
+        self.stop()
+        self._collector = _Collector(self.handler)
+        self._use(self._collector.sender)
+        self._collector.start()
+
+    def flush(self):
+        """Wait for the records logged so far to be written."""
+        collector = getattr(self, "_collector", None)
+        if collector is not None:
+            if collector._thread is not None:
+                collector.stop()
+                collector.start()
+            # Children have nothing left to write
+            return
+
+        listener = getattr(self, "_listener", None)
+        if listener is not None:
+            listener.stop()
+            listener.start()
+
+    def stop(self):
+        """Write the records logged so far and stop the writer thread."""
+        collector = getattr(self, "_collector", None)
+        if collector is not None:
+            collector.stop()
+
+        listener = getattr(self, "_listener", None)
+        if listener is not None:
+            self._listener = None
+            listener.stop()
+
+
+class RateLimit(object):
+    """Lets through at most `rate` records per second, none if 0.
+
+    `allow()` returns None when the next record should not be logged, or
+    the number of records which were not since the last one which was.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._second = None
+        self._allowed = 0
+        self._skipped = 0
+
+    def allow(self):
+        if self.rate <= 0:
+            return None
+
+        second = int(time.monotonic())
+        with self._lock:
+            if second != self._second:
+                self._second = second
+                self._allowed = 0
+            if self._allowed >= self.rate:
+                self._skipped += 1
+                return None
+            self._allowed += 1
+            skipped, self._skipped = self._skipped, 0
+            return skipped
+
 
 def get_logger():
     global LOGGER
     if LOGGER is None:
         log_conf = config.get_config()["log"]
         LOGGER = VirtualBMCLogger(debug=log_conf["debug"], logfile=log_conf["logfile"])
+        if getattr(LOGGER, "_listener", None) is not None:
+            os.register_at_fork(after_in_child=LOGGER._after_fork)
+            atexit.register(LOGGER.stop)
 
     return LOGGER
+
@@ -10,15 +10,31 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
-import configparser
-import errno
+import collections
+import contextlib
+import fnmatch
+import functools
 import multiprocessing
-import os
-import shutil
+import multiprocessing.connection
+import queue
 import signal
+import sys
+import threading
+import time
 
 from vbmc4vsphere import config as vbmc_config
-from vbmc4vsphere import exception, log, utils
+from vbmc4vsphere import (
+    aioserver,
+    discovery,
+    engine,
+    exception,
+    inventory,
+    log,
+    pool,
+    shard,
+    store,
+    utils,
+)
 from vbmc4vsphere.vbmc import VirtualBMC
 
 LOG = log.get_logger()
@@ -28,7 +44,16 @@ RUNNING = "running"
 DOWN = "down"
 ERROR = "error"
 
-DEFAULT_SECTION = "VirtualBMC"
+# Fields `list` can sort by
+LIST_SORT_KEYS = ("vm_name", "status", "address", "port", "viserver", "fakemac")
+
+# Seconds before restarting an instance which exited again soon after being
+# started, doubled on every such exit up to RESTART_BACKOFF_MAX. The first
+# exit, or one after running RESTART_BACKOFF_RESET seconds, restarts it
+# right away.
+RESTART_BACKOFF = 1
+RESTART_BACKOFF_MAX = 60
+RESTART_BACKOFF_RESET = 60
 
 CONF = vbmc_config.get_config()
 
@@ -36,73 +61,82 @@ CONF = vbmc_config.get_config()
 multiprocessing.set_start_method("fork")
 
 
-class VirtualBMCManager(object):
-
-    VBMC_OPTIONS = [
-        "username",
-        "password",
-        "address",
-        "port",
-        "fakemac",
-        "vm_name",
-        "vm_uuid",
-        "viserver",
-        "viserver_username",
-        "viserver_password",
-        "active",
-    ]
-
-    def __init__(self):
-        super(VirtualBMCManager, self).__init__()
-        self.config_dir = CONF["default"]["config_dir"]
-        self._running_vms = {}
-
-    def _parse_config(self, vm_name):
-        config_path = os.path.join(self.config_dir, vm_name, "config")
-        if not os.path.exists(config_path):
-            raise exception.VMNotFound(vm=vm_name)
+def _exit_reason(instance):
+    error = getattr(instance, "error", None)
+    if error is not None:
+        return str(error)
 
+    rc = instance.exitcode
+    if rc is not None and rc < 0:
         try:
-            config = configparser.ConfigParser()
-            config.read(config_path)
+            return "killed by %s" % signal.Signals(-rc).name
+        except ValueError:
+            return "killed by signal %d" % -rc
 
-            bmc = {}
-            for item in self.VBMC_OPTIONS:
-                try:
-                    value = config.get(DEFAULT_SECTION, item)
-                except configparser.NoOptionError:
-                    value = None
-
-                bmc[item] = value
-
-            # Generate Fake MAC if needed
-            if bmc["fakemac"] is None:
-                bmc["fakemac"] = utils.generate_fakemac_by_vm_name(vm_name)
+    return "rc %s" % rc
 
-            # Port needs to be int
-            bmc["port"] = config.getint(DEFAULT_SECTION, "port")
 
-            return bmc
-
-        except OSError:
-            raise exception.VMNotFound(vm=vm_name)
+class VirtualBMCManager(object):
 
-    def _store_config(self, **options):
-        config = configparser.ConfigParser()
-        config.add_section(DEFAULT_SECTION)
+    VBMC_OPTIONS = store.VBMC_OPTIONS
 
-        for option, value in options.items():
-            if value is not None:
-                config.set(DEFAULT_SECTION, option, str(value))
+    def __init__(self):
+        super(VirtualBMCManager, self).__init__()
+        self.config_dir = CONF["default"]["config_dir"]
+        self._store = store.get_store()
+        # Held while the state is changed, see `batch`
+        self.lock = threading.RLock()
+        self._running_vms = {}
+        # VMs whose instance may not match their config
+        self._dirty = set()
+        self._batching = 0
+        # File descriptors reported to `handle_events`: sentinels of vBMC
+        # processes and of engine workers, read ends of status pipes
+        self._watched = {}
+        self._fds = frozenset()
+        # Last exit of the instance of a VM, start times of the instances,
+        # and when the instances which keep exiting are due for a restart
+        self._exits = {}
+        self._started = {}
+        self._delayed = {}
+        # Read ends of the pipes vBMC instances report their state through
+        self._status_pipes = {}
+        self._vm_status = {}
+        # Changes to let subscribers know about, see `events`, and what to
+        # call, from any thread, when there are new ones
+        self._events = queue.SimpleQueue()
+        self.wakeup = None
+
+        self._engine = None
+        if CONF["default"]["engine"] == "single":
+            self._engine = engine.Engine(
+                CONF["default"]["engine_workers"],
+                timeout=CONF["ipmi"]["session_timeout"],
+            )
+        elif CONF["default"]["engine"] == "asyncio":
+            self._engine = aioserver.AsyncEngine(CONF["default"]["engine_workers"])
+        elif CONF["default"]["engine"] == "sharded":
+            self._engine = shard.ShardedEngine(
+                CONF["default"]["engine_processes"],
+                CONF["default"]["engine_workers"],
+                timeout=CONF["ipmi"]["session_timeout"],
+            )
 
-        config_path = os.path.join(self.config_dir, options["vm_name"], "config")
+        if self._engine is not None:
+            self._engine.start()
+            self._watch_engine()
+            # State reports of the vBMCs served by the engine
+            self._status_queue = queue.SimpleQueue()
 
-        with open(config_path, "w") as f:
-            config.write(f)
+        # vBMCs added and deleted as their VMs come and go in vCenter
+        self._discoveries = discovery.get_discoveries()
+        for source in self._discoveries.values():
+            source.start()
+            self._watch(source.fileno(), source.name, "discovery")
 
     def _vbmc_enabled(self, vm_name, lets_enable=None, config=None):
         if not config:
-            config = self._parse_config(vm_name)
+            config = self._store.get(vm_name)
 
         try:
             currently_enabled = utils.str2bool(config["active"])
@@ -111,8 +145,7 @@ class VirtualBMCManager(object):
             currently_enabled = False
 
         if lets_enable is not None and lets_enable != currently_enabled:
-            config.update(active=lets_enable)
-            self._store_config(**config)
+            self._store.update(vm_name, active=lets_enable)
             currently_enabled = lets_enable
 
         return currently_enabled
@@ -120,15 +153,42 @@ class VirtualBMCManager(object):
     def _sync_vbmc_states(self, shutdown=False):
         """Starts/stops vBMC instances
 
-        Walks over vBMC instances configuration, starts
-        enabled but dead instances, kills non-configured
-        but alive ones.
+        Picks up config changes, then starts enabled but dead
+        instances and kills disabled or removed but alive ones
+        among the VMs they affect.
         """
-
-        def vbmc_runner(bmc_config):
+        if shutdown:
+            for vm_name in list(self._running_vms):
+                self._sync_vbmc_state(vm_name, shutdown=True)
+            return
+
+        self._dirty.update(
+            self._store.refresh(CONF["default"]["config_check_batch"])
+        )
+        self._reconcile()
+
+    def _reconcile(self):
+        """Sync the VMs marked as changed, and those due for a restart."""
+        vm_names = self._dirty
+        self._dirty = set()
+
+        now = time.monotonic()
+        for vm_name, restart_at in list(self._delayed.items()):
+            if restart_at <= now:
+                del self._delayed[vm_name]
+                vm_names.add(vm_name)
+
+        for vm_name in vm_names:
+            self._sync_vbmc_state(vm_name)
+
+    def _sync_vbmc_state(self, vm_name, shutdown=False):
+        """Starts/stops the vBMC instance of a VM according to its config"""
+
+        def vbmc_runner(bmc_config, status_conn):
             # The manager process installs a signal handler for SIGTERM to
-            # propagate it to children. Return to the default handler.
-            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            # propagate it to children. Replace it with one that unwinds
+            # the stack so that pooled VI Server sessions are logged out.
+            signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
 
             show_passwords = CONF["default"]["show_passwords"]
 
@@ -137,14 +197,28 @@ class VirtualBMCManager(object):
             else:
                 show_options = utils.mask_dict_password(bmc_config)
 
+            status_lock = threading.Lock()
+
+            def notify(event, **data):
+                data.update(vm_name=bmc_config["vm_name"], event=event)
+                try:
+                    with status_lock:
+                        status_conn.send(data)
+                except (OSError, ValueError) as ex:
+                    LOG.debug(
+                        "Unable to report %(event)s for vm %(vm)s: %(error)s",
+                        {"event": event, "vm": bmc_config["vm_name"], "error": ex},
+                    )
+
             try:
-                vbmc = VirtualBMC(**bmc_config)
+                vbmc = VirtualBMC(notify=notify, **bmc_config)
 
             except Exception as ex:
                 LOG.exception(
                     "Error running vBMC with configuration " "%(opts)s: %(error)s",
                     {"opts": show_options, "error": ex},
                 )
+                LOG.flush()
                 return
 
             try:
@@ -157,62 +231,413 @@ class VirtualBMCManager(object):
                 )
                 return
 
-        for vm_name in os.listdir(self.config_dir):
-            if not os.path.isdir(os.path.join(self.config_dir, vm_name)):
-                continue
+            finally:
+                pool.get_pool().close()
+                # The process ends without running atexit handlers
+                LOG.flush()
 
-            try:
-                bmc_config = self._parse_config(vm_name)
+        self._dirty.discard(vm_name)
+        self._delayed.pop(vm_name, None)
+        bmc_config = self._store.configs().get(vm_name)
 
-            except exception.VMNotFound:
-                continue
+        if shutdown or bmc_config is None:
+            lets_enable = False
+        else:
+            bmc_config = dict(bmc_config)
+            lets_enable = self._vbmc_enabled(vm_name, config=bmc_config)
 
-            if shutdown:
-                lets_enable = False
-            else:
-                lets_enable = self._vbmc_enabled(vm_name, config=bmc_config)
+        instance = self._running_vms.get(vm_name)
 
-            instance = self._running_vms.get(vm_name)
+        if lets_enable:
+
+            if instance and not instance.is_alive():
+                delay = self._instance_exited(vm_name, instance)
+                if delay > 0:
+                    self._delayed[vm_name] = time.monotonic() + delay
+                    return
+
+            if self._engine is not None and (not instance or not instance.is_alive()):
+                event = "started" if instance is None else "restarted"
+                self._vm_status.pop(vm_name, None)
+                self._started[vm_name] = time.monotonic()
+                instance = self._engine.add(
+                    bmc_config,
+                    notify=functools.partial(self._engine_notify, vm_name),
+                )
+                self._running_vms[vm_name] = instance
+                self._watch_engine()
 
-            if lets_enable:
+                if instance.is_alive():
+                    LOG.info(
+                        "Started vBMC instance for vm " "%(vm)s",
+                        {"vm": vm_name},
+                    )
+                    self._emit(event, vm_name)
+                else:
+                    # Try again later, backing off if it keeps failing
+                    delay = self._instance_exited(vm_name, instance)
+                    self._delayed[vm_name] = time.monotonic() + delay
+
+            elif not instance or not instance.is_alive():
+
+                event = "started" if instance is None else "restarted"
+                self._forget_instance(vm_name)
+                status_reader, status_writer = multiprocessing.Pipe(duplex=False)
+
+                instance = multiprocessing.Process(
+                    name="vbmcd-managing-vm-%s" % vm_name,
+                    target=vbmc_runner,
+                    args=(bmc_config, status_writer),
+                )
 
-                if not instance or not instance.is_alive():
+                instance.daemon = True
+                instance.start()
 
-                    instance = multiprocessing.Process(
-                        name="vbmcd-managing-vm-%s" % vm_name,
-                        target=vbmc_runner,
-                        args=(bmc_config,),
-                    )
+                # Only the child writes to the pipe
+                status_writer.close()
 
-                    instance.daemon = True
-                    instance.start()
+                self._running_vms[vm_name] = instance
+                self._status_pipes[vm_name] = status_reader
+                self._started[vm_name] = time.monotonic()
+                self._watch(instance.sentinel, vm_name, "process")
+                self._watch(status_reader.fileno(), vm_name, "status")
 
-                    self._running_vms[vm_name] = instance
+                LOG.info(
+                    "Started vBMC instance for vm " "%(vm)s",
+                    {"vm": vm_name},
+                )
+                self._emit(event, vm_name)
 
+        else:
+            if instance:
+                if instance.is_alive():
+                    instance.terminate()
                     LOG.info(
-                        "Started vBMC instance for vm " "%(vm)s",
+                        "Terminated vBMC instance for vm " "%(vm)s",
                         {"vm": vm_name},
                     )
+                    self._emit("stopped", vm_name)
+
+                self._forget_instance(vm_name)
+
+    def _instance_exited(self, vm_name, instance):
+        """Record the exit of an instance, return seconds until its restart."""
+        now = time.monotonic()
+        last_exit = self._exits.get(vm_name)
+        if last_exit is not None and last_exit["instance"] is instance:
+            return last_exit["restart_at"] - now
+
+        if (
+            last_exit is None
+            or now - self._started.get(vm_name, now) >= RESTART_BACKOFF_RESET
+        ):
+            exits = 1
+        else:
+            exits = last_exit["exits"] + 1
+
+        delay = 0
+        if exits > 1:
+            delay = min(RESTART_BACKOFF * 2 ** (exits - 2), RESTART_BACKOFF_MAX)
+
+        reason = _exit_reason(instance)
+        self._exits[vm_name] = {
+            "instance": instance,
+            "exits": exits,
+            "restart_at": now + delay,
+            "rc": instance.exitcode,
+            "reason": reason,
+            "time": time.time(),
+        }
+
+        LOG.warning(
+            "vBMC instance for vm %(vm)s exited (%(reason)s), restarting in "
+            "%(delay)d second(s)",
+            {"vm": vm_name, "reason": reason, "delay": delay},
+        )
+        self._emit(
+            "exited", vm_name, rc=instance.exitcode, reason=reason, restart_in=delay
+        )
+        return delay
+
+    def _forget_instance(self, vm_name):
+        instance = self._running_vms.pop(vm_name, None)
+        sentinel = getattr(instance, "sentinel", None)
+        if sentinel is not None:
+            self._unwatch(sentinel)
+        self._close_status(vm_name)
+
+    def _close_status(self, vm_name):
+        status_reader = self._status_pipes.pop(vm_name, None)
+        if status_reader is not None:
+            self._unwatch(status_reader.fileno())
+            status_reader.close()
+        self._vm_status.pop(vm_name, None)
+
+    def _watch(self, fd, vm_name, kind):
+        self._watched[fd] = (vm_name, kind)
+        self._fds = None
+
+    def _unwatch(self, fd):
+        if self._watched.pop(fd, None) is not None:
+            self._fds = None
+
+    def _watch_engine(self):
+        """Watch the worker processes of the engine, if it has any."""
+        sentinels = set(self._engine.sentinels())
+        for fd, (vm_name, kind) in list(self._watched.items()):
+            if kind == "engine" and fd not in sentinels:
+                self._unwatch(fd)
+        for fd in sentinels:
+            if fd not in self._watched:
+                self._watch(fd, None, "engine")
+
+    def fds(self):
+        """Return the file descriptors to wait on for `handle_events`.
+
+        The same object is returned as long as the set does not change.
+        """
+        if self._fds is None:
+            self._fds = frozenset(self._watched)
+        return self._fds
 
-                if not instance.is_alive():
-                    LOG.debug(
-                        "Found dead vBMC instance for vm %(vm)s " "(rc %(rc)s)",
-                        {"vm": vm_name, "rc": instance.exitcode},
+    def next_restart(self):
+        """Return the `time.monotonic()` of the next delayed restart."""
+        return min(self._delayed.values(), default=None)
+
+    def handle_events(self, fds):
+        """Collect state reports and restart exited instances.
+
+        Called with the file descriptors of `fds` which are ready, or with
+        none when a delayed restart is due.
+        """
+        for fd in fds:
+            try:
+                vm_name, kind = self._watched[fd]
+            except KeyError:
+                continue
+
+            if kind == "discovery":
+                self._discover(self._discoveries[vm_name])
+                continue
+
+            if kind == "engine":
+                # A worker of the engine exited, with all of its vBMCs
+                self._unwatch(fd)
+                self._engine.reap(fd)
+                for vm_name, instance in self._running_vms.items():
+                    if not instance.is_alive():
+                        self._dirty.add(vm_name)
+                continue
+
+            # Read what an instance reported before it exited
+            self._drain_pipe(vm_name)
+            if kind == "process":
+                self._unwatch(fd)
+                self._dirty.add(vm_name)
+                # The sentinel is ready as soon as the child closed its end,
+                # possibly before the child can be reaped
+                instance = self._running_vms.get(vm_name)
+                if instance is not None:
+                    instance.join(timeout=1)
+
+        self._reconcile()
+
+    def _discover(self, source):
+        """Add and delete the vBMCs of the VMs which came and went."""
+        changes = source.changes()
+        with self.batch():
+            for index, change in enumerate(changes):
+                if change[0] == "sync":
+                    members = change[1]
+                    for vm_name, bmc_config in list(self._store.configs().items()):
+                        if (
+                            bmc_config["discovery"] == source.name
+                            and vm_name not in members
+                        ):
+                            self._undiscover(source, vm_name)
+                    for vm_name, vm_uuid in members.items():
+                        self._discovered(source, vm_name, vm_uuid)
+
+                elif change[0] == "enter":
+                    self._discovered(source, change[1], change[2])
+
+                else:
+                    # A name which enters again right away, as another VM
+                    # has it now, keeps its vBMC
+                    following = changes[index + 1 : index + 2]
+                    if following and following[0][:2] == ("enter", change[1]):
+                        continue
+                    self._undiscover(source, change[1])
+
+    def _discovered(self, source, vm_name, vm_uuid):
+        bmc_config = self._store.configs().get(vm_name)
+        if bmc_config is not None:
+            # Added by hand, by another discovery or already, in which case
+            # another VM may have the name now
+            if (
+                bmc_config["discovery"] == source.name
+                and bmc_config["vm_uuid"] != vm_uuid
+            ):
+                self._rediscovered(source, vm_name, vm_uuid)
+            return
+
+        options = source.options
+        rc, msg = self.add(
+            username=options.get("username", "admin"),
+            password=options.get("password", "password"),
+            port=None,
+            address=options.get("address", "::"),
+            fakemac=None,
+            vm_name=vm_name,
+            vm_uuid=vm_uuid,
+            viserver=options["viserver"],
+            viserver_username=options.get("viserver_username"),
+            viserver_password=options.get("viserver_password"),
+            discovery=source.name,
+        )
+        if rc:
+            LOG.warning(
+                "Unable to add vBMC for vm %(vm)s found by discovery "
+                "%(name)s: %(error)s",
+                {"vm": vm_name, "name": source.name, "error": msg},
+            )
+            return
+
+        LOG.info(
+            "Added vBMC on port %(port)s for vm %(vm)s found by discovery "
+            "%(name)s",
+            {
+                "port": self._store.configs()[vm_name]["port"],
+                "vm": vm_name,
+                "name": source.name,
+            },
+        )
+        if options["start"]:
+            self.start(vm_name)
+
+    def _rediscovered(self, source, vm_name, vm_uuid):
+        """Point the vBMC of a discovered name at the VM which has it now."""
+        self._store.update(vm_name, vm_uuid=vm_uuid)
+        if vm_name in self._running_vms:
+            # Started again to look the new VM up
+            self._sync_vbmc_state(vm_name, shutdown=True)
+            self._apply(vm_name)
+
+        LOG.info(
+            "Updated vBMC for vm %(vm)s found by discovery %(name)s to UUID "
+            "%(uuid)s",
+            {"vm": vm_name, "name": source.name, "uuid": vm_uuid},
+        )
+
+    def _undiscover(self, source, vm_name):
+        bmc_config = self._store.configs().get(vm_name)
+        if bmc_config is None or bmc_config["discovery"] != source.name:
+            return
+
+        self.delete(vm_name)
+        LOG.info(
+            "Deleted vBMC for vm %(vm)s gone from discovery %(name)s",
+            {"vm": vm_name, "name": source.name},
+        )
+
+    def _engine_notify(self, vm_name, event, **data):
+        if event == "power":
+            self._emit("power", vm_name, **data)
+        data.update(vm_name=vm_name, event=event)
+        self._status_queue.put(data)
+
+    def _emit(self, event, vm_name, **data):
+        data.update(event=event, vm_name=vm_name, time=time.time())
+        self._events.put(data)
+        wakeup = self.wakeup
+        if wakeup is not None:
+            wakeup()
+
+    def events(self):
+        """Return the changes made or seen since the last call.
+
+        Each is a dict with the `event`, the `vm_name` and the `time`, and
+        details depending on the event. vBMCs are "added", "deleted",
+        "started", "restarted" after they exited, "stopped" on request, or
+        "exited" on their own. "power" reports the power state of the VM
+        as last seen by its vBMC. May be called from any thread; `wakeup`
+        is called when there are new changes, engine threads included.
+        """
+        events = []
+        while True:
+            try:
+                events.append(self._events.get_nowait())
+            except queue.Empty:
+                return events
+
+    def metrics(self):
+        """Return the last metrics reported by every vBMC.
+
+        May be called from any thread.
+        """
+        return [
+            status["metrics"]
+            for status in list(self._vm_status.values())
+            if "metrics" in status
+        ]
+
+    def _drain_status(self):
+        """Collect the state reports sent by vBMC instances."""
+        if self._engine is not None:
+            while True:
+                try:
+                    data = self._status_queue.get_nowait()
+                except queue.Empty:
+                    break
+                self._vm_status.setdefault(data["vm_name"], {}).update(data)
+
+        pipes = {
+            status_reader: vm_name
+            for vm_name, status_reader in self._status_pipes.items()
+        }
+        for status_reader in multiprocessing.connection.wait(pipes, timeout=0):
+            self._drain_pipe(pipes[status_reader])
+
+    def _drain_pipe(self, vm_name):
+        status_reader = self._status_pipes.get(vm_name)
+        if status_reader is None:
+            return
+
+        try:
+            while status_reader.poll():
+                data = status_reader.recv()
+                self._vm_status.setdefault(vm_name, {}).update(data)
+                if data.get("event") == "power":
+                    self._emit(
+                        "power",
+                        vm_name,
+                        state=data["state"],
+                        previous=data["previous"],
                     )
 
-            else:
-                if instance:
-                    if instance.is_alive():
-                        instance.terminate()
-                        LOG.info(
-                            "Terminated vBMC instance for vm " "%(vm)s",
-                            {"vm": vm_name},
-                        )
+        except (EOFError, OSError):
+            # The instance is gone, keep what it reported last, and have it
+            # started again if it is still enabled
+            self._unwatch(status_reader.fileno())
+            status_reader.close()
+            self._status_pipes.pop(vm_name, None)
+            self._dirty.add(vm_name)
+
+    def _status(self, vm_name):
+        instance = self._running_vms.get(vm_name)
 
-                    self._running_vms.pop(vm_name, None)
+        if instance and instance.is_alive():
+            return RUNNING
+        elif instance and not instance.is_alive():
+            return ERROR
+        else:
+            return DOWN
 
-    def _show(self, vm_name):
-        bmc_config = self._parse_config(vm_name)
+    def _show(self, vm_name, bmc_config=None):
+        if bmc_config is None:
+            bmc_config = self._store.get(vm_name)
+        else:
+            bmc_config = dict(bmc_config)
 
         show_passwords = CONF["default"]["show_passwords"]
 
@@ -221,20 +646,62 @@ class VirtualBMCManager(object):
         else:
             show_options = utils.mask_dict_password(bmc_config)
 
-        instance = self._running_vms.get(vm_name)
+        show_options["status"] = self._status(vm_name)
 
-        if instance and instance.is_alive():
-            show_options["status"] = RUNNING
-        elif instance and not instance.is_alive():
-            show_options["status"] = ERROR
+        status = self._vm_status.get(vm_name, {})
+        show_options["tasks_in_flight"] = ", ".join(status.get("in_flight", ()))
+
+        last_task = status.get("last_task")
+        if last_task:
+            show_options["last_task"] = "%(operation)s: %(state)s at %(time)s" % {
+                "operation": last_task["operation"],
+                "state": last_task["state"],
+                "time": time.strftime(
+                    "%Y-%m-%d %H:%M:%S", time.localtime(last_task["finished"])
+                ),
+            }
+            if last_task["error"]:
+                show_options["last_task"] += " (%s)" % last_task["error"]
         else:
-            show_options["status"] = DOWN
+            show_options["last_task"] = ""
+
+        last_exit = self._exits.get(vm_name)
+        if last_exit:
+            show_options["last_exit"] = "%(reason)s at %(time)s" % {
+                "reason": last_exit["reason"],
+                "time": time.strftime(
+                    "%Y-%m-%d %H:%M:%S", time.localtime(last_exit["time"])
+                ),
+            }
+            restart_at = self._delayed.get(vm_name)
+            if restart_at is not None:
+                show_options["last_exit"] += ", restarting in %d second(s)" % max(
+                    0, restart_at - time.monotonic()
+                )
+        else:
+            show_options["last_exit"] = ""
+
+        show_options["retransmissions"] = (
+            "%(replayed)d replayed, %(attached)d in flight"
+            % {
+                "replayed": status.get("replayed", 0),
+                "attached": status.get("attached", 0),
+            }
+        )
 
         return show_options
 
     def periodic(self, shutdown=False):
+        if shutdown:
+            for source in self._discoveries.values():
+                source.stop()
+
+        self._drain_status()
         self._sync_vbmc_states(shutdown)
 
+        if shutdown and self._engine is not None:
+            self._engine.stop()
+
     def add(
         self,
         username,
@@ -247,17 +714,39 @@ class VirtualBMCManager(object):
         viserver,
         viserver_username,
         viserver_password,
+        discovery=None,
         **kwargs
     ):
 
-        vm_path = os.path.join(self.config_dir, vm_name)
+        if fakemac is None:
+            fakemac = utils.generate_fakemac_by_vm_name(vm_name)
 
         try:
-            os.makedirs(vm_path)
-        except OSError as ex:
-            if ex.errno == errno.EEXIST:
-                return 1, str(ex)
+            self._store.add(
+                dict(
+                    vm_name=vm_name,
+                    vm_uuid=vm_uuid,
+                    username=username,
+                    password=password,
+                    port=port,
+                    address=address,
+                    fakemac=fakemac.replace("-", ":"),
+                    viserver=viserver,
+                    viserver_username=viserver_username,
+                    viserver_password=viserver_password,
+                    active=False,
+                    discovery=discovery,
+                )
+            )
 
+        except (
+            exception.VMAlreadyExists,
+            exception.PortInUse,
+            exception.NoFreePort,
+        ) as ex:
+            return 1, str(ex)
+
+        except Exception as ex:
             msg = "Failed to create vm %(vm)s. " "Error: %(error)s" % {
                 "vm": vm_name,
                 "error": ex,
@@ -265,61 +754,105 @@ class VirtualBMCManager(object):
             LOG.error(msg)
             return 1, msg
 
-        if fakemac is None:
-            fakemac = utils.generate_fakemac_by_vm_name(vm_name)
+        self._emit(
+            "added",
+            vm_name,
+            address=self._store.configs()[vm_name]["address"],
+            port=self._store.configs()[vm_name]["port"],
+        )
+        return 0, ""
 
-        try:
-            self._store_config(
-                vm_name=vm_name,
-                vm_uuid=vm_uuid,
-                username=username,
-                password=password,
-                port=str(port),
-                address=address,
-                fakemac=fakemac.replace("-", ":"),
-                viserver=viserver,
-                viserver_username=viserver_username,
-                viserver_password=viserver_password,
-                active=False,
-            )
+    def add_many(self, vms, resolve_uuids=False):
+        """Add many VMs at once, return the (rc, msg) of each of them."""
+        errors = self._resolve_uuids(vms) if resolve_uuids else {}
 
-        except Exception as ex:
-            self.delete(vm_name)
-            return 1, str(ex)
+        results = []
+        with self.batch():
+            for vm in vms:
+                if vm["vm_name"] in errors:
+                    results.append((1, errors[vm["vm_name"]]))
+                else:
+                    results.append(self.add(**vm))
 
-        return 0, ""
+        return results
+
+    def _resolve_uuids(self, vms):
+        """Fill in the missing UUIDs of VMs, looked up by name.
+
+        Uses a session of its own, closed afterwards, so that it is not
+        inherited by vBMC processes, and a single inventory retrieval per
+        VI Server. Returns the errors by VM name.
+        """
+        errors = {}
+        by_viserver = collections.defaultdict(list)
+        for vm in vms:
+            if not vm.get("vm_uuid"):
+                key = (
+                    vm.get("viserver"),
+                    vm.get("viserver_username"),
+                    vm.get("viserver_password"),
+                )
+                by_viserver[key].append(vm)
+
+        for (vi, vi_username, vi_password), vi_vms in by_viserver.items():
+            session = pool.ViServerSession(vi, vi_username, vi_password)
+            try:
+                session.connect()
+                index = inventory.VMIndex(session, 0)
+                uuids = index.uuids_by_name([vm["vm_name"] for vm in vi_vms])
+
+            except Exception as ex:
+                LOG.error(
+                    "Unable to look VMs up on VI Server %(vi)s: %(error)s",
+                    {"vi": vi, "error": ex},
+                )
+                for vm in vi_vms:
+                    errors[vm["vm_name"]] = str(ex)
+                continue
+
+            finally:
+                session.disconnect()
+
+            for vm in vi_vms:
+                if vm["vm_name"] in uuids:
+                    vm["vm_uuid"] = uuids[vm["vm_name"]]
+                else:
+                    errors[vm["vm_name"]] = str(exception.VMNotFound(vm=vm["vm_name"]))
+
+        return errors
 
     def delete(self, vm_name):
-        vm_path = os.path.join(self.config_dir, vm_name)
-        if not os.path.exists(vm_path):
-            raise exception.VMNotFound(vm=vm_name)
+        self._store.get(vm_name)
 
         try:
             self.stop(vm_name)
         except exception.VirtualBMCError:
             pass
 
-        shutil.rmtree(vm_path)
+        self._store.delete(vm_name)
+        self._emit("deleted", vm_name)
 
         return 0, ""
 
     def start(self, vm_name):
         try:
-            bmc_config = self._parse_config(vm_name)
+            bmc_config = self._store.get(vm_name)
 
         except Exception as ex:
             return 1, str(ex)
 
-        if vm_name in self._running_vms:
-
-            self._sync_vbmc_states()
+        instance = self._running_vms.get(vm_name)
+        if instance is not None and instance.is_alive():
+            LOG.warning(
+                "BMC instance %(vm)s already running, ignoring "
+                '"start" command' % {"vm": vm_name}
+            )
+            return 0, ""
 
-            if vm_name in self._running_vms:
-                LOG.warning(
-                    "BMC instance %(vm)s already running, ignoring "
-                    '"start" command' % {"vm": vm_name}
-                )
-                return 0, ""
+        # Asked for, so no backing off
+        last_exit = self._exits.get(vm_name)
+        if last_exit is not None:
+            last_exit["restart_at"] = time.monotonic()
 
         try:
             self._vbmc_enabled(vm_name, config=bmc_config, lets_enable=True)
@@ -334,7 +867,7 @@ class VirtualBMCManager(object):
                 ),
             )
 
-        self._sync_vbmc_states()
+        self._apply(vm_name)
 
         return 0, ""
 
@@ -346,23 +879,105 @@ class VirtualBMCManager(object):
             LOG.exception("Failed to stop vm %s", vm_name)
             return 1, str(ex)
 
-        self._sync_vbmc_states()
+        self._apply(vm_name)
 
         return 0, ""
 
-    def list(self):
-        rc = 0
-        tables = []
-        try:
-            for vm in os.listdir(self.config_dir):
-                if os.path.isdir(os.path.join(self.config_dir, vm)):
-                    tables.append(self._show(vm))
+    def _apply(self, vm_name):
+        if self._batching:
+            self._dirty.add(vm_name)
+        else:
+            self._sync_vbmc_state(vm_name)
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Apply the config changes made within at once.
+
+        With the "sqlite" config store they are written in a single
+        transaction. vBMC instances are started and stopped afterwards.
+        `lock` is held throughout.
+        """
+        with self.lock:
+            self._batching += 1
+            try:
+                with self._store.batch():
+                    yield
+            finally:
+                self._batching -= 1
+
+            if not self._batching:
+                self._reconcile()
+
+    def list(
+        self,
+        name=None,
+        status=None,
+        address=None,
+        viserver=None,
+        sort=None,
+        offset=0,
+        limit=None,
+    ):
+        """Return the state of the vBMCs as of the last periodic check.
+
+        Returns the number of vBMCs matching the filters, `name` being a
+        glob, and a generator of the page of them starting at `offset`,
+        sorted by the fields of `sort`, each descending when prefixed with
+        "-". Only reads the state in memory, so may run while `lock` is
+        held by another thread.
+        """
+        sort = sort or ["vm_name"]
+        for key in sort:
+            if key.lstrip("-") not in LIST_SORT_KEYS:
+                raise exception.VirtualBMCError(
+                    "Unable to sort by %s, use one of %s"
+                    % (key, ", ".join(LIST_SORT_KEYS))
+                )
 
-        except OSError as e:
-            if e.errno == errno.EEXIST:
-                rc = 1
+        rows = []
+        for vm_name, bmc_config in list(self._store.configs().items()):
+            if name is not None and not fnmatch.fnmatchcase(vm_name, name):
+                continue
+            if address is not None and bmc_config["address"] != address:
+                continue
+            if viserver is not None and bmc_config["viserver"] != viserver:
+                continue
+            vm_status = self._status(vm_name)
+            if status is not None and vm_status != status:
+                continue
+            rows.append((vm_name, bmc_config, vm_status))
+
+        def value_of(field, row):
+            return row[2] if field == "status" else row[1][field]
+
+        # Stable sorts, least significant key first
+        for key in reversed(sort):
+            field = key.lstrip("-")
+            # Unset values last, whichever the direction
+            unset = [row for row in rows if value_of(field, row) is None]
+            rows = [row for row in rows if value_of(field, row) is not None]
+            rows.sort(
+                key=functools.partial(value_of, field), reverse=key.startswith("-")
+            )
+            rows.extend(unset)
 
-        return rc, tables
+        end = None if limit is None else offset + limit
+        tables = (
+            self._show(vm_name, bmc_config)
+            for vm_name, bmc_config, _ in rows[offset:end]
+        )
+        return 0, len(rows), tables
+
+    def list_workers(self):
+        if not isinstance(self._engine, shard.ShardedEngine):
+            return 1, 'Worker processes are only used by the "sharded" engine'
+
+        return 0, self._engine.load()
 
     def show(self, vm_name):
-        return 0, list(self._show(vm_name).items())
+        """Return the state of a vBMC, like `list`."""
+        bmc_config = self._store.configs().get(vm_name)
+        if bmc_config is None:
+            raise exception.VMNotFound(vm=vm_name)
+
+        return 0, list(self._show(vm_name, bmc_config).items())
@@ -0,0 +1,259 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import bisect
+import collections
+import http.server
+import os
+import threading
+import time
+import weakref
+
+from vbmc4vsphere import log
+
+__all__ = ["Metrics", "render", "report", "serve"]
+
+LOG = log.get_logger()
+
+# Upper bounds, in seconds, of the buckets of the latency histograms
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Seconds between the reports of the metrics which changed to vsbmcd
+REPORT_INTERVAL = 5
+
+# Type, help and label names of the metrics
+METRICS = {
+    "vbmc_ipmi_request_seconds": (
+        "histogram",
+        "Time taken to handle IPMI requests",
+        ("vm", "netfn", "command"),
+    ),
+    "vbmc_ipmi_busy_total": (
+        "counter",
+        "Operations which failed with IPMI_COMMAND_NODE_BUSY",
+        ("vm", "operation"),
+    ),
+    "vbmc_vcenter_call_seconds": (
+        "histogram",
+        "Time spent on VI Server calls, by phase: getting a logged in "
+        "session, looking the VM up and the operation itself",
+        ("vm", "viserver", "phase"),
+    ),
+    "vbmc_vcenter_errors_total": (
+        "counter",
+        "VI Server calls which failed, by phase",
+        ("vm", "viserver", "phase"),
+    ),
+    "vbmc_vcenter_sessions_in_use": (
+        "gauge",
+        "VI Server sessions borrowed from the pool",
+        ("vm", "viserver"),
+    ),
+    "vbmc_vcenter_session_acquires_total": (
+        "counter",
+        "VI Server sessions borrowed from the pool, by outcome: hit for a "
+        "session logged in, miss for a first login and relogin for a new "
+        "login of an expired session",
+        ("vm", "viserver", "outcome"),
+    ),
+    "vbmc_vcenter_received_bytes_total": (
+        "counter",
+        "Bytes received from VI Servers",
+        ("vm", "viserver"),
+    ),
+}
+
+REPORTER = None
+
+
+class Metrics(object):
+    """Counters, gauges and latency histograms of a virtual BMC.
+
+    Values are kept by metric name and tuple of label values, as listed in
+    METRICS. A histogram is a list of the counts of each bucket of
+    BUCKETS, then of the values above them, then the sum of the values.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = collections.defaultdict(dict)
+        self.changed = False
+
+    def add(self, name, labels, value=1):
+        with self._lock:
+            values = self._values[name]
+            values[labels] = values.get(labels, 0) + value
+            self.changed = True
+
+    def observe(self, name, labels, seconds):
+        with self._lock:
+            values = self._values[name]
+            histogram = values.get(labels)
+            if histogram is None:
+                histogram = values[labels] = [0] * (len(BUCKETS) + 2)
+            histogram[bisect.bisect_left(BUCKETS, seconds)] += 1
+            histogram[-1] += seconds
+            self.changed = True
+
+    def snapshot(self):
+        """Return a copy of the values, as plain dicts and lists."""
+        with self._lock:
+            self.changed = False
+            return {
+                name: {
+                    labels: list(value) if isinstance(value, list) else value
+                    for labels, value in values.items()
+                }
+                for name, values in self._values.items()
+            }
+
+
+class _Reporter(object):
+    """Has the sources of metrics of a process report the ones changed."""
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self._sources = weakref.WeakSet()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def add(self, source):
+        with self._lock:
+            self._sources.add(source)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="vbmcd-metrics", daemon=True
+                )
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(REPORT_INTERVAL)
+            with self._lock:
+                sources = list(self._sources)
+            for source in sources:
+                try:
+                    source.report_metrics()
+                except Exception as e:
+                    LOG.debug("Unable to report metrics: %(error)s", {"error": e})
+
+
+def report(source):
+    """Call `source.report_metrics()` every REPORT_INTERVAL seconds.
+
+    Only a weak reference to `source` is kept. Each process has a thread
+    of its own for this, started on first use.
+    """
+    global REPORTER
+    if REPORTER is None or REPORTER.pid != os.getpid():
+        REPORTER = _Reporter()
+    REPORTER.add(source)
+
+
+def _label_value(value):
+    if isinstance(value, int):
+        # netfn and command
+        return "0x%02x" % value
+    return (
+        str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+    )
+
+
+def _series(name, labels, values, extra=""):
+    pairs = [
+        '%s="%s"' % (label, _label_value(value)) for label, value in zip(labels, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return name
+    return "%s{%s}" % (name, ",".join(pairs))
+
+
+def render(snapshots):
+    """Return the sum of the snapshots in the Prometheus text format."""
+    combined = collections.defaultdict(dict)
+    for snapshot in snapshots:
+        for name, values in snapshot.items():
+            for labels, value in values.items():
+                total = combined[name].get(labels)
+                if total is None:
+                    combined[name][labels] = (
+                        list(value) if isinstance(value, list) else value
+                    )
+                elif isinstance(value, list):
+                    for index, count in enumerate(value):
+                        total[index] += count
+                else:
+                    combined[name][labels] = total + value
+
+    lines = []
+    for name, (kind, description, label_names) in METRICS.items():
+        lines.append("# HELP %s %s" % (name, description))
+        lines.append("# TYPE %s %s" % (name, kind))
+        for labels, value in sorted(combined.get(name, {}).items()):
+            if kind != "histogram":
+                lines.append("%s %s" % (_series(name, label_names, labels), value))
+                continue
+
+            count = 0
+            for bound, bucket in zip(BUCKETS + ("+Inf",), value[:-1]):
+                count += bucket
+                lines.append(
+                    "%s %d"
+                    % (
+                        _series(
+                            name + "_bucket", label_names, labels, 'le="%s"' % bound
+                        ),
+                        count,
+                    )
+                )
+            lines.append(
+                "%s %r" % (_series(name + "_sum", label_names, labels), value[-1])
+            )
+            lines.append(
+                "%s %d" % (_series(name + "_count", label_names, labels), count)
+            )
+
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+
+        body = render(self.server.collect()).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        LOG.debug("Metrics request: " + format, *args)
+
+
+def serve(port, collect):
+    """Serve the snapshots returned by `collect()` on 127.0.0.1:`port`.
+
+    Returns the server, to be stopped with `shutdown()`.
+    """
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), _MetricsHandler)
+    server.daemon_threads = True
+    server.collect = collect
+    thread = threading.Thread(
+        target=server.serve_forever, name="vbmcd-metrics-server", daemon=True
+    )
+    thread.start()
+    return server
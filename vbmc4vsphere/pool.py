@@ -0,0 +1,320 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import http.client
+import ssl
+import threading
+import time
+
+from pyVim.connect import Disconnect, SmartConnect
+from pyVmomi import vim
+
+from vbmc4vsphere import config as vbmc_config
+from vbmc4vsphere import exception, log
+
+__all__ = ["get_pool", "retry_expired", "viserver_open"]
+
+LOG = log.get_logger()
+
+CONF = vbmc_config.get_config()
+
+POOL = None
+
+# Bytes received from VI Servers by the current thread since the last reset
+_TRANSFER = threading.local()
+
+
+class _CountingReader(object):
+    """Socket file wrapper which counts the bytes read through it."""
+
+    def __init__(self, fp):
+        self._fp = fp
+
+    def _count(self, size):
+        if size:
+            _TRANSFER.bytes = getattr(_TRANSFER, "bytes", 0) + size
+
+    def read(self, *args):
+        data = self._fp.read(*args)
+        self._count(len(data))
+        return data
+
+    def read1(self, *args):
+        data = self._fp.read1(*args)
+        self._count(len(data))
+        return data
+
+    def readline(self, *args):
+        data = self._fp.readline(*args)
+        self._count(len(data))
+        return data
+
+    def readinto(self, buffer):
+        size = self._fp.readinto(buffer)
+        self._count(size)
+        return size
+
+    def __getattr__(self, name):
+        return getattr(self._fp, name)
+
+
+class _CountingResponse(http.client.HTTPResponse):
+    def __init__(self, *args, **kwargs):
+        super(_CountingResponse, self).__init__(*args, **kwargs)
+        self.fp = _CountingReader(self.fp)
+
+
+def _count_transfers(conn):
+    """Make the SOAP stub of a connection account for received bytes."""
+    stub = getattr(conn, "_stub", None)
+    stub = getattr(stub, "soapStub", stub)
+    scheme = getattr(stub, "scheme", None)
+    if not (
+        isinstance(scheme, type) and issubclass(scheme, http.client.HTTPConnection)
+    ):
+        return
+
+    stub.scheme = type(
+        scheme.__name__, (scheme,), {"response_class": _CountingResponse}
+    )
+    # Pooled HTTP connections were created with the previous scheme
+    stub.DropConnections()
+
+
+class ViServerSession(object):
+    """Authenticated, long-lived connection to a VI Server.
+
+    The underlying `ServiceInstance` is shared by every caller using the
+    same VI Server and username. `generation` is bumped on every login,
+    and the objects bound to the server-side session (property collectors,
+    filters and so on) are kept per login, see `get_object`.
+    """
+
+    def __init__(self, vi, vi_username=None, vi_password=None):
+        self.vi = vi
+        self.vi_username = vi_username
+        self.vi_password = vi_password
+        self.conn = None
+        # Every access to `ServiceInstance.content` is a round trip to the
+        # VI Server, while the service content never changes during a login
+        self.content = None
+        self.generation = 0
+        self.last_checked = 0
+        self.lock = threading.RLock()
+        self._objects = {}
+        self._objects_lock = threading.Lock()
+
+    def connect(self):
+        context = None
+        if hasattr(ssl, "_create_unverified_context"):
+            context = ssl._create_unverified_context()
+        try:
+            conn = SmartConnect(
+                host=self.vi,
+                user=self.vi_username,
+                pwd=self.vi_password,
+                sslContext=context,
+            )
+            if not conn:
+                raise Exception
+            content = conn.RetrieveContent()
+        except Exception as e:
+            raise exception.VIServerConnectionOpenError(vi=self.vi, error=e)
+
+        _count_transfers(conn)
+
+        with self._objects_lock:
+            self._objects = {}
+        self.conn = conn
+        self.content = content
+        self.generation += 1
+        self.last_checked = time.monotonic()
+
+        LOG.debug(
+            "Logged in to VI Server %(vi)s as %(user)s (generation %(gen)d)",
+            {"vi": self.vi, "user": self.vi_username, "gen": self.generation},
+        )
+
+    def get_object(self, name, factory, stale=None):
+        """Return the object `name` of the current login.
+
+        It is made by `factory(self)` on first use, and again when
+        `stale(obj)` tells the previous one can no longer be used. Objects
+        are never shared between logins, nor between sessions: `pyVmomi`
+        managed objects all compare equal, whatever their server.
+        """
+        with self._objects_lock:
+            obj = self._objects.get(name)
+            if obj is None or (stale is not None and stale(obj)):
+                obj = self._objects[name] = factory(self)
+        return obj
+
+    def is_alive(self):
+        try:
+            return self.content.sessionManager.currentSession is not None
+        except Exception:
+            return False
+
+    def disconnect(self):
+        with self._objects_lock:
+            self._objects = {}
+        if self.conn is None:
+            return
+        try:
+            Disconnect(self.conn)
+        except Exception as e:
+            LOG.debug(
+                "Error logging out from VI Server %(vi)s: %(error)s",
+                {"vi": self.vi, "error": e},
+            )
+        self.conn = None
+
+
+class ViServerPool(object):
+    """Pool of VI Server sessions keyed by (viserver, username).
+
+    Sessions are logged in on first use and kept open afterwards. A session
+    which has been idle for longer than `session_check_interval` seconds is
+    checked before being handed out, and is logged in again if vCenter has
+    expired it in the meantime.
+    """
+
+    def __init__(self, check_interval):
+        self.check_interval = check_interval
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, vi, vi_username=None, vi_password=None):
+        """Return a logged in session, and how it was obtained.
+
+        The latter is "hit" for a session already logged in, "miss" for
+        the first login and "relogin" for a session logged in again.
+        """
+        key = (vi, vi_username)
+        stale = None
+
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None or session.vi_password != vi_password:
+                stale = session
+                session = ViServerSession(vi, vi_username, vi_password)
+                self._sessions[key] = session
+
+        if stale is not None:
+            with stale.lock:
+                stale.disconnect()
+
+        with session.lock:
+            now = time.monotonic()
+
+            if session.conn is None:
+                # Either never logged in, or rejected by the VI Server
+                outcome = "miss" if session.generation == 0 else "relogin"
+                session.connect()
+
+            elif now - session.last_checked > self.check_interval:
+                if session.is_alive():
+                    outcome = "hit"
+                    session.last_checked = now
+                else:
+                    LOG.info(
+                        "Session for VI Server %(vi)s has expired, logging in "
+                        "again",
+                        {"vi": vi},
+                    )
+                    outcome = "relogin"
+                    session.connect()
+
+            else:
+                outcome = "hit"
+
+        return session, outcome
+
+    def invalidate(self, session, conn):
+        """Forget the login of a session rejected by the VI Server.
+
+        Unless it has been logged in again since `conn` was handed out.
+        """
+        with session.lock:
+            if session.conn is conn:
+                session.conn = None
+
+    def close(self):
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions.clear()
+
+        for session in sessions:
+            with session.lock:
+                session.disconnect()
+
+
+def get_pool():
+    global POOL
+    if POOL is None:
+        POOL = ViServerPool(CONF["vsphere"]["session_check_interval"])
+
+    return POOL
+
+
+class viserver_open(object):
+    """Borrow a pooled session of the VI Server.
+
+    The session is shared with other callers and stays logged in after
+    the block exits. If the VI Server rejects the session, it is logged in
+    again on the next use, see `retry_expired`. `outcome` tells how the
+    session was obtained, as returned by `ViServerPool.acquire`, and
+    `bytes_received` how much the block received from the VI Server.
+    """
+
+    def __init__(self, vi, vi_username=None, vi_password=None, readonly=False):
+        self.vi = vi
+        self.vi_username = vi_username
+        self.vi_password = vi_password
+        self.readonly = readonly
+
+    def __enter__(self):
+        _TRANSFER.bytes = 0
+        self.session, self.outcome = get_pool().acquire(
+            self.vi, self.vi_username, self.vi_password
+        )
+        self.conn = self.session.conn
+        return self.session
+
+    def __exit__(self, type, value, traceback):
+        self.bytes_received = getattr(_TRANSFER, "bytes", 0)
+        LOG.debug(
+            "Received %(bytes)d bytes from VI Server %(vi)s",
+            {"bytes": self.bytes_received, "vi": self.vi},
+        )
+
+        if isinstance(value, vim.fault.NotAuthenticated):
+            get_pool().invalidate(self.session, self.conn)
+
+
+def retry_expired(func, *args, **kwargs):
+    """Call `func`, and once more if the VI Server expired a session.
+
+    A session expired less than `session_check_interval` seconds after its
+    last check is only found out by a call failing with NotAuthenticated.
+    `viserver_open` then forgets its login, so that `func`, borrowing the
+    session again, logs in again.
+    """
+    try:
+        return func(*args, **kwargs)
+    except vim.fault.NotAuthenticated as e:
+        LOG.info(
+            "Session for VI Server expired during a call, logging in again "
+            "and retrying. Error: %(error)s",
+            {"error": e.msg},
+        )
+        return func(*args, **kwargs)
@@ -0,0 +1,150 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import collections
+import ipaddress
+
+from vbmc4vsphere import exception, log
+
+__all__ = ["PortIndex"]
+
+LOG = log.get_logger()
+
+DEFAULT_ADDRESS = "::"
+
+# Port of the VMs added without one when there is no range to pick from
+DEFAULT_PORT = 6230
+
+# Addresses which bind a port on every interface
+WILDCARD_ADDRESSES = frozenset(["::", "0.0.0.0"])
+
+
+def _canonical(address):
+    if not address:
+        return DEFAULT_ADDRESS
+    try:
+        return ipaddress.ip_address(address).compressed
+    except ValueError:
+        # A host name, compared as it is
+        return address.lower()
+
+
+class PortIndex(object):
+    """The (address, port) pairs allocated to virtual BMCs.
+
+    Two VMs conflict when they use the same port on the same address, or
+    when either of them binds the port on every address. Ports are handed
+    out from `port_range`, a `(first, last)` tuple or None, lowest first
+    on start and then in the order they are freed.
+    """
+
+    def __init__(self, port_range=None):
+        self.port_range = port_range
+        # VMs by port, with the address they bind
+        self._by_port = collections.defaultdict(dict)
+        self._by_vm = {}
+        # Ports of the range which were free when queued; the ones taken
+        # since are skipped when they reach the head
+        self._free = collections.deque()
+        self._queued = set()
+        if port_range is not None:
+            self._free.extend(range(port_range[0], port_range[1] + 1))
+            self._queued.update(self._free)
+
+    def _in_range(self, port):
+        return (
+            self.port_range is not None
+            and self.port_range[0] <= port <= self.port_range[1]
+        )
+
+    def owner(self, address, port, vm_name=None):
+        """Return a VM other than `vm_name` conflicting with the pair."""
+        address = _canonical(address)
+        for other, other_address in self._by_port.get(port, {}).items():
+            if other == vm_name:
+                continue
+            if (
+                other_address == address
+                or address in WILDCARD_ADDRESSES
+                or other_address in WILDCARD_ADDRESSES
+            ):
+                return other
+
+        return None
+
+    def next_free(self):
+        """Return the first queued port nobody uses, on any address."""
+        while self._free and self._free[0] in self._by_port:
+            self._queued.discard(self._free.popleft())
+
+        if not self._free:
+            raise exception.NoFreePort(range="%d-%d" % self.port_range)
+
+        return self._free[0]
+
+    def claim(self, bmc_config):
+        """Return `bmc_config` with a port assigned if it has none.
+
+        Raises PortInUse if the pair is taken by another VM. The pair is
+        recorded by `set`, once the config is stored.
+        """
+        if bmc_config.get("port") is None:
+            port = DEFAULT_PORT if self.port_range is None else self.next_free()
+            bmc_config = dict(bmc_config, port=port)
+
+        port = int(bmc_config["port"])
+        other = self.owner(bmc_config.get("address"), port, bmc_config["vm_name"])
+        if other is not None:
+            raise exception.PortInUse(
+                address=bmc_config.get("address") or DEFAULT_ADDRESS,
+                port=port,
+                vm=other,
+            )
+
+        return bmc_config
+
+    def set(self, vm_name, address, port):
+        """Record the pair used by a VM, replacing the previous one."""
+        address = _canonical(address)
+        if self._by_port.get(port, {}).get(vm_name) == address:
+            return
+
+        self.discard(vm_name)
+
+        other = self.owner(address, port, vm_name)
+        if other is not None:
+            LOG.warning(
+                "vBMC of vm %(vm)s uses port %(port)d on %(address)s "
+                "like the one of vm %(other)s",
+                {
+                    "vm": vm_name,
+                    "port": port,
+                    "address": address,
+                    "other": other,
+                },
+            )
+
+        self._by_port[port][vm_name] = address
+        self._by_vm[vm_name] = port
+
+    def discard(self, vm_name):
+        port = self._by_vm.pop(vm_name, None)
+        if port is None:
+            return
+
+        vms = self._by_port[port]
+        vms.pop(vm_name, None)
+        if not vms:
+            del self._by_port[port]
+            if self._in_range(port) and port not in self._queued:
+                self._free.append(port)
+                self._queued.add(port)
@@ -0,0 +1,147 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import collections
+import threading
+import time
+
+from vbmc4vsphere import log
+
+__all__ = ["ReplayCache"]
+
+LOG = log.get_logger()
+
+# Requests remembered per IPMI session. Clients have a single request
+# outstanding, so only the last few can be retransmitted; keeping few of
+# them also prevents a reused 6-bit sequence number from being mistaken
+# for a retransmission.
+HISTORY = 4
+
+
+class _Recorder(object):
+    """Session wrapper which remembers the responses sent through it."""
+
+    def __init__(self, session):
+        self._session = session
+        self.responses = []
+
+    def send_ipmi_response(self, data=[], code=0):
+        self._send_ipmi_net_payload(data=data, code=code)
+
+    def _send_ipmi_net_payload(self, **kwargs):
+        self.responses.append(kwargs)
+        self._session._send_ipmi_net_payload(**kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._session, name)
+
+
+class _Entry(object):
+    def __init__(self):
+        self.responses = None
+        self.created = time.monotonic()
+
+
+class ReplayCache(object):
+    """Answers retransmitted IPMI requests without running them again.
+
+    A request is identified by its session, sequence number, netfn,
+    command and data. A copy arriving within `window` seconds either gets
+    the responses recorded for the first one, or, if that one is still
+    being handled, is dropped: the response to the original carries the
+    same sequence number and satisfies the client.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self._lock = threading.Lock()
+        # Least recently used first
+        self._sessions = collections.OrderedDict()
+        self._stats = {"replayed": 0, "attached": 0}
+
+    def _expire(self, entries, now):
+        while entries:
+            key, entry = next(iter(entries.items()))
+            if len(entries) <= HISTORY and now - entry.created <= self.window:
+                break
+            del entries[key]
+
+    def _entries(self, session, now):
+        # Every ipmitool invocation opens a session of its own, forget the
+        # ones which have not been used within the window
+        while self._sessions:
+            ident, entries = next(iter(self._sessions.items()))
+            self._expire(entries, now)
+            if entries:
+                break
+            del self._sessions[ident]
+
+        ident = (session.sockaddr, session.localsid)
+        entries = self._sessions.pop(ident, None)
+        if entries is None:
+            entries = collections.OrderedDict()
+        self._sessions[ident] = entries
+        self._expire(entries, now)
+        return entries
+
+    def run(self, request, session, handler):
+        """Call `handler(request, session)` unless the request is a copy."""
+        if self.window <= 0:
+            return handler(request, session)
+
+        key = (
+            session.seqlun,
+            request["netfn"],
+            request["command"],
+            bytes(request["data"]),
+        )
+
+        with self._lock:
+            entries = self._entries(session, time.monotonic())
+            entry = entries.get(key)
+            if entry is None:
+                entry = entries[key] = _Entry()
+            elif entry.responses is None:
+                self._stats["attached"] += 1
+                LOG.debug(
+                    "Request netfn 0x%(netfn)x command 0x%(cmd)x seq "
+                    "%(seq)d is still being handled, ignoring copy",
+                    {"netfn": key[1], "cmd": key[2], "seq": key[0]},
+                )
+                return
+            else:
+                self._stats["replayed"] += 1
+                responses = entry.responses
+                entry = None
+
+        if entry is None:
+            LOG.debug(
+                "Replaying response to netfn 0x%(netfn)x command 0x%(cmd)x "
+                "seq %(seq)d",
+                {"netfn": key[1], "cmd": key[2], "seq": key[0]},
+            )
+            for response in responses:
+                session._send_ipmi_net_payload(**response)
+            return
+
+        recorder = _Recorder(session)
+        try:
+            return handler(request, recorder)
+        finally:
+            with self._lock:
+                entry.responses = recorder.responses
+                # Retransmissions are timed from the original's answer
+                entry.created = time.monotonic()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
@@ -0,0 +1,313 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import hashlib
+import multiprocessing
+import signal
+import sys
+import threading
+
+from vbmc4vsphere import engine, log, pool
+
+__all__ = ["ShardedEngine", "shard_of"]
+
+LOG = log.get_logger()
+
+# Seconds to wait for a worker to acknowledge a command
+COMMAND_TIMEOUT = 30
+
+
+def shard_of(vm_name, shards):
+    """Return the worker serving a VM.
+
+    The hash does not depend on other VMs, so adding or removing a VM never
+    moves another one.
+    """
+    digest = hashlib.sha1(vm_name.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % shards
+
+
+def _worker_main(index, conn, workers, timeout):
+    # Unwind the stack on SIGTERM so that pooled sessions are logged out
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+
+    send_lock = threading.Lock()
+
+    def send(message):
+        with send_lock:
+            conn.send(message)
+
+    def notify(vm_name, event, **data):
+        data.update(vm_name=vm_name, event=event)
+        send(("status", data))
+
+    shard = engine.Engine(workers, timeout=timeout)
+    shard.start()
+    hosted = {}
+
+    try:
+        while True:
+            try:
+                command, vm_name, bmc_config = conn.recv()
+            except EOFError:
+                break
+
+            if command == "add":
+                entry = shard.add(
+                    bmc_config,
+                    notify=lambda event, _vm=vm_name, **data: notify(
+                        _vm, event, **data
+                    ),
+                )
+                if entry.is_alive():
+                    hosted[vm_name] = entry
+                    send(("added", vm_name, None))
+                else:
+                    send(("added", vm_name, str(entry.error)))
+
+            elif command == "remove":
+                entry = hosted.pop(vm_name, None)
+                if entry is not None:
+                    entry.terminate()
+                send(("removed", vm_name, None))
+
+    finally:
+        shard.stop()
+        pool.get_pool().close()
+        # The process ends without running atexit handlers
+        LOG.flush()
+
+
+class _Worker(object):
+    """Parent side of a worker process and the BMCs of its shard."""
+
+    def __init__(self, index):
+        self.index = index
+        self.process = None
+        self.conn = None
+        self._reader = None
+        self.restarts = 0
+        self.hosted = {}
+        self.notify = {}
+        self._replies = {}
+        self._lock = threading.Lock()
+
+    def is_alive(self):
+        return self.process is not None and self.process.is_alive()
+
+    def start(self, workers, timeout):
+        if self.process is not None:
+            self.restarts += 1
+            LOG.warning(
+                "Restarting vBMC worker %(index)d (rc %(rc)s), serving "
+                "%(count)d vBMC(s)",
+                {
+                    "index": self.index,
+                    "rc": self.process.exitcode,
+                    "count": len(self.hosted),
+                },
+            )
+
+        if self.conn is not None:
+            # The reader of the previous process stops at the end of the
+            # pipe, which came with the exit, and fails the calls left
+            # pending. Only then may the pipe be closed, or its descriptor
+            # be reused by the new one while still being read from.
+            self._reader.join()
+            self.conn.close()
+
+        parent_conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            name="vbmcd-worker-%d" % self.index,
+            target=_worker_main,
+            args=(self.index, child_conn, workers, timeout),
+        )
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+
+        self.conn = parent_conn
+        # Whatever was served by the previous process is gone
+        self.hosted.clear()
+
+        self._reader = threading.Thread(
+            target=self._read,
+            args=(parent_conn,),
+            name="vbmcd-worker-%d-reader" % self.index,
+            daemon=True,
+        )
+        self._reader.start()
+
+    def _read(self, conn):
+        while True:
+            try:
+                kind, *message = conn.recv()
+            except (EOFError, OSError):
+                break
+
+            if kind == "status":
+                data = message[0]
+                notify = self.notify.get(data.pop("vm_name"))
+                if notify is not None:
+                    notify(**data)
+                continue
+
+            vm_name, error = message
+            with self._lock:
+                reply = self._replies.pop((kind, vm_name), None)
+            if reply is not None:
+                reply["error"] = error
+                reply["done"].set()
+
+        # Wake up whoever waits for a reply from the dead worker
+        with self._lock:
+            replies = list(self._replies.values())
+            self._replies.clear()
+        for reply in replies:
+            reply["error"] = "vBMC worker %d exited" % self.index
+            reply["done"].set()
+
+    def call(self, command, vm_name, bmc_config=None):
+        reply = {"done": threading.Event(), "error": None}
+        key = ("added" if command == "add" else "removed", vm_name)
+        with self._lock:
+            self._replies[key] = reply
+        try:
+            self.conn.send((command, vm_name, bmc_config))
+            if not reply["done"].wait(COMMAND_TIMEOUT):
+                raise TimeoutError("no answer")
+        except (OSError, ValueError) as e:
+            with self._lock:
+                self._replies.pop(key, None)
+            LOG.error(
+                "Unable to %(cmd)s vm %(vm)s on vBMC worker %(index)d: %(error)s",
+                {"cmd": command, "vm": vm_name, "index": self.index, "error": e},
+            )
+            return str(e)
+
+        return reply["error"]
+
+
+class ShardedBMC(engine.HostedBMC):
+    """A BMC served by one of the workers of a `ShardedEngine`."""
+
+    def __init__(self, engine, vm_name, worker, error=None):
+        super(ShardedBMC, self).__init__(engine, vm_name, error=error)
+        self.worker = worker
+        self.process = worker.process
+
+    @property
+    def exitcode(self):
+        if self.is_alive():
+            return None
+        if self.error is None and self.process.exitcode is not None:
+            return self.process.exitcode
+        return 1
+
+    def is_alive(self):
+        return self.error is None and self.engine.is_serving(self)
+
+
+class ShardedEngine(object):
+    """Spreads virtual BMCs over a fixed number of worker processes.
+
+    Each worker runs an `engine.Engine` for the VMs hashed to it. A worker
+    which dies is started again the next time one of its VMs is added,
+    which the manager does for every enabled VM found not running, so that
+    only the shard of the dead worker is affected.
+    """
+
+    def __init__(self, processes, workers, timeout=1):
+        self.workers = workers
+        self.timeout = timeout
+        self._lock = threading.RLock()
+        self._shards = [_Worker(index) for index in range(processes)]
+
+    def start(self):
+        for worker in self._shards:
+            worker.start(self.workers, self.timeout)
+
+    def add(self, bmc_config, notify=None):
+        vm_name = bmc_config["vm_name"]
+        worker = self._shards[shard_of(vm_name, len(self._shards))]
+
+        with self._lock:
+            if not worker.is_alive():
+                worker.start(self.workers, self.timeout)
+
+        if notify is not None:
+            worker.notify[vm_name] = notify
+        # Errors are logged by the worker, or by the call
+        error = worker.call("add", vm_name, bmc_config)
+        if error is not None:
+            return ShardedBMC(self, vm_name, worker, error=error)
+
+        hosted = ShardedBMC(self, vm_name, worker)
+        with self._lock:
+            worker.hosted[vm_name] = hosted
+        return hosted
+
+    def is_serving(self, hosted):
+        worker = hosted.worker
+        with self._lock:
+            return worker.is_alive() and worker.hosted.get(hosted.vm_name) is hosted
+
+    def remove(self, hosted):
+        worker = hosted.worker
+        with self._lock:
+            if worker.hosted.get(hosted.vm_name) is not hosted:
+                return
+            del worker.hosted[hosted.vm_name]
+        worker.notify.pop(hosted.vm_name, None)
+
+        if worker.is_alive():
+            worker.call("remove", hosted.vm_name)
+
+    def sentinels(self):
+        """Return the sentinels of the worker processes which are alive."""
+        with self._lock:
+            return [
+                worker.process.sentinel for worker in self._shards if worker.is_alive()
+            ]
+
+    def reap(self, sentinel):
+        """Wait for the worker process whose sentinel became ready."""
+        with self._lock:
+            processes = [
+                worker.process
+                for worker in self._shards
+                if worker.process is not None and worker.process.sentinel == sentinel
+            ]
+        for process in processes:
+            process.join(timeout=1)
+
+    def load(self):
+        """Return the state and number of BMCs of every worker."""
+        with self._lock:
+            return [
+                {
+                    "worker": worker.index,
+                    "pid": worker.process.pid if worker.process else None,
+                    "alive": worker.is_alive(),
+                    "bmcs": len(worker.hosted),
+                    "restarts": worker.restarts,
+                }
+                for worker in self._shards
+            ]
+
+    def stop(self):
+        for worker in self._shards:
+            if worker.is_alive():
+                worker.process.terminate()
+        for worker in self._shards:
+            if worker.process is not None:
+                worker.process.join(COMMAND_TIMEOUT)
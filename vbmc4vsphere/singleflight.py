@@ -0,0 +1,138 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import collections
+import functools
+import threading
+
+__all__ = ["Group", "coalesced"]
+
+
+class _Call(object):
+    def __init__(self, key):
+        self.key = key
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.shared = 0
+
+    def run(self, fn, args, kwargs):
+        try:
+            self.result = fn(*args, **kwargs)
+        except BaseException as e:
+            self.error = e
+        finally:
+            self.done.set()
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class Group(object):
+    """Coalesces concurrent identical calls made on behalf of one VM.
+
+    `do` is meant for reads: a caller arriving while a call with the same
+    key is in flight waits for it and gets its result, or its exception,
+    instead of issuing another one.
+
+    `do_serial` is meant for mutations. They run one at a time, in arrival
+    order. A caller only joins a queued call with the same key when that
+    call is the last one queued; `power_on` arriving after `power_off` was
+    queued behind an earlier `power_on` gets a call of its own.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reads = {}
+        self._queue = collections.deque()
+        self._turn = threading.Condition(self._lock)
+        self._stats = {"calls": 0, "shared": 0}
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            self._stats["calls"] += 1
+            call = self._reads.get(key)
+            if call is not None:
+                call.shared += 1
+                self._stats["shared"] += 1
+                follower = True
+            else:
+                call = self._reads[key] = _Call(key)
+                follower = False
+
+        if follower:
+            return call.wait()
+
+        try:
+            call.run(fn, args, kwargs)
+        finally:
+            with self._lock:
+                del self._reads[key]
+
+        return call.wait()
+
+    def do_serial(self, key, fn, *args, **kwargs):
+        with self._lock:
+            self._stats["calls"] += 1
+            if self._queue and self._queue[-1].key == key:
+                call = self._queue[-1]
+                call.shared += 1
+                self._stats["shared"] += 1
+                follower = True
+            else:
+                call = _Call(key)
+                self._queue.append(call)
+                follower = False
+
+            if not follower:
+                while self._queue[0] is not call:
+                    self._turn.wait()
+
+        if follower:
+            return call.wait()
+
+        try:
+            call.run(fn, args, kwargs)
+        finally:
+            with self._lock:
+                self._queue.popleft()
+                self._turn.notify_all()
+
+        return call.wait()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+
+def coalesced(serial=False):
+    """Route a method through the `flights` Group of its instance.
+
+    Calls are keyed on the method name and positional arguments, so that
+    e.g. `set_boot_device("network")` and `set_boot_device("hd")` are
+    distinct. Mutations should pass `serial=True`.
+    """
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(self, *args):
+            key = (fn.__name__,) + args
+            if serial:
+                return self.flights.do_serial(key, fn, self, *args)
+            return self.flights.do(key, fn, self, *args)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,465 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import collections
+import configparser
+import contextlib
+import os
+import shutil
+import sqlite3
+
+from vbmc4vsphere import config as vbmc_config
+from vbmc4vsphere import exception, log, ports, utils
+
+__all__ = ["DirectoryStore", "SQLiteStore", "get_store"]
+
+LOG = log.get_logger()
+
+CONF = vbmc_config.get_config()
+
+STORE = None
+
+DEFAULT_SECTION = "VirtualBMC"
+
+VBMC_OPTIONS = [
+    "username",
+    "password",
+    "address",
+    "port",
+    "fakemac",
+    "vm_name",
+    "vm_uuid",
+    "viserver",
+    "viserver_username",
+    "viserver_password",
+    "active",
+    # Name of the discovery which added the VM, if any
+    "discovery",
+]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS vbmc (
+    vm_name TEXT PRIMARY KEY,
+    username TEXT,
+    password TEXT,
+    address TEXT,
+    port INTEGER NOT NULL,
+    fakemac TEXT,
+    vm_uuid TEXT,
+    viserver TEXT,
+    viserver_username TEXT,
+    viserver_password TEXT,
+    active TEXT,
+    discovery TEXT
+);
+CREATE INDEX IF NOT EXISTS vbmc_address_port ON vbmc (address, port);
+CREATE INDEX IF NOT EXISTS vbmc_active ON vbmc (active);
+"""
+
+
+def _normalize(bmc_config):
+    """Return a config as it reads back from the store."""
+    bmc = {}
+    for item in VBMC_OPTIONS:
+        value = bmc_config.get(item)
+        if value is not None:
+            value = int(value) if item == "port" else str(value)
+        bmc[item] = value
+
+    # Generate Fake MAC if needed
+    if bmc["fakemac"] is None:
+        bmc["fakemac"] = utils.generate_fakemac_by_vm_name(bmc["vm_name"])
+
+    return bmc
+
+
+class DirectoryStore(object):
+    """Configs of virtual BMCs in `<config_dir>/<vm_name>/config` files.
+
+    The files are read once and kept in memory. VMs added or removed
+    outside of vsbmc are noticed by the mtime of `config_dir`, and edited
+    config files by looking at a few of them at a time.
+    """
+
+    def __init__(self, config_dir, port_range=None):
+        self.config_dir = config_dir
+        self.ports = ports.PortIndex(port_range)
+        self._configs = {}
+        # (mtime, size) of the files the configs were read from
+        self._stats = {}
+        self._vm_dirs = set()
+        self._dir_mtime = None
+        # VMs whose config file is checked for edits, in turn
+        self._sweep = collections.deque()
+        self._changed = set()
+        self._scan()
+
+    def _config_path(self, vm_name):
+        return os.path.join(self.config_dir, vm_name, "config")
+
+    def _stat(self, vm_name):
+        try:
+            stat = os.stat(self._config_path(vm_name))
+        except OSError:
+            return None
+
+        return stat.st_mtime_ns, stat.st_size
+
+    def _parse(self, vm_name):
+        config_path = self._config_path(vm_name)
+        if not os.path.exists(config_path):
+            raise exception.VMNotFound(vm=vm_name)
+
+        try:
+            config = configparser.ConfigParser()
+            config.read(config_path)
+
+            bmc = {}
+            for item in VBMC_OPTIONS:
+                try:
+                    value = config.get(DEFAULT_SECTION, item)
+                except configparser.NoOptionError:
+                    value = None
+
+                bmc[item] = value
+
+            # Generate Fake MAC if needed
+            if bmc["fakemac"] is None:
+                bmc["fakemac"] = utils.generate_fakemac_by_vm_name(vm_name)
+
+            # Port needs to be int
+            bmc["port"] = config.getint(DEFAULT_SECTION, "port")
+
+            return bmc
+
+        except OSError:
+            raise exception.VMNotFound(vm=vm_name)
+
+    def _write(self, options):
+        config = configparser.ConfigParser()
+        config.add_section(DEFAULT_SECTION)
+
+        for option, value in options.items():
+            if value is not None:
+                config.set(DEFAULT_SECTION, option, str(value))
+
+        with open(self._config_path(options["vm_name"]), "w") as f:
+            config.write(f)
+
+        self._load(options["vm_name"], force=True)
+
+    def _load(self, vm_name, force=False):
+        """Update the config of a VM if its file has changed."""
+        stat = self._stat(vm_name)
+        if not force and stat == self._stats.get(vm_name):
+            return
+
+        try:
+            if stat is None:
+                raise exception.VMNotFound(vm=vm_name)
+            bmc_config = self._parse(vm_name)
+
+        except exception.VMNotFound:
+            self._forget(vm_name)
+            return
+
+        except (configparser.Error, ValueError) as ex:
+            # Possibly caught in the middle of an edit, look again later
+            LOG.warning(
+                "Ignoring invalid config of vm %(vm)s: %(error)s",
+                {"vm": vm_name, "error": ex},
+            )
+            return
+
+        self._configs[vm_name] = bmc_config
+        self._stats[vm_name] = stat
+        self.ports.set(vm_name, bmc_config["address"], bmc_config["port"])
+        self._vm_dirs.add(vm_name)
+        self._changed.add(vm_name)
+
+    def _forget(self, vm_name):
+        if self._configs.pop(vm_name, None) is not None:
+            self._changed.add(vm_name)
+        self._stats.pop(vm_name, None)
+        self.ports.discard(vm_name)
+
+    def _scan(self):
+        try:
+            mtime = os.stat(self.config_dir).st_mtime_ns
+        except OSError:
+            mtime = None
+
+        if mtime is not None and mtime == self._dir_mtime:
+            return
+
+        self._dir_mtime = mtime
+        try:
+            vm_dirs = {
+                vm_name
+                for vm_name in os.listdir(self.config_dir)
+                if os.path.isdir(os.path.join(self.config_dir, vm_name))
+            }
+        except OSError:
+            vm_dirs = set()
+
+        for vm_name in self._vm_dirs - vm_dirs:
+            self._forget(vm_name)
+        for vm_name in vm_dirs - self._vm_dirs:
+            self._load(vm_name)
+        self._vm_dirs = vm_dirs
+
+    def refresh(self, batch):
+        """Return the VMs whose config changed since the last call.
+
+        Looks for VMs added or removed outside of vsbmc, and at `batch`
+        config files for edits.
+        """
+        self._scan()
+        for _ in range(min(batch, len(self._vm_dirs))):
+            if not self._sweep:
+                self._sweep.extend(self._vm_dirs)
+            vm_name = self._sweep.popleft()
+            if vm_name in self._vm_dirs:
+                self._load(vm_name)
+
+        changed, self._changed = self._changed, set()
+        return changed
+
+    def configs(self):
+        """Return the configs of all VMs by name, not to be modified."""
+        return self._configs
+
+    def get(self, vm_name):
+        self._load(vm_name)
+        try:
+            return dict(self._configs[vm_name])
+        except KeyError:
+            raise exception.VMNotFound(vm=vm_name)
+
+    def add(self, bmc_config):
+        vm_path = os.path.join(self.config_dir, bmc_config["vm_name"])
+        if os.path.exists(vm_path):
+            raise exception.VMAlreadyExists(vm=bmc_config["vm_name"])
+
+        bmc_config = self.ports.claim(bmc_config)
+        try:
+            os.makedirs(vm_path)
+        except FileExistsError:
+            raise exception.VMAlreadyExists(vm=bmc_config["vm_name"])
+
+        try:
+            self._write(bmc_config)
+        except Exception:
+            shutil.rmtree(vm_path, ignore_errors=True)
+            raise
+
+    def update(self, vm_name, **options):
+        bmc_config = self.get(vm_name)
+        bmc_config.update(options)
+        self._write(self.ports.claim(bmc_config))
+
+    def delete(self, vm_name):
+        vm_path = os.path.join(self.config_dir, vm_name)
+        if not os.path.exists(vm_path):
+            raise exception.VMNotFound(vm=vm_name)
+
+        shutil.rmtree(vm_path)
+        self._vm_dirs.discard(vm_name)
+        self._forget(vm_name)
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Group changes; every file is written on its own here."""
+        yield
+
+
+class SQLiteStore(object):
+    """Configs of virtual BMCs in a single SQLite database.
+
+    The table is read once and kept in memory. Changes committed by other
+    connections, e.g. the `sqlite3` shell, are noticed through
+    `PRAGMA data_version` and picked up by reading it again.
+    """
+
+    def __init__(self, path, port_range=None):
+        self.path = path
+        self.ports = ports.PortIndex(port_range)
+        self._db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.executescript(SCHEMA)
+        # Columns added since the database was created
+        columns = {row["name"] for row in self._db.execute("PRAGMA table_info(vbmc)")}
+        for item in VBMC_OPTIONS:
+            if item not in columns:
+                self._db.execute("ALTER TABLE vbmc ADD COLUMN %s TEXT" % item)
+        self._configs = {}
+        self._changed = set()
+        self._data_version = None
+        self._depth = 0
+        self._reload()
+
+    def _reload(self):
+        version = self._db.execute("PRAGMA data_version").fetchone()[0]
+        if version == self._data_version:
+            return
+
+        self._data_version = version
+        configs = {
+            row["vm_name"]: _normalize(dict(row))
+            for row in self._db.execute("SELECT * FROM vbmc")
+        }
+        for vm_name in configs.keys() | self._configs.keys():
+            bmc_config = configs.get(vm_name)
+            if bmc_config != self._configs.get(vm_name):
+                self._changed.add(vm_name)
+                if bmc_config is None:
+                    self.ports.discard(vm_name)
+                else:
+                    self.ports.set(vm_name, bmc_config["address"], bmc_config["port"])
+        self._configs = configs
+
+    def _write(self, sql, bmc_config):
+        bmc_config = _normalize(bmc_config)
+        with self.batch():
+            self._db.execute(sql, bmc_config)
+        self._configs[bmc_config["vm_name"]] = bmc_config
+        self._changed.add(bmc_config["vm_name"])
+        self.ports.set(
+            bmc_config["vm_name"], bmc_config["address"], bmc_config["port"]
+        )
+
+    def refresh(self, batch):
+        """Return the VMs whose config changed since the last call."""
+        self._reload()
+        changed, self._changed = self._changed, set()
+        return changed
+
+    def configs(self):
+        """Return the configs of all VMs by name, not to be modified."""
+        return self._configs
+
+    def get(self, vm_name):
+        self._reload()
+        try:
+            return dict(self._configs[vm_name])
+        except KeyError:
+            raise exception.VMNotFound(vm=vm_name)
+
+    def add(self, bmc_config):
+        self._reload()
+        if bmc_config["vm_name"] in self._configs:
+            raise exception.VMAlreadyExists(vm=bmc_config["vm_name"])
+
+        self._insert(self.ports.claim(bmc_config))
+
+    def _insert(self, bmc_config):
+        try:
+            self._write(
+                "INSERT INTO vbmc (%s) VALUES (%s)"
+                % (
+                    ", ".join(VBMC_OPTIONS),
+                    ", ".join(":%s" % item for item in VBMC_OPTIONS),
+                ),
+                bmc_config,
+            )
+        except sqlite3.IntegrityError:
+            raise exception.VMAlreadyExists(vm=bmc_config["vm_name"])
+
+    def update(self, vm_name, **options):
+        bmc_config = self.get(vm_name)
+        bmc_config.update(options)
+        bmc_config = self.ports.claim(bmc_config)
+        self._write(
+            "UPDATE vbmc SET %s WHERE vm_name = :vm_name"
+            % ", ".join("%s = :%s" % (item, item) for item in VBMC_OPTIONS),
+            bmc_config,
+        )
+
+    def delete(self, vm_name):
+        self._reload()
+        with self.batch():
+            cursor = self._db.execute("DELETE FROM vbmc WHERE vm_name = ?", (vm_name,))
+        if not cursor.rowcount:
+            raise exception.VMNotFound(vm=vm_name)
+
+        del self._configs[vm_name]
+        self._changed.add(vm_name)
+        self.ports.discard(vm_name)
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Write the changes made within in a single transaction."""
+        if not self._depth:
+            self._db.execute("BEGIN IMMEDIATE")
+        self._depth += 1
+        try:
+            yield
+        except BaseException:
+            self._depth -= 1
+            if not self._depth:
+                self._db.execute("ROLLBACK")
+                # Forget the changes which did not make it
+                self._data_version = None
+                self._reload()
+            raise
+        else:
+            self._depth -= 1
+            if not self._depth:
+                self._db.execute("COMMIT")
+
+    def close(self):
+        self._db.close()
+
+
+def _open_sqlite(path, config_dir, port_range):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    migrate = not os.path.exists(path)
+    sqlite_store = SQLiteStore(path, port_range)
+
+    if migrate and os.path.isdir(config_dir):
+        configs = DirectoryStore(config_dir).configs()
+        try:
+            with sqlite_store.batch():
+                # As they are, conflicting ports included
+                for bmc_config in configs.values():
+                    sqlite_store._insert(bmc_config)
+
+        except Exception:
+            # Try again next time
+            sqlite_store.close()
+            os.unlink(path)
+            raise
+
+        if configs:
+            LOG.info(
+                "Imported %(count)d vBMC(s) from %(dir)s into %(db)s",
+                {"count": len(configs), "dir": config_dir, "db": path},
+            )
+
+    return sqlite_store
+
+
+def get_store():
+    global STORE
+    if STORE is None:
+        config_dir = CONF["default"]["config_dir"]
+        if CONF["default"]["config_store"] == "sqlite":
+            STORE = _open_sqlite(
+                CONF["default"]["config_db"]
+                or os.path.join(config_dir, "vbmc4vsphere.db"),
+                config_dir,
+                CONF["default"]["port_range"],
+            )
+        else:
+            STORE = DirectoryStore(config_dir, CONF["default"]["port_range"])
+
+    return STORE
@@ -0,0 +1,149 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import threading
+
+from pyVmomi import vim, vmodl
+
+from vbmc4vsphere import log
+
+__all__ = ["track_task"]
+
+LOG = log.get_logger()
+
+# Seconds a WaitForUpdatesEx call may block while no task changes state
+WAIT_SECONDS = 60
+
+
+class TaskTracker(object):
+    """Follows vCenter tasks to completion through a PropertyCollector.
+
+    Callers hand over the task returned by e.g. `PowerOnVM_Task` and carry
+    on. A background thread waits for `info.state` of all tracked tasks to
+    reach `success` or `error` and then invokes the callback given for the
+    task with the final state and error, if any.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self._lock = threading.Lock()
+        self._collector = session.content.propertyCollector.CreatePropertyCollector()
+        self._tasks = {}
+        self.failed = False
+        self._thread = threading.Thread(
+            target=self._run, name="vbmcd-task-tracker", daemon=True
+        )
+        self._thread.start()
+
+    def track(self, task, callback):
+        spec = vmodl.query.PropertyCollector.FilterSpec(
+            objectSet=[vmodl.query.PropertyCollector.ObjectSpec(obj=task, skip=False)],
+            propSet=[
+                vmodl.query.PropertyCollector.PropertySpec(
+                    type=vim.Task, pathSet=["info.state", "info.error"]
+                )
+            ],
+        )
+        with self._lock:
+            # Registered before the filter exists, as the outstanding
+            # WaitForUpdatesEx may report the task as soon as it does
+            self._tasks[task._moId] = {
+                "filter": None,
+                "callback": callback,
+                "error": None,
+            }
+        try:
+            pc_filter = self._collector.CreateFilter(spec, partialUpdates=True)
+        except Exception:
+            with self._lock:
+                self._tasks.pop(task._moId, None)
+            raise
+
+        with self._lock:
+            if task._moId in self._tasks:
+                self._tasks[task._moId]["filter"] = pc_filter
+                pc_filter = None
+
+        if pc_filter is not None:
+            # Already finished while the filter was being created
+            self._destroy(pc_filter)
+
+    @staticmethod
+    def _destroy(pc_filter):
+        try:
+            pc_filter.DestroyPropertyFilter()
+        except Exception:
+            pass
+
+    def _apply(self, update):
+        finished = []
+        with self._lock:
+            for filter_update in update.filterSet or ():
+                for obj_update in filter_update.objectSet or ():
+                    entry = self._tasks.get(obj_update.obj._moId)
+                    if entry is None:
+                        continue
+                    state = None
+                    for change in obj_update.changeSet or ():
+                        if change.name == "info.error":
+                            entry["error"] = change.val
+                        elif change.name == "info.state":
+                            state = change.val
+                    if state in ("success", "error"):
+                        del self._tasks[obj_update.obj._moId]
+                        finished.append((entry, state))
+
+        for entry, state in finished:
+            if entry["filter"] is not None:
+                self._destroy(entry["filter"])
+            error = entry["error"]
+            if error is not None:
+                error = getattr(error, "msg", None) or str(error)
+            entry["callback"](state, error)
+
+    def _run(self):
+        version = ""
+        options = vmodl.query.PropertyCollector.WaitOptions(
+            maxWaitSeconds=WAIT_SECONDS
+        )
+        try:
+            while True:
+                update = self._collector.WaitForUpdatesEx(version, options)
+                if update is not None:
+                    self._apply(update)
+                    version = update.version
+
+        except Exception as e:
+            LOG.warning(
+                "Task tracking failed, outcome of %(count)d task(s) is "
+                "unknown. Error: %(error)s",
+                {"count": len(self._tasks), "error": e},
+            )
+            with self._lock:
+                self.failed = True
+                entries = list(self._tasks.values())
+                self._tasks.clear()
+
+            for entry in entries:
+                entry["callback"]("unknown", str(e))
+
+
+def track_task(session, task, callback):
+    """Call `callback(state, error)` once the vCenter task has finished.
+
+    The task is followed by the tracker of the current login of the pooled
+    session it was started with.
+    """
+    tracker = session.get_object(
+        "task_tracker", TaskTracker, stale=lambda tracker: tracker.failed
+    )
+    tracker.track(task, callback)
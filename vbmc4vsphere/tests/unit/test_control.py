@@ -0,0 +1,112 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import json
+import os
+import socket
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import zmq
+
+from vbmc4vsphere import control, manager, store
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class MainLoopTestCase(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        vbmc_store = store.SQLiteStore(os.path.join(tmp.name, "vbmc4vsphere.db"))
+        self.addCleanup(vbmc_store.close)
+
+        self.server_port, self.event_port = _free_port(), _free_port()
+        patches = [
+            mock.patch.object(store, "get_store", return_value=vbmc_store),
+            mock.patch.object(manager.discovery, "get_discoveries", return_value={}),
+            mock.patch.object(manager.engine, "Engine"),
+            mock.patch.dict(manager.CONF["default"], engine="single"),
+            mock.patch.dict(
+                control.CONF["default"],
+                server_port=self.server_port,
+                event_port=self.event_port,
+                metrics_port=0,
+            ),
+            # The events must not wait for the periodic pass
+            mock.patch.object(control, "TIMER_PERIOD", 3600 * 1000),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        manager.engine.Engine.return_value.sentinels.return_value = []
+        self.manager = manager.VirtualBMCManager()
+
+        self.context = zmq.Context()
+        self.addCleanup(self.context.destroy, linger=0)
+
+    def _run(self):
+        def handle_command(vbmc_manager, data_in):
+            raise KeyboardInterrupt()
+
+        def run():
+            try:
+                control.main_loop(self.manager, handle_command)
+            except KeyboardInterrupt:
+                pass
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+
+        def stop():
+            client = self.context.socket(zmq.DEALER)
+            client.setsockopt(zmq.LINGER, 0)
+            client.connect("tcp://127.0.0.1:%d" % self.server_port)
+            client.send(json.dumps({"command": "list"}).encode("utf-8"))
+            thread.join(timeout=10)
+            client.close()
+            self.assertFalse(thread.is_alive())
+
+        self.addCleanup(stop)
+
+    def test_engine_power_event_published_at_once(self):
+        subscriber = self.context.socket(zmq.SUB)
+        subscriber.setsockopt(zmq.LINGER, 0)
+        subscriber.setsockopt(zmq.SUBSCRIBE, b"power")
+        subscriber.connect("tcp://127.0.0.1:%d" % self.event_port)
+        self.addCleanup(subscriber.close)
+        self._run()
+
+        # As an engine thread would, until the subscription went through
+        notify = self.manager._engine_notify
+        for _ in range(50):
+            threading.Thread(
+                target=notify,
+                args=("vm1", "power"),
+                kwargs={"state": "on", "previous": "off"},
+            ).start()
+            if subscriber.poll(timeout=100):
+                break
+        else:
+            self.fail("No power event was published")
+
+        name, event = subscriber.recv_multipart()
+        self.assertEqual(b"power", name)
+        event = json.loads(event.decode("utf-8"))
+        self.assertEqual("vm1", event["vm_name"])
+        self.assertEqual("on", event["state"])
@@ -0,0 +1,194 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import types
+import unittest
+from unittest import mock
+
+from vbmc4vsphere import discovery, exception
+
+
+def _change(name, val, op="assign"):
+    return types.SimpleNamespace(name=name, val=val, op=op)
+
+
+def _object_update(moid, kind="enter", **props):
+    return types.SimpleNamespace(
+        obj=types.SimpleNamespace(_moId=moid),
+        kind=kind,
+        changeSet=[_change(name.replace("_", "."), val) for name, val in props.items()],
+    )
+
+
+def _update(version, *object_updates, truncated=False):
+    return types.SimpleNamespace(
+        version=version,
+        truncated=truncated,
+        filterSet=[types.SimpleNamespace(objectSet=list(object_updates))],
+    )
+
+
+class DiscoveryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.discovery = discovery.Discovery(
+            "lab", {"viserver": "192.0.2.1", "folder": "dc/vm/lab"}
+        )
+        self.addCleanup(os.close, self.discovery._wakeup_r)
+        self.addCleanup(os.close, self.discovery._wakeup_w)
+
+    def test_needs_one_scope(self):
+        for options in (
+            {"viserver": "192.0.2.1"},
+            {"viserver": "192.0.2.1", "folder": "f", "resource_pool": "p"},
+            {"folder": "f"},
+        ):
+            self.assertRaises(
+                exception.VirtualBMCError, discovery.Discovery, "lab", options
+            )
+
+    def test_update_enter_leave(self):
+        members, names = {}, {}
+        update = self.discovery._update
+
+        self.assertEqual(
+            [("enter", "vm1", "uuid1")],
+            update(members, names, "vm-1", ("vm1", "uuid1")),
+        )
+        # Reported once only
+        self.assertEqual([], update(members, names, "vm-1", ("vm1", "uuid1")))
+        self.assertEqual([("leave", "vm1", None)], update(members, names, "vm-1", None))
+        self.assertEqual([], update(members, names, "vm-1", None))
+        self.assertEqual({}, members)
+        self.assertEqual({}, names)
+
+    def test_update_rename(self):
+        members, names = {}, {}
+        update = self.discovery._update
+        update(members, names, "vm-1", ("vm1", "uuid1"))
+
+        self.assertEqual(
+            [("leave", "vm1", None), ("enter", "vm2", "uuid1")],
+            update(members, names, "vm-1", ("vm2", "uuid1")),
+        )
+        self.assertEqual({"vm-1": ("vm2", "uuid1")}, members)
+
+    def test_update_uuid_change(self):
+        members, names = {}, {}
+        update = self.discovery._update
+        update(members, names, "vm-1", ("vm1", "uuid1"))
+
+        self.assertEqual(
+            [("leave", "vm1", None), ("enter", "vm1", "uuid2")],
+            update(members, names, "vm-1", ("vm1", "uuid2")),
+        )
+
+    def test_update_duplicate_names(self):
+        members, names = {}, {}
+        update = self.discovery._update
+
+        update(members, names, "vm-1", ("vm1", "uuid1"))
+        self.assertEqual([], update(members, names, "vm-2", ("vm1", "uuid2")))
+        self.assertEqual({"vm1": ["vm-1", "vm-2"]}, names)
+
+        # The name stays while another VM of the scope has it
+        self.assertEqual([], update(members, names, "vm-2", None))
+        self.assertEqual([("leave", "vm1", None)], update(members, names, "vm-1", None))
+
+    def test_update_duplicate_names_first_leaves(self):
+        members, names = {}, {}
+        update = self.discovery._update
+        update(members, names, "vm-1", ("vm1", "uuid1"))
+        update(members, names, "vm-2", ("vm1", "uuid2"))
+        update(members, names, "vm-3", ("vm1", "uuid3"))
+
+        # The name goes on with the UUID of the VM which still has it
+        self.assertEqual(
+            [("leave", "vm1", None), ("enter", "vm1", "uuid2")],
+            update(members, names, "vm-1", None),
+        )
+        self.assertEqual(
+            [
+                ("leave", "vm1", None),
+                ("enter", "vm1", "uuid3"),
+                ("enter", "vm2", "uuid2"),
+            ],
+            update(members, names, "vm-2", ("vm2", "uuid2")),
+        )
+        self.assertEqual({"vm1": ["vm-3"], "vm2": ["vm-2"]}, names)
+
+    def test_update_duplicate_names_same_uuid(self):
+        members, names = {}, {}
+        update = self.discovery._update
+        update(members, names, "vm-1", ("vm1", "uuid1"))
+        update(members, names, "vm-2", ("vm1", "uuid1"))
+
+        self.assertEqual([], update(members, names, "vm-1", None))
+
+    def _watch(self, *updates):
+        collector = mock.Mock()
+
+        def wait(version, options):
+            if not updates_left:
+                self.discovery._stopped.set()
+                return None
+            return updates_left.pop(0)
+
+        updates_left = list(updates)
+        collector.WaitForUpdatesEx.side_effect = wait
+        view = mock.Mock()
+
+        with mock.patch.object(
+            discovery.inventory,
+            "create_vm_collector",
+            return_value=(view, collector),
+        ):
+            self.discovery._watch(mock.Mock())
+
+        collector.Destroy.assert_called_once_with()
+        view.Destroy.assert_called_once_with()
+        return self.discovery.changes(), collector
+
+    def test_watch(self):
+        changes, collector = self._watch(
+            _update(
+                "1",
+                _object_update("vm-1", name="vm1", config_uuid="uuid1"),
+                truncated=True,
+            ),
+            _update(
+                "2",
+                _object_update("vm-2", name="vm2", config_uuid="uuid2"),
+                _object_update("vm-3", name="tmpl", config_template=True),
+            ),
+            _update(
+                "3",
+                _object_update("vm-4", name="vm4", config_uuid="uuid4"),
+                _object_update("vm-1", kind="leave"),
+            ),
+            _update("4", _object_update("vm-2", kind="modify", name="vm2-renamed")),
+        )
+
+        self.assertEqual(
+            [
+                ("sync", {"vm1": "uuid1", "vm2": "uuid2"}),
+                ("enter", "vm4", "uuid4"),
+                ("leave", "vm1", None),
+                ("leave", "vm2", None),
+                ("enter", "vm2-renamed", "uuid2"),
+            ],
+            changes,
+        )
+        self.assertEqual(
+            ["", "1", "2", "3", "4"],
+            [call.args[0] for call in collector.WaitForUpdatesEx.call_args_list],
+        )
@@ -0,0 +1,46 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import unittest
+from unittest import mock
+
+from vbmc4vsphere import log
+
+
+class RateLimitTestCase(unittest.TestCase):
+    def setUp(self):
+        patch = mock.patch.object(log.time, "monotonic", return_value=100.2)
+        self.monotonic = patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_rate(self):
+        limit = log.RateLimit(2)
+
+        self.assertEqual([0, 0, None, None], [limit.allow() for _ in range(4)])
+
+        # The next second reports how many were not logged
+        self.monotonic.return_value = 101.0
+        self.assertEqual(2, limit.allow())
+        self.assertEqual(0, limit.allow())
+        self.assertIsNone(limit.allow())
+
+    def test_same_second(self):
+        limit = log.RateLimit(1)
+
+        self.assertEqual(0, limit.allow())
+        self.monotonic.return_value = 100.9
+        self.assertIsNone(limit.allow())
+
+    def test_disabled(self):
+        for rate in (0, -1):
+            limit = log.RateLimit(rate)
+            self.assertIsNone(limit.allow())
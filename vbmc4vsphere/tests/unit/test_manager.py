@@ -0,0 +1,158 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from vbmc4vsphere import exception, manager, store
+from vbmc4vsphere.tests.unit.test_store import _bmc_config
+
+
+class ListTestCase(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.store = store.SQLiteStore(os.path.join(tmp.name, "vbmc4vsphere.db"))
+        self.addCleanup(self.store.close)
+
+        patches = [
+            mock.patch.object(store, "get_store", return_value=self.store),
+            mock.patch.object(manager.discovery, "get_discoveries", return_value={}),
+            mock.patch.dict(manager.CONF["default"], engine="process"),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.manager = manager.VirtualBMCManager()
+
+        for vm_name, port, address in (
+            ("vm-b", 6231, "192.0.2.1"),
+            ("vm-a", 6230, "192.0.2.2"),
+            ("vm-c", 6232, None),
+            ("lab-1", 6233, "192.0.2.2"),
+        ):
+            self.store.add(_bmc_config(vm_name, port=port, address=address))
+
+    def _list(self, **kwargs):
+        rc, total, tables = self.manager.list(**kwargs)
+        self.assertEqual(0, rc)
+        return total, [table["vm_name"] for table in tables]
+
+    def test_default_sort(self):
+        self.assertEqual((4, ["lab-1", "vm-a", "vm-b", "vm-c"]), self._list())
+
+    def test_filters(self):
+        self.assertEqual((3, ["vm-a", "vm-b", "vm-c"]), self._list(name="vm-*"))
+        self.assertEqual((1, ["vm-b"]), self._list(name="vm-*", address="192.0.2.1"))
+        self.assertEqual(
+            (4, ["lab-1", "vm-a", "vm-b", "vm-c"]), self._list(status="down")
+        )
+        self.assertEqual((0, []), self._list(status="running"))
+
+    def test_sort_fields(self):
+        self.assertEqual(
+            ["vm-a", "vm-b", "vm-c", "lab-1"], self._list(sort=["port"])[1]
+        )
+        self.assertEqual(
+            ["vm-b", "lab-1", "vm-a", "vm-c"], self._list(sort=["address", "-port"])[1]
+        )
+        self.assertEqual(
+            ["vm-a", "lab-1", "vm-b", "vm-c"],
+            self._list(sort=["-address", "-vm_name"])[1],
+        )
+
+    def test_sort_unset_last(self):
+        # Whichever the direction
+        self.assertEqual("vm-c", self._list(sort=["address"])[1][-1])
+        self.assertEqual("vm-c", self._list(sort=["-address"])[1][-1])
+
+    def test_sort_invalid(self):
+        self.assertRaises(exception.VirtualBMCError, self._list, sort=["password"])
+
+    def test_page(self):
+        self.assertEqual((4, ["vm-a", "vm-b"]), self._list(offset=1, limit=2))
+        self.assertEqual((4, ["vm-c"]), self._list(offset=3, limit=2))
+        self.assertEqual((4, []), self._list(offset=4))
+
+
+class DiscoverTestCase(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.store = store.SQLiteStore(
+            os.path.join(tmp.name, "vbmc4vsphere.db"), port_range=(6230, 6239)
+        )
+        self.addCleanup(self.store.close)
+
+        patches = [
+            mock.patch.object(store, "get_store", return_value=self.store),
+            mock.patch.object(manager.discovery, "get_discoveries", return_value={}),
+            mock.patch.dict(manager.CONF["default"], engine="process"),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.manager = manager.VirtualBMCManager()
+        self.source = mock.Mock(options={"viserver": "192.0.2.1", "start": False})
+        self.source.name = "lab"
+
+    def _discover(self, *changes):
+        self.source.changes.return_value = list(changes)
+        self.manager._discover(self.source)
+        return {
+            vm_name: (bmc_config["vm_uuid"], bmc_config["port"])
+            for vm_name, bmc_config in self.store.configs().items()
+        }
+
+    def test_sync(self):
+        self.store.add(_bmc_config("by-hand"))
+
+        self.assertEqual(
+            {"by-hand": (None, 6230), "vm1": ("uuid1", 6231)},
+            self._discover(("sync", {"vm1": "uuid1", "by-hand": "uuid2"})),
+        )
+        self.assertEqual(
+            {"by-hand": (None, 6230), "vm2": ("uuid2", 6231)},
+            self._discover(("sync", {"vm2": "uuid2"})),
+        )
+
+    def test_name_taken_over(self):
+        self._discover(("enter", "vm1", "uuid1"), ("enter", "vm2", "uuid2"))
+
+        # Another VM of the same name is left once the first one goes
+        self.assertEqual(
+            {"vm1": ("uuid3", 6230), "vm2": ("uuid2", 6231)},
+            self._discover(("leave", "vm1", None), ("enter", "vm1", "uuid3")),
+        )
+        # Found as such by a later sync too
+        self.assertEqual(
+            {"vm1": ("uuid4", 6230), "vm2": ("uuid2", 6231)},
+            self._discover(("sync", {"vm1": "uuid4", "vm2": "uuid2"})),
+        )
+        self.assertEqual(
+            {"vm2": ("uuid2", 6231)}, self._discover(("leave", "vm1", None))
+        )
+
+    def test_name_taken_over_restarts(self):
+        self._discover(("enter", "vm1", "uuid1"))
+        instance = mock.Mock(sentinel=None)
+        self.manager._running_vms["vm1"] = instance
+
+        with mock.patch.object(self.manager, "_sync_vbmc_state") as sync:
+            self._discover(("leave", "vm1", None), ("enter", "vm1", "uuid2"))
+
+        # Stopped, then started again once the batch is over
+        self.assertEqual(
+            [mock.call("vm1", shutdown=True), mock.call("vm1")], sync.call_args_list
+        )
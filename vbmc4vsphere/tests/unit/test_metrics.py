@@ -0,0 +1,118 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import unittest
+import urllib.error
+import urllib.request
+
+from vbmc4vsphere import metrics
+
+REQUEST = "vbmc_ipmi_request_seconds"
+BUSY = "vbmc_ipmi_busy_total"
+
+
+class MetricsTestCase(unittest.TestCase):
+    def test_add(self):
+        values = metrics.Metrics()
+        self.assertFalse(values.changed)
+
+        values.add(BUSY, ("vm1", "power_on"))
+        values.add(BUSY, ("vm1", "power_on"), 2)
+        values.add(BUSY, ("vm1", "power_off"))
+
+        self.assertTrue(values.changed)
+        self.assertEqual(
+            {BUSY: {("vm1", "power_on"): 3, ("vm1", "power_off"): 1}},
+            values.snapshot(),
+        )
+        self.assertFalse(values.changed)
+
+    def test_observe(self):
+        values = metrics.Metrics()
+        labels = ("vm1", 0, 1)
+        values.observe(REQUEST, labels, 0.001)
+        values.observe(REQUEST, labels, 0.003)
+        values.observe(REQUEST, labels, 60)
+
+        histogram = values.snapshot()[REQUEST][labels]
+        self.assertEqual(len(metrics.BUCKETS) + 2, len(histogram))
+        # Bounds are inclusive, and values above them counted last
+        self.assertEqual([1, 1] + [0] * 10 + [1], histogram[:-1])
+        self.assertAlmostEqual(60.004, histogram[-1])
+
+    def test_snapshot_is_a_copy(self):
+        values = metrics.Metrics()
+        values.observe(REQUEST, ("vm1", 0, 1), 0.5)
+        snapshot = values.snapshot()
+        values.observe(REQUEST, ("vm1", 0, 1), 0.5)
+
+        self.assertEqual(1, sum(snapshot[REQUEST][("vm1", 0, 1)][:-1]))
+
+
+class RenderTestCase(unittest.TestCase):
+    def test_empty(self):
+        text = metrics.render([])
+
+        self.assertIn("# TYPE %s histogram\n" % REQUEST, text)
+        self.assertIn("# TYPE %s counter\n" % BUSY, text)
+        self.assertFalse([line for line in text.splitlines() if line[0] != "#"])
+
+    def test_counters_summed(self):
+        first, second = metrics.Metrics(), metrics.Metrics()
+        first.add(BUSY, ("vm1", "power_on"))
+        second.add(BUSY, ("vm1", "power_on"), 2)
+        second.add(BUSY, ('vm"2\\\n', "power_off"))
+
+        lines = metrics.render([first.snapshot(), second.snapshot()]).splitlines()
+
+        self.assertIn('%s{vm="vm1",operation="power_on"} 3' % BUSY, lines)
+        self.assertIn('%s{vm="vm\\"2\\\\\\n",operation="power_off"} 1' % BUSY, lines)
+
+    def test_histograms_summed(self):
+        first, second = metrics.Metrics(), metrics.Metrics()
+        first.observe(REQUEST, ("vm1", 0, 1), 0.002)
+        second.observe(REQUEST, ("vm1", 0, 1), 0.02)
+        second.observe(REQUEST, ("vm1", 0, 1), 20)
+        snapshots = [first.snapshot(), second.snapshot()]
+
+        lines = metrics.render(snapshots).splitlines()
+
+        series = '%s_%%s{vm="vm1",netfn="0x00",command="0x01"%%s}' % REQUEST
+        self.assertIn(series % ("bucket", ',le="0.001"') + " 0", lines)
+        self.assertIn(series % ("bucket", ',le="0.005"') + " 1", lines)
+        self.assertIn(series % ("bucket", ',le="0.025"') + " 2", lines)
+        self.assertIn(series % ("bucket", ',le="10"') + " 2", lines)
+        self.assertIn(series % ("bucket", ',le="+Inf"') + " 3", lines)
+        self.assertIn(series % ("count", "") + " 3", lines)
+        self.assertIn(series % ("sum", "") + " %r" % 20.022, lines)
+        # The snapshots are left as they were
+        self.assertEqual(1, sum(snapshots[0][REQUEST][("vm1", 0, 1)][:-1]))
+
+
+class ServeTestCase(unittest.TestCase):
+    def test_serve(self):
+        values = metrics.Metrics()
+        values.add(BUSY, ("vm1", "power_on"))
+        server = metrics.serve(0, lambda: [values.snapshot()])
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = "http://127.0.0.1:%d" % server.server_address[1]
+
+        with urllib.request.urlopen(url + "/metrics") as response:
+            self.assertEqual(200, response.status)
+            body = response.read().decode("utf-8")
+        self.assertIn('%s{vm="vm1",operation="power_on"} 1\n' % BUSY, body)
+
+        with self.assertRaises(urllib.error.HTTPError) as ctx:
+            urllib.request.urlopen(url + "/other")
+        ctx.exception.close()
+        self.assertEqual(404, ctx.exception.code)
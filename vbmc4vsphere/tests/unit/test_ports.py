@@ -0,0 +1,132 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import unittest
+
+from vbmc4vsphere import exception, ports
+
+
+class PortIndexTestCase(unittest.TestCase):
+    def test_owner(self):
+        index = ports.PortIndex()
+        index.set("vm1", "192.0.2.1", 6230)
+
+        self.assertEqual("vm1", index.owner("192.0.2.1", 6230))
+        self.assertIsNone(index.owner("192.0.2.1", 6230, vm_name="vm1"))
+        self.assertIsNone(index.owner("192.0.2.2", 6230))
+        self.assertIsNone(index.owner("192.0.2.1", 6231))
+
+    def test_owner_wildcards(self):
+        index = ports.PortIndex()
+        index.set("vm1", "192.0.2.1", 6230)
+        index.set("vm2", None, 6231)
+
+        # Binding every address conflicts with any address, both ways
+        self.assertEqual("vm1", index.owner("0.0.0.0", 6230))
+        self.assertEqual("vm1", index.owner("::", 6230))
+        self.assertEqual("vm2", index.owner("192.0.2.2", 6231))
+        self.assertEqual("vm2", index.owner("", 6231))
+
+    def test_owner_canonical_address(self):
+        index = ports.PortIndex()
+        index.set("vm1", "2001:db8:0:0::1", 6230)
+        index.set("vm2", "BMC.example.com", 6230)
+
+        self.assertEqual("vm1", index.owner("2001:db8::1", 6230))
+        self.assertEqual("vm2", index.owner("bmc.example.com", 6230))
+
+    def test_next_free_lowest_first(self):
+        index = ports.PortIndex((6230, 6232))
+        index.set("vm1", "::", 6230)
+        self.assertEqual(6231, index.next_free())
+
+        # Taken on another address still takes it out of the range
+        index.set("vm2", "192.0.2.1", 6231)
+        self.assertEqual(6232, index.next_free())
+
+    def test_next_free_in_order_freed(self):
+        index = ports.PortIndex((6230, 6233))
+        for port in range(6230, 6234):
+            index.set("vm%d" % port, "::", port)
+        self.assertRaises(exception.NoFreePort, index.next_free)
+
+        index.discard("vm6232")
+        index.discard("vm6230")
+        self.assertEqual(6232, index.next_free())
+
+        index.set("vm", "::", 6232)
+        self.assertEqual(6230, index.next_free())
+
+    def test_next_free_exhausted(self):
+        index = ports.PortIndex((6230, 6231))
+        index.set("vm1", "::", 6230)
+        index.set("vm2", "::", 6231)
+
+        self.assertRaises(exception.NoFreePort, index.next_free)
+
+    def test_discard_outside_range(self):
+        index = ports.PortIndex((6230, 6230))
+        index.set("vm1", "::", 6230)
+        index.set("vm2", "::", 7000)
+        index.discard("vm2")
+        index.discard("vm2")
+
+        self.assertRaises(exception.NoFreePort, index.next_free)
+
+    def test_discard_shared_port(self):
+        index = ports.PortIndex((6230, 6231))
+        index.set("vm1", "192.0.2.1", 6230)
+        index.set("vm2", "192.0.2.2", 6230)
+
+        index.discard("vm1")
+        self.assertEqual(6231, index.next_free())
+        index.discard("vm2")
+        # Queued once only
+        index.set("vm3", "::", 6231)
+        self.assertEqual(6230, index.next_free())
+        index.set("vm4", "::", 6230)
+        self.assertRaises(exception.NoFreePort, index.next_free)
+
+    def test_set_replaces(self):
+        index = ports.PortIndex()
+        index.set("vm1", "::", 6230)
+        index.set("vm1", "::", 6231)
+
+        self.assertIsNone(index.owner("::", 6230))
+        self.assertEqual("vm1", index.owner("::", 6231))
+
+    def test_claim(self):
+        index = ports.PortIndex((6230, 6239))
+        index.set("vm1", "::", 6230)
+
+        bmc_config = {"vm_name": "vm2", "address": "::", "port": None}
+        claimed = index.claim(bmc_config)
+        self.assertEqual(6231, claimed["port"])
+        # Not recorded until set
+        self.assertIsNone(bmc_config["port"])
+        self.assertEqual(6231, index.next_free())
+
+        self.assertRaises(
+            exception.PortInUse,
+            index.claim,
+            {"vm_name": "vm2", "address": "192.0.2.1", "port": "6230"},
+        )
+        # A VM keeps its own port
+        self.assertEqual(
+            6230, index.claim({"vm_name": "vm1", "address": "::", "port": 6230})["port"]
+        )
+
+    def test_claim_without_range(self):
+        index = ports.PortIndex()
+
+        claimed = index.claim({"vm_name": "vm1", "address": None, "port": None})
+        self.assertEqual(ports.DEFAULT_PORT, claimed["port"])
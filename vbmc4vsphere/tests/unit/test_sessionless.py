@@ -0,0 +1,109 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import struct
+import unittest
+from unittest import mock
+
+from vbmc4vsphere import vbmc
+
+SOCKADDR = ("192.0.2.10", 623)
+
+AUTHCAP = b"\x00\x01\x80\x04\x02\x00\x00\x00\x00"
+
+
+def _request(command, data, authtype=6, payloadtype=0, rqseq=5, netfn=6):
+    """Return a sessionless request from 0x81, LUN 2, to 0x20."""
+    message = bytes([0x20, netfn << 2, -(0x20 + (netfn << 2)) & 0xFF])
+    body = bytes([0x81, rqseq << 2 | 2, command]) + data
+    message += body + bytes([-sum(body) & 0xFF])
+    if authtype == 6:
+        header = bytes([6, payloadtype]) + bytes(8) + struct.pack("<H", len(message))
+    else:
+        header = bytes([authtype]) + bytes(8) + bytes([len(message)])
+    return b"\x06\x00\xff\x07" + header + message
+
+
+class SessionlessTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = vbmc.ipmiserver.__new__(vbmc.ipmiserver)
+        self.server.serversocket = mock.sentinel.socket
+        self.server.authcap = AUTHCAP
+        patch = mock.patch.object(vbmc.ipmisession, "_io_sendto")
+        self.sendto = patch.start()
+        self.addCleanup(patch.stop)
+
+    def _sent(self, data):
+        self.sendto.reset_mock()
+        self.server.sessionless_data(data, SOCKADDR)
+        if not self.sendto.called:
+            return None
+        self.sendto.assert_called_once_with(mock.sentinel.socket, mock.ANY, SOCKADDR)
+        return bytes(self.sendto.call_args.args[1])
+
+    def _assert_reply(self, packet, command, data, rqseq=5):
+        self.assertEqual(vbmc.IPMI2_SESSIONLESS_HEADER, packet[:14])
+        message = packet[vbmc.IPMI2_HEADER_LENGTH :]
+        self.assertEqual(struct.pack("<H", len(message)), packet[14:16])
+        # rqAddr, response netFn with the LUN of the requester, rsAddr,
+        # and the sequence number of the request
+        self.assertEqual(bytes([0x81, 7 << 2 | 2]), message[:2])
+        self.assertEqual(bytes([0x20, rqseq << 2, command]), message[3:6])
+        self.assertEqual(data, message[6:-1])
+        self.assertEqual(0, sum(message[:3]) & 0xFF)
+        self.assertEqual(0, sum(message[3:]) & 0xFF)
+
+    def test_auth_cap_v2(self):
+        packet = self._sent(_request(0x38, b"\x8e\x04"))
+        self._assert_reply(packet, 0x38, AUTHCAP)
+
+        # From the template, with the sequence number patched in
+        packet = self._sent(_request(0x38, b"\x8e\x04", rqseq=9))
+        self._assert_reply(packet, 0x38, AUTHCAP, rqseq=9)
+
+    def test_auth_cap_v2_only_for_ipmi2_current_channel(self):
+        self.assertIsNone(self._sent(_request(0x38, b"\x0e\x04")))
+        self.assertIsNone(self._sent(_request(0x38, b"\x81\x04")))
+
+    def test_auth_cap_v1(self):
+        with mock.patch.object(self.server, "send_auth_cap", create=True) as send:
+            self.server.sessionless_data(
+                _request(0x38, b"\x8e\x04", authtype=0), SOCKADDR
+            )
+        send.assert_called_once_with(0x20, 0, 0x81, 2, 5, SOCKADDR)
+
+    def test_cipher_suites(self):
+        packet = self._sent(_request(0x54, b"\x0e\x00\x80"))
+        self._assert_reply(packet, 0x54, vbmc.CIPHER_SUITES)
+
+    def test_asf_presence_ping(self):
+        ping = vbmc.ASF_HEADER + b"\x00\x00\x11\xbe\x80\x2a\x00\x00"
+        packet = self._sent(ping)
+
+        self.assertEqual(len(vbmc.ASF_PONG), len(packet))
+        self.assertEqual(0x2A, packet[9])
+        self.assertEqual(vbmc.ASF_PONG[:9], packet[:9])
+        self.assertEqual(vbmc.ASF_PONG[10:], packet[10:])
+
+    def test_ignored(self):
+        for data in (
+            b"\x06\x00\xff",
+            # Not RMCP
+            b"\x05" + _request(0x38, b"\x8e\x04")[1:],
+            # Not an application request
+            _request(0x38, b"\x8e\x04", netfn=0),
+            # Another payload type
+            _request(0x38, b"\x8e\x04", payloadtype=2),
+            # Truncated
+            _request(0x38, b"\x8e\x04")[:21],
+        ):
+            self.assertIsNone(self._sent(data))
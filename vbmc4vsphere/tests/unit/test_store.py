@@ -0,0 +1,211 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from vbmc4vsphere import exception, store
+
+
+def _bmc_config(vm_name, port=6230, address="::"):
+    return {
+        "username": "admin",
+        "password": "password",
+        "address": address,
+        "port": port,
+        "fakemac": None,
+        "vm_name": vm_name,
+        "vm_uuid": None,
+        "viserver": "192.0.2.1",
+        "viserver_username": "administrator@vsphere.local",
+        "viserver_password": "password",
+        "active": False,
+        "discovery": None,
+    }
+
+
+class SQLiteStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.path = os.path.join(self.tmp.name, "vbmc4vsphere.db")
+        self.store = store.SQLiteStore(self.path, port_range=(6230, 6239))
+        self.addCleanup(self.store.close)
+
+    def _stored(self):
+        db = sqlite3.connect(self.path)
+        try:
+            return {row[0] for row in db.execute("SELECT vm_name FROM vbmc")}
+        finally:
+            db.close()
+
+    def test_add_get(self):
+        self.store.add(_bmc_config("vm1", port="6231"))
+
+        bmc_config = self.store.get("vm1")
+        self.assertEqual(6231, bmc_config["port"])
+        self.assertEqual("False", bmc_config["active"])
+        self.assertTrue(bmc_config["fakemac"].startswith("02:00:00:"))
+        self.assertEqual({"vm1"}, self.store.refresh(1))
+        self.assertEqual(set(), self.store.refresh(1))
+
+    def test_add_without_port(self):
+        config = _bmc_config("vm1")
+        config["port"] = None
+        self.store.add(config)
+
+        self.assertEqual(6230, self.store.get("vm1")["port"])
+
+    def test_add_existing(self):
+        self.store.add(_bmc_config("vm1"))
+
+        self.assertRaises(
+            exception.VMAlreadyExists, self.store.add, _bmc_config("vm1", port=6231)
+        )
+
+    def test_add_port_in_use(self):
+        self.store.add(_bmc_config("vm1"))
+
+        self.assertRaises(exception.PortInUse, self.store.add, _bmc_config("vm2"))
+        self.assertEqual({"vm1"}, self._stored())
+
+    def test_update(self):
+        self.store.add(_bmc_config("vm1"))
+        self.store.refresh(1)
+
+        self.store.update("vm1", active=True)
+
+        self.assertEqual("True", self.store.get("vm1")["active"])
+        self.assertEqual({"vm1"}, self.store.refresh(1))
+
+    def test_delete(self):
+        self.store.add(_bmc_config("vm1"))
+        self.store.delete("vm1")
+
+        self.assertRaises(exception.VMNotFound, self.store.get, "vm1")
+        self.assertRaises(exception.VMNotFound, self.store.delete, "vm1")
+        self.assertEqual(set(), self._stored())
+        # The port is free again
+        self.store.add(_bmc_config("vm2"))
+
+    def test_batch_commits_once(self):
+        with self.store.batch():
+            self.store.add(_bmc_config("vm1", port=6230))
+            self.store.add(_bmc_config("vm2", port=6231))
+            # Not visible to other connections before the end
+            self.assertEqual(set(), self._stored())
+
+        self.assertEqual({"vm1", "vm2"}, self._stored())
+
+    def test_batch_rollback(self):
+        self.store.add(_bmc_config("vm1", port=6230))
+        self.store.refresh(1)
+
+        with self.assertRaises(RuntimeError):
+            with self.store.batch():
+                self.store.add(_bmc_config("vm2", port=6231))
+                self.store.update("vm1", active=True)
+                raise RuntimeError("boom")
+
+        self.assertEqual({"vm1"}, self._stored())
+        self.assertEqual(["vm1"], list(self.store.configs()))
+        self.assertEqual("False", self.store.get("vm1")["active"])
+        # Both were reported changed, then changed back
+        self.assertEqual({"vm1", "vm2"}, self.store.refresh(1))
+        # The port taken by the rolled back VM is free again
+        self.store.add(_bmc_config("vm3", port=6231))
+
+    def test_nested_batch_rollback(self):
+        with self.assertRaises(RuntimeError):
+            with self.store.batch():
+                self.store.add(_bmc_config("vm1", port=6230))
+                with self.store.batch():
+                    self.store.add(_bmc_config("vm2", port=6231))
+                raise RuntimeError("boom")
+
+        self.assertEqual(set(), self._stored())
+        self.assertEqual({}, self.store.configs())
+
+    def test_failed_add_in_batch_rolls_back(self):
+        with self.assertRaises(exception.VMAlreadyExists):
+            with self.store.batch():
+                self.store.add(_bmc_config("vm1", port=6230))
+                self.store._insert(_bmc_config("vm1", port=6231))
+
+        self.assertEqual(set(), self._stored())
+
+    def test_external_changes(self):
+        self.store.add(_bmc_config("vm1"))
+        self.store.refresh(1)
+
+        db = sqlite3.connect(self.path)
+        with db:
+            db.execute("UPDATE vbmc SET port = 6235 WHERE vm_name = 'vm1'")
+        db.close()
+
+        self.assertEqual({"vm1"}, self.store.refresh(1))
+        self.assertEqual(6235, self.store.configs()["vm1"]["port"])
+        self.assertEqual("vm1", self.store.ports.owner("::", 6235))
+        self.assertIsNone(self.store.ports.owner("::", 6230))
+
+
+class DirectoryStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.store = store.DirectoryStore(self.tmp.name, port_range=(6230, 6239))
+
+    def test_add_get_delete(self):
+        self.store.add(_bmc_config("vm1"))
+
+        self.assertTrue(os.path.exists(os.path.join(self.tmp.name, "vm1", "config")))
+        self.assertEqual(6230, self.store.get("vm1")["port"])
+        self.assertRaises(
+            exception.VMAlreadyExists, self.store.add, _bmc_config("vm1", port=6231)
+        )
+
+        self.store.delete("vm1")
+        self.assertRaises(exception.VMNotFound, self.store.get, "vm1")
+        self.assertFalse(os.path.exists(os.path.join(self.tmp.name, "vm1")))
+
+    def test_refresh_finds_other_writers(self):
+        other = store.DirectoryStore(self.tmp.name)
+        other.add(_bmc_config("vm1"))
+
+        self.assertEqual({"vm1"}, self.store.refresh(1))
+        self.assertEqual("vm1", self.store.ports.owner("::", 6230))
+
+        other.update("vm1", port=6231)
+        self.assertEqual({"vm1"}, self.store.refresh(1))
+        self.assertEqual(6231, self.store.configs()["vm1"]["port"])
+
+        other.delete("vm1")
+        self.assertEqual({"vm1"}, self.store.refresh(1))
+        self.assertEqual({}, self.store.configs())
+
+
+class OpenSQLiteTestCase(unittest.TestCase):
+    def test_import_config_dir(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            directory = store.DirectoryStore(tmp)
+            directory.add(_bmc_config("vm1", port=6230))
+            directory.add(_bmc_config("vm2", port=6231))
+
+            path = os.path.join(tmp, "db", "vbmc4vsphere.db")
+            sqlite_store = store._open_sqlite(path, tmp, None)
+            try:
+                self.assertEqual({"vm1", "vm2"}, set(sqlite_store.configs()))
+                self.assertEqual(6231, sqlite_store.get("vm2")["port"])
+            finally:
+                sqlite_store.close()
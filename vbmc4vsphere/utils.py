@@ -19,77 +19,37 @@ import urllib.parse
 import urllib.request
 from threading import Thread
 
-from pyVim.connect import Disconnect, SmartConnect
-from pyVmomi import vim
+from pyVmomi import vim, vmodl
 
 from vbmc4vsphere import exception
 
 
-class viserver_open(object):
-    def __init__(self, vi, vi_username=None, vi_password=None, readonly=False):
-        self.vi = vi
-        self.vi_username = vi_username
-        self.vi_password = vi_password
-        self.readonly = readonly
+def retrieve_properties(session, obj, paths):
+    """Fetch only the given property paths of a managed object.
 
-    def __enter__(self):
-        context = None
-        if hasattr(ssl, "_create_unverified_context"):
-            context = ssl._create_unverified_context()
-        try:
-            self.conn = SmartConnect(
-                host=self.vi,
-                user=self.vi_username,
-                pwd=self.vi_password,
-                # port=self.vi_port,
-                sslContext=context,
+    Reading e.g. `vm.config.bootOptions` through pyVmomi transfers the
+    whole `config` data object, which includes every device and the
+    extraConfig of the VM. Ask the PropertyCollector for the needed paths
+    instead. Paths which are unset on the object map to None.
+    """
+    spec = vmodl.query.PropertyCollector.FilterSpec(
+        objectSet=[vmodl.query.PropertyCollector.ObjectSpec(obj=obj, skip=False)],
+        propSet=[
+            vmodl.query.PropertyCollector.PropertySpec(
+                type=type(obj), pathSet=list(paths)
             )
-            if not self.conn:
-                raise Exception
-        except Exception as e:
-            raise exception.VIServerConnectionOpenError(vi=self.vi, error=e)
-
-        return self.conn
-
-    def __exit__(self, type, value, traceback):
-        _ = Disconnect(self.conn)
-
-
-def get_obj_by_name(conn, root, vim_type, value):
-    objs = []
-    container = conn.content.viewManager.CreateContainerView(root, vim_type, True)
-    for obj in container.view:
-        if obj.name == value:
-            objs.append(obj)
-    container.Destroy()
-    return objs
-
-
-def get_viserver_vm_by_uuid(conn, uuid):
-    try:
-        search_index = conn.content.searchIndex
-        vm = search_index.FindByUuid(None, uuid, True)
-
-        if vm:
-            return vm
-        else:
-            raise Exception
-
-    except Exception:
-        raise exception.VMNotFoundByUUID(uuid=uuid)
-
-
-def get_viserver_vm(conn, vm):
-    try:
-        vms = get_obj_by_name(conn, conn.content.rootFolder, [vim.VirtualMachine], vm)
-
-        if len(vms) != 1:
-            raise Exception
-
-        return vms[0]
+        ],
+    )
+    result = session.content.propertyCollector.RetrievePropertiesEx(
+        [spec], vmodl.query.PropertyCollector.RetrieveOptions()
+    )
 
-    except Exception:
-        raise exception.VMNotFound(vm=vm)
+    props = dict.fromkeys(paths)
+    if result:
+        for obj_content in result.objects:
+            for prop in obj_content.propSet:
+                props[prop.name] = prop.val
+    return props
 
 
 def get_bootable_device_type(conn, boot_dev):
@@ -103,17 +63,24 @@ def get_bootable_device_type(conn, boot_dev):
         return "ethernet"
 
 
-def set_boot_device(conn, vm, device):
-    """Set boot device to specified device.
+def build_boot_order(session, vm, device):
+    """Build the boot order which boots from specified device.
 
     https://github.com/ansible-collections/vmware/blob/main/plugins/module_utils/vmware.py
     """
 
+    devices = (
+        retrieve_properties(session, vm, ["config.hardware.device"])[
+            "config.hardware.device"
+        ]
+        or []
+    )
+
     boot_order_list = []
     if device == "cdrom":
         bootable_cdroms = [
             dev
-            for dev in vm.config.hardware.device
+            for dev in devices
             if isinstance(dev, vim.vm.device.VirtualCdrom)
         ]
         if bootable_cdroms:
@@ -121,7 +88,7 @@ def set_boot_device(conn, vm, device):
     elif device == "disk":
         bootable_disks = [
             dev
-            for dev in vm.config.hardware.device
+            for dev in devices
             if isinstance(dev, vim.vm.device.VirtualDisk)
         ]
         if bootable_disks:
@@ -134,7 +101,7 @@ def set_boot_device(conn, vm, device):
     elif device == "ethernet":
         bootable_ethernets = [
             dev
-            for dev in vm.config.hardware.device
+            for dev in devices
             if isinstance(dev, vim.vm.device.VirtualEthernetCard)
         ]
         if bootable_ethernets:
@@ -149,22 +116,33 @@ def set_boot_device(conn, vm, device):
     elif device == "floppy":
         bootable_floppy = [
             dev
-            for dev in vm.config.hardware.device
+            for dev in devices
             if isinstance(dev, vim.vm.device.VirtualFloppy)
         ]
         if bootable_floppy:
             boot_order_list.append(vim.vm.BootOptions.BootableFloppyDevice())
 
+    return boot_order_list
+
+
+def boot_order_key(boot_order):
+    """Comparable form of a boot order: a tuple of (type, device key)."""
+    return tuple(
+        (type(dev).__name__, getattr(dev, "deviceKey", None))
+        for dev in boot_order or ()
+    )
+
+
+def set_boot_order(conn, vm, boot_order):
     kwargs = dict()
-    kwargs.update({"bootOrder": boot_order_list})
+    kwargs.update({"bootOrder": boot_order})
 
     vm_conf = vim.vm.ConfigSpec()
     vm_conf.bootOptions = vim.vm.BootOptions(**kwargs)
-    vm.ReconfigVM_Task(vm_conf)
-    return
+    return vm.ReconfigVM_Task(vm_conf)
 
 
-def send_nmi(conn, vm):
+def send_nmi(session, vm):
     """Send NMI to specified VM.
 
     https://github.com/vmware/pyvmomi/issues/726
@@ -173,18 +151,22 @@ def send_nmi(conn, vm):
     if hasattr(ssl, "_create_unverified_context"):
         context = ssl._create_unverified_context()
 
-    vmx_path = vm.config.files.vmPathName
-    for ds_url in vm.config.datastoreUrl:
+    props = retrieve_properties(
+        session, vm, ["config.files.vmPathName", "config.datastoreUrl", "runtime.host"]
+    )
+    vmx_path = props["config.files.vmPathName"]
+    for ds_url in props["config.datastoreUrl"] or []:
         vmx_path = vmx_path.replace("[%s] " % ds_url.name, "%s/" % ds_url.url)
+    host_name = retrieve_properties(session, props["runtime.host"], ["name"])["name"]
 
     url = "https://%s/cgi-bin/vm-support.cgi?manifests=%s&vm=%s" % (
-        vm.runtime.host.name,
+        host_name,
         urllib.parse.quote_plus("HungVM:Send_NMI_To_Guest"),
         urllib.parse.quote_plus(vmx_path),
     )
 
     spec = vim.SessionManager.HttpServiceRequestSpec(method="httpGet", url=url)
-    ticket = conn.content.sessionManager.AcquireGenericServiceTicket(spec)
+    ticket = session.content.sessionManager.AcquireGenericServiceTicket(spec)
     headers = {
         "Cookie": "vmware_cgi_ticket=%s" % ticket.id,
     }
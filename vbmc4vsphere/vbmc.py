@@ -12,7 +12,12 @@
 
 # import xml.etree.ElementTree as ET
 
+import contextlib
+import functools
+import logging
 import struct
+import threading
+import time
 import traceback
 
 import pyghmi.ipmi.bmc as bmc
@@ -20,10 +25,23 @@ import pyghmi.ipmi.private.session as ipmisession
 from pyghmi.ipmi.private.serversession import IpmiServer as ipmiserver
 from pyghmi.ipmi.private.serversession import ServerSession as serversession
 
-from vbmc4vsphere import exception, log, utils
+from vbmc4vsphere import config as vbmc_config
+from vbmc4vsphere import (
+    exception,
+    inventory,
+    log,
+    metrics,
+    pool,
+    replay,
+    singleflight,
+    tasks,
+    utils,
+)
 
 LOG = log.get_logger()
 
+CONF = vbmc_config.get_config()
+
 # Power states
 POWEROFF = 0
 POWERON = 1
@@ -37,6 +55,75 @@ IPMI_COMMAND_NODE_BUSY = 0xC0
 # Invalid data field in request
 IPMI_INVALID_DATA = 0xCC
 
+# Get Chassis Status, current power state: power control fault
+CHASSIS_POWER_CONTROL_FAULT = 0b00010000
+# Get Chassis Status, last power event: last power on was via IPMI command
+CHASSIS_LAST_POWER_ON_BY_IPMI = 0b00010000
+
+# Operations whose failure is reported as a power control fault
+POWER_OPERATIONS = ("power_on", "power_off", "power_reset")
+
+# Power state of the VM once an operation succeeded
+POWER_STATES = {"power_on": "poweredOn", "power_off": "poweredOff"}
+
+
+# Sessionless packets, read in place. Requests are an RMCP header, an
+# IPMI 1.5 or 2.0 session header, and an IPMI message of rsAddr,
+# netFn/rsLUN, checksum, rqAddr, rqSeq/rqLUN, command and data.
+IPMI1_HEADER_LENGTH = 14
+IPMI2_HEADER_LENGTH = 16
+# RMCP version, sequence number and class, authentication type and
+# payload type
+_RMCP_HEADER = struct.Struct("BxBBBB")
+RMCP_CLASS_ASF = 0x06
+RMCP_CLASS_IPMI = 0x07
+# The IPMI message up to the first data byte
+_SESSIONLESS_REQUEST = struct.Struct("7B")
+# rqAddr, netFn/rqLUN, checksum, rsAddr and rqSeq/rsLUN of a reply
+_REPLY_ADDRESSES = struct.Struct("5B")
+# IPMI 2.0 header of the replies, but for the payload length
+IPMI2_SESSIONLESS_HEADER = b"\x06\x00\xff\x07\x06\x00" + bytes(8)
+# Get Channel Cipher Suites, cipher suite 3 only as offered by pyghmi
+CIPHER_SUITES = b"\x00\x01\xc0\x03\x01\x41\x81"
+
+ASF_HEADER = b"\x06\x00\xff\x06"
+# ASF Presence Pong, but for the message tag of the ping
+ASF_PONG = (
+    ASF_HEADER
+    + b"\x00\x00\x11\xbe\x40\x00\x00\x10\x00\x00\x11\xbe\x00\x00\x00\x00\x81"
+    + bytes(7)
+)
+
+# Handlers of the IPMI commands by (netfn, command), called with the
+# VirtualBMC, the request and the session
+HANDLERS = {}
+
+
+def register(netfn, command, handler=None):
+    """Register the handler of an IPMI command, replacing any other.
+
+    Can be used as a decorator when `handler` is omitted.
+    """
+    if handler is None:
+        return functools.partial(register, netfn, command)
+
+    HANDLERS[(netfn, command)] = handler
+    return handler
+
+
+def _method(name):
+    """Return a handler calling the method `name` of the VirtualBMC.
+
+    The method is looked up on the instance, so that the overrides of
+    subclasses are the ones called.
+    """
+
+    def handler(self, request, session):
+        return getattr(self, name)(request, session)
+
+    handler.__name__ = handler.__qualname__ = name
+    return handler
+
 
 # Boot device maps
 GET_BOOT_DEVICES_MAP = {
@@ -54,12 +141,13 @@ SET_BOOT_DEVICES_MAP = {
 }
 
 
-def _get_vm_object(conn, vm_obj):
+def _get_vm_object(vi_session, vm_obj):
     """Simple wrapper to chose lookup method"""
+    index = inventory.get_vm_index(vi_session)
     if vm_obj.vm_uuid:
-        LOG.debug('UUID lookup method called for vm uuid %s' % vm_obj.vm_uuid)
-        return utils.get_viserver_vm_by_uuid(conn, vm_obj.vm_uuid)
-    return utils.get_viserver_vm(conn, vm_obj.vm_name)
+        LOG.debug("UUID lookup method called for vm uuid %s", vm_obj.vm_uuid)
+        return index.find_by_uuid(vm_obj.vm_uuid)
+    return index.find_by_name(vm_obj.vm_name)
 
 
 def sessionless_data(self, data, sockaddr):
@@ -72,22 +160,27 @@ def sessionless_data(self, data, sockaddr):
     spawn a session to handle the context.
 
     Patched by VirtualBMC for vSphere to handle sessionless IPMIv2
-    packet and ASF Presence Ping.
+    packet and ASF Presence Ping, reading the packet in place.
     Based on pyghmi 1.5.16, Apache License 2.0
     https://opendev.org/x/pyghmi/src/branch/master/pyghmi/ipmi/private/serversession.py
     """
-    data = bytearray(data)
-    if len(data) < 22:
-        if data[0:4] == b"\x06\x00\xff\x06" and data[8] == 0x80:  # asf presence ping
-            LOG.info("Responding to asf presence ping")
-            self.send_asf_presence_pong(data, sockaddr)
-        else:
-            return
-    if not (data[0] == 6 and data[2:4] == b"\xff\x07"):  # not ipmi
+    view = memoryview(data)
+    if len(view) < 10:
+        return
+    version, sequence, rmcp_class, authtype, payloadtype = _RMCP_HEADER.unpack_from(
+        view
+    )
+    if version != 6 or sequence != 0xFF:  # not rmcp
+        return
+    if len(view) < 22:
+        if rmcp_class == RMCP_CLASS_ASF and view[8] == 0x80:  # asf presence ping
+            LOG.debug("Responding to asf presence ping")
+            self.send_asf_presence_pong(view, sockaddr)
         return
-    authtype = data[4]
+    if rmcp_class != RMCP_CLASS_IPMI:  # not ipmi
+        return
+    offset = IPMI1_HEADER_LENGTH
     if authtype == 6:  # ipmi 2 payload...
-        payloadtype = data[5]
         if payloadtype not in (0, 16):
             return
         if payloadtype == 16:  # new session to handle conversation
@@ -96,83 +189,146 @@ def sessionless_data(self, data, sockaddr):
                 self.kg,
                 sockaddr,
                 self.serversocket,
-                data[16:],
+                bytearray(view[16:]),
                 self.uuid,
                 bmc=self,
             )
             return
-        # ditch two byte, because ipmi2 header is two
-        # bytes longer than ipmi1 (payload type added, payload length 2).
-        data = data[2:]
-    myaddr, netfnlun = struct.unpack("2B", bytes(data[14:16]))
-    netfn = (netfnlun & 0b11111100) >> 2
+        # ipmi2 header is two bytes longer than ipmi1 (payload type added,
+        # payload length 2)
+        offset = IPMI2_HEADER_LENGTH
+    if len(view) < offset + _SESSIONLESS_REQUEST.size:
+        return
+    (
+        myaddr,
+        netfnlun,
+        _,
+        clientaddr,
+        clientlun,
+        command,
+        verchannel,
+    ) = _SESSIONLESS_REQUEST.unpack_from(view, offset)
+    netfn = netfnlun >> 2
     mylun = netfnlun & 0b11
-    if netfn == 6:  # application request
-        if data[19] == 0x38:  # cmd = get channel auth capabilities
-            verchannel, level = struct.unpack("2B", bytes(data[20:22]))
-            version = verchannel & 0b10000000
-            if version != 0b10000000:
-                return
-            channel = verchannel & 0b1111
-            if channel != 0xE:
-                return
-            (clientaddr, clientlun) = struct.unpack("BB", bytes(data[17:19]))
-            clientseq = clientlun >> 2
-            clientlun &= 0b11  # Lun is only the least significant bits
-            level &= 0b1111
-            if authtype == 6:
-                self.send_auth_cap_v2(
-                    myaddr, mylun, clientaddr, clientlun, clientseq, sockaddr
-                )
-            else:
-                self.send_auth_cap(
-                    myaddr, mylun, clientaddr, clientlun, clientseq, sockaddr
-                )
-        elif data[19] == 0x54:
-            clientaddr, clientlun = data[17:19]
-            clientseq = clientlun >> 2
-            clientlun &= 0b11
-            self.send_cipher_suites(
-                myaddr, mylun, clientaddr, clientlun, clientseq, data, sockaddr
+    if netfn != 6:  # not an application request
+        return
+    clientseq = clientlun >> 2
+    clientlun &= 0b11  # Lun is only the least significant bits
+    if command == 0x38:  # cmd = get channel auth capabilities
+        version = verchannel & 0b10000000
+        if version != 0b10000000:
+            return
+        channel = verchannel & 0b1111
+        if channel != 0xE:
+            return
+        if authtype == 6:
+            self.send_auth_cap_v2(
+                myaddr, mylun, clientaddr, clientlun, clientseq, sockaddr
+            )
+        else:
+            self.send_auth_cap(
+                myaddr, mylun, clientaddr, clientlun, clientseq, sockaddr
             )
+    elif command == 0x54:
+        self.send_cipher_suites(
+            myaddr, mylun, clientaddr, clientlun, clientseq, view, sockaddr
+        )
+
+
+@functools.lru_cache(maxsize=None)
+def _sessionless_reply(command, data):
+    """Return the template of an IPMI 2.0 sessionless reply.
+
+    The template is complete but for the addresses, the sequence number
+    and the checksums, which `_send_sessionless_reply` patches in. Also
+    returns the part of the body checksum which never changes.
+    """
+    message_length = _REPLY_ADDRESSES.size + 1 + len(data) + 1
+    template = (
+        IPMI2_SESSIONLESS_HEADER
+        + struct.pack("<H", message_length)
+        + bytes(_REPLY_ADDRESSES.size)
+        + bytes([command])
+        + data
+        + b"\x00"
+    )
+    return template, command + sum(data)
+
+
+def _send_sessionless_reply(
+    self, command, data, myaddr, mylun, clientaddr, clientlun, clientseq, sockaddr
+):
+    template, body_sum = _sessionless_reply(command, data)
+    netfnlun = clientlun | (7 << 2)
+    seqlun = mylun | (clientseq << 2)
+    packet = bytearray(template)
+    _REPLY_ADDRESSES.pack_into(
+        packet,
+        IPMI2_HEADER_LENGTH,
+        clientaddr,
+        netfnlun,
+        -(clientaddr + netfnlun) & 0xFF,
+        myaddr,
+        seqlun,
+    )
+    packet[-1] = -(myaddr + seqlun + body_sum) & 0xFF
+    ipmisession._io_sendto(self.serversocket, packet, sockaddr)
 
 
 def send_auth_cap_v2(self, myaddr, mylun, clientaddr, clientlun, clientseq, sockaddr):
     """Send response to "get channel auth cap (0x38)" command with IPMI 2.0 headers.
 
     Copied from send_auth_cap function and modified to send response
-    in the form of IPMI 2.0.
+    in the form of IPMI 2.0, from a template built once.
     Based on pyghmi 1.5.16, Apache License 2.0
     https://opendev.org/x/pyghmi/src/branch/master/pyghmi/ipmi/private/serversession.py
     """
-    header = bytearray(
-        b"\x06\x00\xff\x07\x06\x00\x00\x00\x00\x00\x00\x00\x00\x00\x10\x00"
-    )
-    headerdata = [clientaddr, clientlun | (7 << 2)]
-    headersum = ipmisession._checksum(*headerdata)
-    header += bytearray(
-        headerdata + [headersum, myaddr, mylun | (clientseq << 2), 0x38]
+    _send_sessionless_reply(
+        self,
+        0x38,
+        bytes(self.authcap),
+        myaddr,
+        mylun,
+        clientaddr,
+        clientlun,
+        clientseq,
+        sockaddr,
     )
-    header += self.authcap
-    bodydata = struct.unpack("B" * len(header[19:]), bytes(header[19:]))
 
-    header.append(ipmisession._checksum(*bodydata))
-    ipmisession._io_sendto(self.serversocket, header, sockaddr)
+
+def send_cipher_suites(
+    self, myaddr, mylun, clientaddr, clientlun, clientseq, data, sockaddr
+):
+    """Send response to "get channel cipher suites (0x54)" command.
+
+    Same response as pyghmi, cipher suite 3 only, from a template built
+    once.
+    """
+    _send_sessionless_reply(
+        self,
+        0x54,
+        CIPHER_SUITES,
+        myaddr,
+        mylun,
+        clientaddr,
+        clientlun,
+        clientseq,
+        sockaddr,
+    )
 
 
 def send_asf_presence_pong(self, data, sockaddr):
     """Send response to ASF Presence Ping."""
-    header = bytearray(
-        b"\x06\x00\xff\x06\x00\x00\x11\xbe\x40"
-        + struct.pack("B", data[9])
-        + b"\x00\x10\x00\x00\x11\xbe\x00\x00\x00\x00\x81\x00\x00\x00\x00\x00\x00\x00"
-    )
-    ipmisession._io_sendto(self.serversocket, header, sockaddr)
+    packet = bytearray(ASF_PONG)
+    # Message tag of the ping
+    packet[9] = data[9]
+    ipmisession._io_sendto(self.serversocket, packet, sockaddr)
 
 
 # Patch pyghmi with modified functions
 ipmiserver.sessionless_data = sessionless_data
 ipmiserver.send_auth_cap_v2 = send_auth_cap_v2
+ipmiserver.send_cipher_suites = send_cipher_suites
 ipmiserver.send_asf_presence_pong = send_asf_presence_pong
 
 
@@ -189,6 +345,8 @@ class VirtualBMC(bmc.Bmc):
         viserver,
         viserver_username=None,
         viserver_password=None,
+        notify=None,
+        dispatcher=None,
         **kwargs
     ):
         super(VirtualBMC, self).__init__(
@@ -202,20 +360,236 @@ class VirtualBMC(bmc.Bmc):
             "vi_username": viserver_username,
             "vi_password": viserver_password,
         }
+        # (device, boot order) last set or found in effect
+        self._applied_boot_order = None
+        self.stats = {"reconfigures": 0, "reconfigures_avoided": 0}
+        # Called with an event name and keyword arguments to let the
+        # manager know about state changes
+        self._notify = notify
+        # Called with a handler, the request and the session to run the
+        # handler elsewhere than in the thread which received the request
+        self._dispatcher = dispatcher
+        self._task_lock = threading.Lock()
+        self._tasks_in_flight = {}
+        # Power state of the VM when last seen
+        self._power = None
+        self._last_task = None
+        # Concurrent identical requests share one VI Server call
+        self.flights = singleflight.Group()
+        # Retransmitted IPMI requests are answered without running again
+        self.replays = replay.ReplayCache(CONF["ipmi"]["replay_window"])
+        self._replay_stats = self.replays.stats()
+        # Sampled log of the requests received
+        self._access_log = log.RateLimit(CONF["log"]["access_log_rate"])
+        # Reported to the manager every few seconds when they change
+        self.metrics = metrics.Metrics()
+        if notify is not None:
+            metrics.report(self)
+
+        # Payloads of the responses which never change
+        self._device_id = bytes(
+            [
+                self.deviceid,
+                self.revision,
+                self.firmwaremajor,
+                self.firmwareminor,
+                self.ipmiversion,
+                self.additionaldevices,
+            ]
+        ) + struct.pack("<II", self.mfgid, self.prodid)
+        self._channel_access = bytes(
+            [
+                0b00100010,  # alerting disabled, auth enabled, always available
+                0x04,  # priviredge level limit = administrator
+            ]
+        )
+        self._channel_info = bytes(
+            [
+                0x02,  # channel number = 2
+                0x04,  # channel medium type = 802.3 LAN
+                0x01,  # channel protocol type = IPMB-1.0
+                0x80,  # session support = multi-session
+                0xF2,  # vendor id = 7154
+                0x1B,  # vendor id = 7154
+                0x00,  # vendor id = 7154
+                0x00,  # reserved
+                0x00,  # reserved
+            ]
+        )
+        # The first byte is revision, force to 0 as a dummy
+        self._lan_mac = None
+        if fakemac:
+            self._lan_mac = bytes(
+                [0] + utils.convert_fakemac_string_to_bytes(fakemac)
+            )
+
+    def _report_tasks(self):
+        if self._notify is None:
+            return
+        with self._task_lock:
+            in_flight = sorted(self._tasks_in_flight.values())
+            last_task = self._last_task
+        self._notify("tasks", in_flight=in_flight, last_task=last_task)
+
+    def report_metrics(self):
+        if self._notify is not None and self.metrics.changed:
+            self._notify("metrics", metrics=self.metrics.snapshot())
+
+    def _lap(self, viserver, phase, start):
+        now = time.monotonic()
+        self.metrics.observe(
+            "vbmc_vcenter_call_seconds", (self.vm_name, viserver, phase), now - start
+        )
+        return now
+
+    @contextlib.contextmanager
+    def _vm(self):
+        """Borrow a pooled VI Server session and look the VM up with it.
+
+        Yields the session and the VM, and measures the time taken to
+        get a logged in session, to look the VM up and by the operation
+        done in the block.
+        """
+        viserver = self._conn_args["vi"]
+        labels = (self.vm_name, viserver)
+        phase = "connect"
+        self.metrics.add("vbmc_vcenter_sessions_in_use", labels)
+        start = time.monotonic()
+        opener = pool.viserver_open(**self._conn_args)
+        try:
+            with opener as vi_session:
+                self.metrics.add(
+                    "vbmc_vcenter_session_acquires_total", labels + (opener.outcome,)
+                )
+                start = self._lap(viserver, phase, start)
+                phase = "lookup"
+                vm = _get_vm_object(vi_session, self)
+                start = self._lap(viserver, phase, start)
+                phase = "operation"
+                yield vi_session, vm
+        except Exception:
+            self.metrics.add("vbmc_vcenter_errors_total", labels + (phase,))
+            raise
+        finally:
+            self._lap(viserver, phase, start)
+            self.metrics.add("vbmc_vcenter_sessions_in_use", labels, -1)
+            if phase != "connect":
+                self.metrics.add(
+                    "vbmc_vcenter_received_bytes_total", labels, opener.bytes_received
+                )
+
+    def _call_vm(self, func):
+        """Return `func(vi_session, vm)`, called within `_vm()`.
+
+        Called once more if the pooled session turns out to have been
+        expired by the VI Server, see `pool.retry_expired`.
+        """
+
+        def call():
+            with self._vm() as (vi_session, vm):
+                return func(vi_session, vm)
+
+        return pool.retry_expired(call)
 
+    def _busy(self, operation):
+        """Return IPMI_COMMAND_NODE_BUSY, counting it for `operation`."""
+        self.metrics.add("vbmc_ipmi_busy_total", (self.vm_name, operation))
+        return IPMI_COMMAND_NODE_BUSY
+
+    def _power_state(self, vi_session, vm):
+        """Return the power state of the VM, reporting it if it changed."""
+        state = inventory.get_power_state(vi_session, vm)
+        self._observe_power(state)
+        return state
+
+    def _observe_power(self, state):
+        with self._task_lock:
+            previous, self._power = self._power, state
+        if state != previous and self._notify is not None:
+            self._notify("power", state=state, previous=previous)
+
+    def _track_task(self, vi_session, operation, task):
+        """Follow a vCenter task without waiting for it to finish."""
+        if task is None:
+            return
+
+        with self._task_lock:
+            self._tasks_in_flight[task._moId] = operation
+
+        try:
+            tasks.track_task(
+                vi_session,
+                task,
+                functools.partial(self._task_done, task._moId, operation),
+            )
+        except Exception as e:
+            LOG.warning(
+                "Unable to track %(op)s task of vm %(vm)s. Error: %(error)s",
+                {"op": operation, "vm": self.vm_name, "error": e},
+            )
+            with self._task_lock:
+                self._tasks_in_flight.pop(task._moId, None)
+            return
+
+        self._report_tasks()
+
+    def _task_done(self, moid, operation, state, error):
+        if state == "success":
+            LOG.debug(
+                "Task %(op)s for vm %(vm)s succeeded",
+                {"op": operation, "vm": self.vm_name},
+            )
+        else:
+            LOG.error(
+                "Task %(op)s for vm %(vm)s ended in state %(state)s. "
+                "Error: %(error)s",
+                {"op": operation, "vm": self.vm_name, "state": state, "error": error},
+            )
+
+        with self._task_lock:
+            self._tasks_in_flight.pop(moid, None)
+            self._last_task = {
+                "operation": operation,
+                "state": state,
+                "error": error,
+                "finished": time.time(),
+            }
+
+        self._report_tasks()
+
+        if state == "success" and operation in POWER_STATES:
+            self._observe_power(POWER_STATES[operation])
+
+    def get_chassis_status(self, session):
+        powerstate = self.get_power_state()
+        last_event = 0
+
+        with self._task_lock:
+            last_task = self._last_task
+
+        if last_task and last_task["operation"] in POWER_OPERATIONS:
+            if last_task["state"] != "success":
+                powerstate |= CHASSIS_POWER_CONTROL_FAULT
+            elif last_task["operation"] == "power_on":
+                last_event |= CHASSIS_LAST_POWER_ON_BY_IPMI
+
+        session.send_ipmi_response(data=[powerstate, last_event, 0])
+
+    @singleflight.coalesced()
     def get_boot_device(self):
         LOG.debug("Get boot device called for %(vm)s", {"vm": self.vm_name})
 
+        def get_boot_device(vi_session, vm):
+            path = "config.bootOptions.bootOrder"
+            boot_element = utils.retrieve_properties(vi_session, vm, [path])[path]
+            boot_dev = None
+            if boot_element:
+                boot_dev = utils.get_bootable_device_type(vi_session, boot_element[0])
+            LOG.debug("Boot device is: %s", boot_dev)
+            return GET_BOOT_DEVICES_MAP.get(boot_dev, 0)
+
         try:
-            with utils.viserver_open(**self._conn_args) as conn:
-                vm = _get_vm_object(conn, self)
-                boot_element = vm.config.bootOptions.bootOrder
-                boot_dev = None
-                if boot_element:
-                    boot_dev = utils.get_bootable_device_type(conn, boot_element[0])
-                LOG.debug("Boot device is: %s" % boot_dev)
-                return GET_BOOT_DEVICES_MAP.get(boot_dev, 0)
-            return IPMI_COMMAND_NODE_BUSY
+            return self._call_vm(get_boot_device)
         except Exception as e:
             msg = "Error getting boot device of vm %(vm)s. " "Error: %(error)s" % {
                 "vm": self.vm_name,
@@ -228,6 +602,7 @@ class VirtualBMC(bmc.Bmc):
         for boot_element in parent_element.findall("boot"):
             parent_element.remove(boot_element)
 
+    @singleflight.coalesced(serial=True)
     def set_boot_device(self, bootdevice):
         LOG.debug(
             "Set boot device called for %(vm)s with boot " 'device "%(bootdev)s"',
@@ -237,10 +612,33 @@ class VirtualBMC(bmc.Bmc):
         if device is None:
             # Invalid data field in request
             return IPMI_INVALID_DATA
+
+        def set_boot_device(vi_session, vm):
+            current = utils.boot_order_key(inventory.get_boot_order(vi_session, vm))
+
+            if self._applied_boot_order == (device, current):
+                # Nothing changed since we last set or checked it, no
+                # need to even look at the devices of the VM
+                wanted = current
+            else:
+                boot_order = utils.build_boot_order(vi_session, vm, device)
+                wanted = utils.boot_order_key(boot_order)
+
+            if wanted == current:
+                self.stats["reconfigures_avoided"] += 1
+                LOG.debug(
+                    "Boot device of vm %(vm)s is already %(bootdev)s",
+                    {"vm": self.vm_name, "bootdev": device},
+                )
+            else:
+                task = utils.set_boot_order(vi_session, vm, boot_order)
+                self._track_task(vi_session, "set_boot_device", task)
+                self.stats["reconfigures"] += 1
+
+            self._applied_boot_order = (device, wanted)
+
         try:
-            with utils.viserver_open(**self._conn_args) as conn:
-                vm = _get_vm_object(conn, self)
-                utils.set_boot_device(conn, vm, device)
+            self._call_vm(set_boot_device)
         except Exception as e:
             LOG.error(
                 "Failed setting the boot device %(bootdev)s for vm %(vm)s."
@@ -248,16 +646,15 @@ class VirtualBMC(bmc.Bmc):
                 {"bootdev": device, "vm": self.vm_name, "error": e},
             )
             # Command failed, but let client to retry
-            return IPMI_COMMAND_NODE_BUSY
+            return self._busy("set_boot_device")
 
+    @singleflight.coalesced()
     def get_power_state(self):
         LOG.debug("Get power state called for vm %(vm)s", {"vm": self.vm_name})
 
         try:
-            with utils.viserver_open(**self._conn_args) as conn:
-                vm = _get_vm_object(conn, self)
-                if "poweredOn" == vm.runtime.powerState:
-                    return POWERON
+            if "poweredOn" == self._call_vm(self._power_state):
+                return POWERON
         except Exception as e:
             msg = "Error getting the power state of vm %(vm)s. " "Error: %(error)s" % {
                 "vm": self.vm_name,
@@ -268,12 +665,11 @@ class VirtualBMC(bmc.Bmc):
 
         return POWEROFF
 
+    @singleflight.coalesced(serial=True)
     def pulse_diag(self):
         LOG.debug("Power diag called for vm %(vm)s", {"vm": self.vm_name})
         try:
-            with utils.viserver_open(**self._conn_args) as conn:
-                vm = _get_vm_object(conn, self)
-                utils.send_nmi(conn, vm)
+            self._call_vm(utils.send_nmi)
             LOG.debug(
                 "The NMI will be sent to the vm %(vm)s 60 seconds later",
                 {"vm": self.vm_name},
@@ -284,67 +680,82 @@ class VirtualBMC(bmc.Bmc):
                 {"vm": self.vm_name, "error": e},
             )
             # Command failed, but let client to retry
-            return IPMI_COMMAND_NODE_BUSY
+            return self._busy("pulse_diag")
 
+    @singleflight.coalesced(serial=True)
     def power_off(self):
         LOG.debug("Power off called for vm %(vm)s", {"vm": self.vm_name})
+
+        def power_off(vi_session, vm):
+            if "poweredOn" == self._power_state(vi_session, vm):
+                self._track_task(vi_session, "power_off", vm.PowerOff())
+
         try:
-            with utils.viserver_open(**self._conn_args) as conn:
-                vm = _get_vm_object(conn, self)
-                if "poweredOn" == vm.runtime.powerState:
-                    vm.PowerOff()
+            self._call_vm(power_off)
         except Exception as e:
             LOG.error(
                 "Error powering off the vm %(vm)s. " "Error: %(error)s",
                 {"vm": self.vm_name, "error": e},
             )
             # Command failed, but let client to retry
-            return IPMI_COMMAND_NODE_BUSY
+            return self._busy("power_off")
 
+    @singleflight.coalesced(serial=True)
     def power_on(self):
         LOG.debug("Power on called for vm %(vm)s", {"vm": self.vm_name})
+
+        def power_on(vi_session, vm):
+            if "poweredOn" != self._power_state(vi_session, vm):
+                self._track_task(vi_session, "power_on", vm.PowerOn())
+
         try:
-            with utils.viserver_open(**self._conn_args) as conn:
-                vm = _get_vm_object(conn, self)
-                if "poweredOn" != vm.runtime.powerState:
-                    vm.PowerOn()
+            self._call_vm(power_on)
         except Exception as e:
             LOG.error(
                 "Error powering on the vm %(vm)s. " "Error: %(error)s",
                 {"vm": self.vm_name, "error": e},
             )
             # Command failed, but let client to retry
-            return IPMI_COMMAND_NODE_BUSY
+            return self._busy("power_on")
 
+    @singleflight.coalesced(serial=True)
     def power_shutdown(self):
         LOG.debug("Soft power off called for vm %(vm)s", {"vm": self.vm_name})
+
+        def power_shutdown(vi_session, vm):
+            if "poweredOn" == self._power_state(vi_session, vm):
+                vm.ShutdownGuest()
+
         try:
-            with utils.viserver_open(**self._conn_args) as conn:
-                vm = _get_vm_object(conn, self)
-                if "poweredOn" == vm.runtime.powerState:
-                    vm.ShutdownGuest()
+            self._call_vm(power_shutdown)
         except Exception as e:
             LOG.error(
                 "Error soft powering off the vm %(vm)s. " "Error: %(error)s",
                 {"vm": self.vm_name, "error": e},
             )
             # Command failed, but let client to retry
-            return IPMI_COMMAND_NODE_BUSY
+            return self._busy("power_shutdown")
 
+    @singleflight.coalesced(serial=True)
     def power_reset(self):
         LOG.debug("Power reset called for vm %(vm)s", {"vm": self.vm_name})
+
+        def power_reset(vi_session, vm):
+            if "poweredOn" == self._power_state(vi_session, vm):
+                self._track_task(vi_session, "power_reset", vm.Reset())
+
         try:
-            with utils.viserver_open(**self._conn_args) as conn:
-                vm = _get_vm_object(conn, self)
-                if "poweredOn" == vm.runtime.powerState:
-                    vm.Reset()
+            self._call_vm(power_reset)
         except Exception as e:
             LOG.error(
                 "Error reseting the vm %(vm)s. " "Error: %(error)s",
                 {"vm": self.vm_name, "error": e},
             )
             # Command not supported in present state
-            return IPMI_COMMAND_NODE_BUSY
+            return self._busy("power_reset")
+
+    def get_device_id(self, request, session):
+        session.send_ipmi_response(data=self._device_id)
 
     def get_channel_access(self, request, session):
         """Fake response to "get channel access" command.
@@ -352,11 +763,7 @@ class VirtualBMC(bmc.Bmc):
         Send dummy packet to response "get channel access" command.
         Just exists to be able to negotiate with vCenter Server.
         """
-        data = [
-            0b00100010,  # alerting disabled, auth enabled, always available
-            0x04,  # priviredge level limit = administrator
-        ]
-        session.send_ipmi_response(data=data)
+        session.send_ipmi_response(data=self._channel_access)
 
     def get_channel_info(self, request, session):
         """Fake response to "get channel access" command.
@@ -365,18 +772,7 @@ class VirtualBMC(bmc.Bmc):
         as 802.3 LAN channel.
         Just exists to be able to negotiate with vCenter Server.
         """
-        data = [
-            0x02,  # channel number = 2
-            0x04,  # channel medium type = 802.3 LAN
-            0x01,  # channel protocol type = IPMB-1.0
-            0x80,  # session support = multi-session
-            0xF2,  # vendor id = 7154
-            0x1B,  # vendor id = 7154
-            0x00,  # vendor id = 7154
-            0x00,  # reserved
-            0x00,  # reserved
-        ]
-        session.send_ipmi_response(data=data)
+        session.send_ipmi_response(data=self._channel_info)
 
     def get_lan_configuration_parameters(self, request, session):
         """Fake response to "get lan conf params" command.
@@ -385,24 +781,32 @@ class VirtualBMC(bmc.Bmc):
         with fake MAC address.
         Just exists to be able to negotiate with vCenter Server.
         """
-        data = [0]  # the first byte is revision, force to 0 as a dummy
-
         req_param = request["data"][1]
-        LOG.info("Requested parameter = %s" % req_param)
+        LOG.debug("Requested parameter = %s", req_param)
 
-        if req_param == 5:  # mac address
-            data.extend(utils.convert_fakemac_string_to_bytes(self.fakemac))
+        if req_param == 5 and self._lan_mac is not None:  # mac address
+            session.send_ipmi_response(data=self._lan_mac)
         else:
-            pass
+            # Parameter not supported
+            session.send_ipmi_response(data=b"\x00", code=0x80)
 
-        LOG.info("ne: %s" % data)
+    def handle_raw_request(self, request, session):
+        if self._dispatcher is not None:
+            return self._dispatcher(self._handle_request, request, session)
 
-        if len(data) > 1:
-            session.send_ipmi_response(data=data)
-        else:
-            session.send_ipmi_response(data=data, code=0x80)
+        self._handle_request(request, session)
 
-    def handle_raw_request(self, request, session):
+    def _handle_request(self, request, session):
+        """Handle a request, unless it is a copy of one handled just now."""
+        self.replays.run(request, session, self.dispatch_raw_request)
+
+        replay_stats = self.replays.stats()
+        if replay_stats != self._replay_stats:
+            self._replay_stats = replay_stats
+            if self._notify is not None:
+                self._notify("replays", **replay_stats)
+
+    def dispatch_raw_request(self, request, session):
         """Call the appropriate function depending on the received command.
 
         Based on pyghmi 1.5.16, Apache License 2.0
@@ -448,45 +852,58 @@ class VirtualBMC(bmc.Bmc):
         # | 0x2C:0x05 | Group Extension | Activate/Deactivate Power Limit     |
         # | 0x2C:0x06 | Group Extension | Get Asset Tag                       |
         # | 0x2C:0x08 | Group Extension | Set Asset Tag                       |
-        LOG.info(
-            "Received netfn = 0x%x (%d), command = 0x%x (%d), data = %s"
-            % (
-                request["netfn"],
-                request["netfn"],
-                request["command"],
-                request["command"],
-                request["data"].hex(),
-            )
-        )
+        netfn = request["netfn"]
+        command = request["command"]
+        if LOG.isEnabledFor(logging.INFO):
+            skipped = self._access_log.allow()
+            if skipped is not None:
+                if skipped:
+                    LOG.info(
+                        "%(count)d request(s) for vm %(vm)s not logged",
+                        {"count": skipped, "vm": self.vm_name},
+                    )
+                LOG.info(
+                    "Received netfn = 0x%x (%d), command = 0x%x (%d), data = %s",
+                    netfn,
+                    netfn,
+                    command,
+                    command,
+                    request["data"].hex(),
+                )
+        start = time.monotonic()
         try:
-            if request["netfn"] == 6:
-                if request["command"] == 1:  # get device id
-                    return self.send_device_id(session)
-                elif request["command"] == 2:  # cold reset
-                    return session.send_ipmi_response(code=self.cold_reset())
-                elif request["command"] == 0x41:  # get channel access
-                    return self.get_channel_access(request, session)
-                elif request["command"] == 0x42:  # get channel info
-                    return self.get_channel_info(request, session)
-                elif request["command"] == 0x48:  # activate payload
-                    return self.activate_payload(request, session)
-                elif request["command"] == 0x49:  # deactivate payload
-                    return self.deactivate_payload(request, session)
-            elif request["netfn"] == 0:
-                if request["command"] == 1:  # get chassis status
-                    return self.get_chassis_status(session)
-                elif request["command"] == 2:  # chassis control
-                    return self.control_chassis(request, session)
-                elif request["command"] == 8:  # set boot options
-                    return self.set_system_boot_options(request, session)
-                elif request["command"] == 9:  # get boot options
-                    return self.get_system_boot_options(request, session)
-            elif request["netfn"] == 12:
-                if request["command"] == 2:  # get lan configuration parameters
-                    return self.get_lan_configuration_parameters(request, session)
+            handler = HANDLERS.get((netfn, command))
+            if handler is not None:
+                return handler(self, request, session)
             session.send_ipmi_response(code=0xC1)
         except NotImplementedError:
             session.send_ipmi_response(code=0xC1)
         except Exception:
             session._send_ipmi_net_payload(code=0xFF)
             traceback.print_exc()
+        finally:
+            self.metrics.observe(
+                "vbmc_ipmi_request_seconds",
+                (self.vm_name, netfn, command),
+                time.monotonic() - start,
+            )
+
+
+# The commands served by every virtual BMC
+register(0x00, 0x01, lambda self, request, session: self.get_chassis_status(session))
+register(0x00, 0x02, _method("control_chassis"))
+register(0x00, 0x08, _method("set_system_boot_options"))
+register(0x00, 0x09, _method("get_system_boot_options"))
+register(0x06, 0x01, _method("get_device_id"))
+register(
+    0x06,
+    0x02,
+    lambda self, request, session: session.send_ipmi_response(
+        code=self.cold_reset()
+    ),
+)
+register(0x06, 0x41, _method("get_channel_access"))
+register(0x06, 0x42, _method("get_channel_info"))
+register(0x06, 0x48, _method("activate_payload"))
+register(0x06, 0x49, _method("deactivate_payload"))
+register(0x0C, 0x02, _method("get_lan_configuration_parameters"))